@@ -0,0 +1,213 @@
+"""Users and sessions stored in SQLite.
+
+Passwords are hashed with scrypt in the thread pool so logins never stall
+the event loop. Sessions are random tokens kept in the ``sessions`` table;
+lookups go through a short-lived in-process cache so authenticated requests
+normally avoid a database round trip. Revoking a session bumps the
+"sessions" epoch (see workers.py), which clears the cache in every worker.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+import db
+
+logger = logging.getLogger(__name__)
+
+SESSION_COOKIE = "session_token"
+SESSION_TTL = 3600  # seconds, also the cookie max-age
+SESSION_CACHE_TTL = 60  # how long a worker trusts a cached session before re-checking
+SESSION_CACHE_SIZE = 10000
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+MAX_CONCURRENT_HASHES = max(1, os.cpu_count() or 1)
+
+_hash_slots = asyncio.Semaphore(MAX_CONCURRENT_HASHES)
+
+
+@dataclass(frozen=True)
+class User:
+    id: int
+    username: str
+
+
+class UsernameTaken(Exception):
+    pass
+
+
+def hash_password(password: str) -> str:
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return "$".join(["scrypt", str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P),
+                     base64.b64encode(salt).decode(), base64.b64encode(digest).decode()])
+
+
+def verify_password(password: str, stored: str) -> bool:
+    """Check ``password`` against an scrypt hash or a legacy unsalted sha256 hex digest."""
+    if not stored.startswith("scrypt$"):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+    _, n, r, p, salt, digest = stored.split("$")
+    expected = base64.b64decode(digest)
+    actual = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt), n=int(n), r=int(r), p=int(p),
+                            dklen=len(expected))
+    return hmac.compare_digest(actual, expected)
+
+
+def needs_rehash(stored: str) -> bool:
+    return not stored.startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
+
+async def _in_hash_pool(fn, *args):
+    async with _hash_slots:
+        return await run_in_threadpool(fn, *args)
+
+
+class SessionCache:
+    """TTL + LRU cache of session token -> (User, expires_at)."""
+
+    def __init__(self, ttl: float = SESSION_CACHE_TTL, maxsize: int = SESSION_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, User, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[User]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                cached_until, user, expires_at = entry
+                if cached_until > now and expires_at > now:
+                    self._entries.move_to_end(token)
+                    self.hits += 1
+                    return user
+                del self._entries[token]
+        self.misses += 1
+        return None
+
+    def put(self, token: str, user: User, expires_at: float):
+        with self._lock:
+            self._entries[token] = (time.time() + self.ttl, user, expires_at)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, token: str):
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+session_cache = SessionCache()
+
+
+async def create_user(username: str, password: str, email: str, broj: str) -> int:
+    password_hash = await _in_hash_pool(hash_password, password)
+    try:
+        cursor = await db.execute(
+            "INSERT INTO users (username, password_hash, email, broj, created_at) VALUES (?, ?, ?, ?, ?)",
+            (username, password_hash, email, broj, time.time()))
+    except sqlite3.IntegrityError:
+        raise UsernameTaken(username)
+    return cursor.lastrowid
+
+
+async def authenticate(username: str, password: str) -> Optional[User]:
+    row = await db.fetchone("SELECT id, password_hash FROM users WHERE username = ?", (username,))
+    if not row:
+        # Burn comparable time so unknown usernames aren't distinguishable by latency
+        await _in_hash_pool(hash_password, password)
+        return None
+    user_id, stored = row
+    if not await _in_hash_pool(verify_password, password, stored):
+        return None
+    if needs_rehash(stored):
+        new_hash = await _in_hash_pool(hash_password, password)
+        await db.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hash, user_id))
+        logger.debug("Upgraded password hash for user id %s", user_id)
+    return User(user_id, username)
+
+
+async def create_session(user: User) -> str:
+    token = secrets.token_urlsafe(32)
+    now = time.time()
+
+    def _create(conn):
+        conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
+        conn.execute("INSERT INTO sessions (token, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                     (token, user.id, now, now + SESSION_TTL))
+
+    await db.run(_create)
+    session_cache.put(token, user, now + SESSION_TTL)
+    return token
+
+
+async def get_session_user(token: Optional[str]) -> Optional[User]:
+    if not token:
+        return None
+    user = session_cache.get(token)
+    if user is not None:
+        return user
+    row = await db.fetchone(
+        """SELECT u.id, u.username, s.expires_at FROM sessions s JOIN users u ON u.id = s.user_id
+           WHERE s.token = ? AND s.expires_at > ?""", (token, time.time()))
+    if not row:
+        return None
+    user = User(row[0], row[1])
+    session_cache.put(token, user, row[2])
+    return user
+
+
+async def delete_session(token: Optional[str]):
+    if not token:
+        return
+    session_cache.discard(token)
+    await db.execute("DELETE FROM sessions WHERE token = ?", (token,))
+
+
+def migrate_users_json(path: Path) -> int:
+    """One-shot import of the legacy users.json; renames the file afterwards.
+
+    Legacy sha256 hashes are kept as-is and upgraded to scrypt on the next
+    successful login.
+    """
+    if not path.exists():
+        return 0
+    try:
+        content = path.read_text().strip()
+        users = json.loads(content) if content else {}
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error(f"Failed to read {path} for migration: {e}")
+        return 0
+    rows = [(username, data.get("password", ""), data.get("email"), data.get("broj"), time.time())
+            for username, data in users.items() if data.get("password")]
+    with db.transaction() as conn:
+        conn.executemany("INSERT OR IGNORE INTO users (username, password_hash, email, broj, created_at) "
+                         "VALUES (?, ?, ?, ?, ?)", rows)
+    try:
+        path.rename(path.with_name(path.name + ".migrated"))
+    except FileNotFoundError:
+        return 0  # another worker migrated it at the same time; INSERT OR IGNORE made that harmless
+    logger.info(f"Migrated {len(rows)} users from {path}")
+    return len(rows)
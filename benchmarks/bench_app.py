@@ -0,0 +1,233 @@
+"""End-to-end benchmark against a synthetic library, fully offline.
+
+Run from the repository root (needs httpx, which FastAPI's test client uses):
+
+    python benchmarks/bench_app.py --playlists 200 --songs 100000
+    python benchmarks/bench_app.py --save baseline.json
+    python benchmarks/bench_app.py --compare baseline.json --tolerance 0.25
+
+Builds a throwaway MUSIC_DIR of silent mp3s, database, lyrics and users in a
+temporary directory (or --workdir), stubs yt_dlp, then reports:
+
+* micro-benchmarks: cold and warm index_songs, parse_lyrics, get_songs paging
+* an in-process ASGI load test mixing /songs, /playlists, ranged /song/{id}
+  and /login at a fixed concurrency, with p50/p95/p99 and throughput. The
+  app runs with its lifespan, as under a server. "songs" repeats one page,
+  so after the first request it measures the snapshot cache; "songs_query"
+  asks for a random cursor and limit each time, so it misses the cache and
+  measures the paginated query
+
+--compare exits non-zero when a timing is more than --tolerance slower than
+the saved baseline, so the script can gate regressions.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+import httpx  # noqa: E402
+
+from benchmarks import synthetic  # noqa: E402
+
+PASSWORD = "benchmark"
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank percentile
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def timed(fn, *args, repeat=1):
+    """Best wall time of ``repeat`` calls, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def micro_benchmarks(app, args, results):
+    from lyrics import parse_lyrics
+
+    print("micro-benchmarks:")
+    cold = timed(app.index_songs)
+    warm = timed(app.index_songs, repeat=3)
+    songs = app.library_indexer.progress.scanned
+    results["index_songs_cold_s"] = cold
+    results["index_songs_warm_s"] = warm
+    print(f"  index_songs cold ({songs} files)      {cold * 1000:10.1f} ms")
+    print(f"  index_songs warm (no changes)         {warm * 1000:10.1f} ms")
+
+    rng = random.Random(3)
+    texts = [synthetic.synthetic_lrc(rng, 60) for _ in range(500)]
+    parse = timed(lambda: [parse_lyrics(t) for t in texts], repeat=3) / len(texts)
+    results["parse_lyrics_s"] = parse
+    print(f"  parse_lyrics (60 lines)               {parse * 1e6:10.1f} us")
+
+    async def page_all():
+        cursor, total = None, 0
+        while True:
+            body = await app._songs_page(limit=app.SONGS_PAGE_MAX, cursor=cursor, playlist=None, fields=None)
+            total += len(body["songs"])
+            cursor = body["next_cursor"]
+            if not cursor:
+                return total
+
+    start = time.perf_counter()
+    total = asyncio.run(page_all())
+    elapsed = time.perf_counter() - start
+    results["get_songs_all_s"] = elapsed
+    print(f"  get_songs, all {total} songs paged    {elapsed * 1000:10.1f} ms")
+
+
+async def load_test(app, args, song_ids, cursors, users, results):
+    scenarios = [
+        ("songs", 4, lambda c: c.get("/songs", params={"limit": 500})),
+        # A fresh (cursor, limit) pair is a new snapshot key, so this goes to the database
+        ("songs_query", 4, lambda c: c.get("/songs", params={"limit": random.randint(400, 500),
+                                                              "cursor": random.choice(cursors)})),
+        ("playlists", 2, lambda c: c.get("/playlists")),
+        ("song_range", 6, lambda c: c.get(f"/song/{random.choice(song_ids)}",
+                                          headers={"Range": f"bytes={random.randint(0, 1000)}-"})),
+        ("login", 1, lambda c: c.post("/login", data={"username": random.choice(users), "password": PASSWORD},
+                                      follow_redirects=False)),
+    ]
+    names = [name for name, _, _ in scenarios]
+    weights = [weight for _, weight, _ in scenarios]
+    calls = {name: call for name, _, call in scenarios}
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    rng = random.Random(4)
+    plan = rng.choices(names, weights, k=args.requests)
+    queue = asyncio.Queue()
+    for name in plan:
+        queue.put_nowait(name)
+
+    asgi_app = app.create_app()
+    transport = httpx.ASGITransport(app=asgi_app)
+    # ASGITransport sends no lifespan events; run startup and shutdown around the test as a server would
+    async with asgi_app.router.lifespan_context(asgi_app), \
+            httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await asyncio.to_thread(app.library_indexer.wait)  # the startup index run
+        async def worker():
+            while True:
+                try:
+                    name = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                start = time.perf_counter()
+                response = await calls[name](client)
+                latencies[name].append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    errors[name] += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        wall = time.perf_counter() - start
+
+    print(f"load test: {args.requests} requests, concurrency {args.concurrency}, "
+          f"{args.requests / wall:.0f} req/s overall")
+    print(f"  {'endpoint':<12} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8}")
+    results["load_rps"] = args.requests / wall
+    for name in names:
+        values = sorted(latencies[name])
+        p50, p95, p99 = (percentile(values, f) for f in (0.50, 0.95, 0.99))
+        rate = len(values) / wall
+        print(f"  {name:<12} {len(values):>6} {errors[name]:>6} {p50 * 1000:9.2f} {p95 * 1000:9.2f} "
+              f"{p99 * 1000:9.2f} {rate:8.0f}")
+        results[f"{name}_p50_s"] = p50
+        results[f"{name}_p95_s"] = p95
+        results[f"{name}_p99_s"] = p99
+        if values:
+            results[f"{name}_mean_s"] = statistics.fmean(values)
+
+
+def compare(results, baseline_path, tolerance):
+    baseline = json.loads(Path(baseline_path).read_text())
+    regressions = []
+    print(f"compared with {baseline_path} (tolerance {tolerance:.0%}):")
+    for key, value in sorted(results.items()):
+        old = baseline.get(key)
+        if not old:
+            continue
+        # Throughput regresses when it drops; everything else is a duration
+        change = (old - value) / old if key.endswith("_rps") else (value - old) / old
+        flag = "  REGRESSION" if change > tolerance else ""
+        print(f"  {key:<28} {old:12.6g} -> {value:12.6g}  {change:+7.1%}{flag}")
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--playlists", type=int, default=50)
+    parser.add_argument("--songs", type=int, default=10000)
+    parser.add_argument("--frames", type=int, default=4, help="mp3 frames per file (about 26 ms each)")
+    parser.add_argument("--lyrics-fraction", type=float, default=0.2)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workdir", type=Path, help="keep the synthetic data here instead of a temp dir")
+    parser.add_argument("--save", type=Path, help="write the results as JSON")
+    parser.add_argument("--compare", type=Path, help="baseline JSON from an earlier --save")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    tmp = None
+    if args.workdir is None:
+        tmp = tempfile.TemporaryDirectory(prefix="echo-bench-")
+        args.workdir = Path(tmp.name)
+    args.workdir = args.workdir.resolve()
+    save = args.save.resolve() if args.save else None
+    baseline = args.compare.resolve() if args.compare else None
+
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    synthetic.prepare_workdir(args.workdir, REPO)
+    synthetic.install_fake_ytdlp()
+    start = time.perf_counter()
+    synthetic.build_library(args.workdir / "music", args.playlists, args.songs, args.frames)
+    print(f"generated {args.songs} files in {args.playlists} playlists in {time.perf_counter() - start:.1f}s "
+          f"under {args.workdir}")
+
+    import db
+    import main as app_main
+
+    app_main.setup()
+    results = {}
+    micro_benchmarks(app_main, args, results)
+    with db.connection() as conn:
+        with_lyrics = synthetic.add_lyrics(conn, args.lyrics_fraction)
+        users = synthetic.add_users(conn, args.users, PASSWORD)
+        song_ids = [row[0] for row in conn.execute("SELECT id FROM songs")]
+        cursors = [app_main.encode_cursor(*row) for row in conn.execute("SELECT playlist, position, id FROM songs")]
+    print(f"added lyrics to {with_lyrics} songs and {len(users)} users")
+    asyncio.run(load_test(app_main, args, song_ids, cursors, users, results))
+
+    if save:
+        save.write_text(json.dumps(results, indent=2, sort_keys=True))
+        print(f"saved results to {save}")
+    regressions = compare(results, baseline, args.tolerance) if baseline else []
+    app_main.job_manager.shutdown()
+    if tmp is not None:
+        os.chdir(REPO)
+        tmp.cleanup()
+    if regressions:
+        sys.exit(f"{len(regressions)} timings regressed: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
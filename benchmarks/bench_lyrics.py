@@ -0,0 +1,88 @@
+"""Compare the old and new lyric parsing and storage formats.
+
+Run from the repository root:
+
+    python benchmarks/bench_lyrics.py [--lines 60] [--songs 200]
+
+Reports parse time per song, stored size per song, decode time and the
+cost of finding the active line (linear scan vs bisect).
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import lyrics  # noqa: E402
+from benchmarks.synthetic import synthetic_lrc  # noqa: E402
+
+
+def old_parse_lyrics(lyrics_text):
+    """The parser main.py used before the compact format, minus its logging."""
+    parsed_lyrics = []
+    for line in lyrics_text.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        match = re.match(r'^\[(\d{2}):(\d{2}\.\d{2})\](.*)$', line)
+        if match:
+            time = int(match.group(1)) * 60 + float(match.group(2))
+            if 0 <= time < 3600:
+                parsed_lyrics.append({"time": time, "text": match.group(3).strip()})
+    parsed_lyrics.sort(key=lambda x: x["time"])
+    return parsed_lyrics
+
+
+def old_active_line(parsed, seconds):
+    index = -1
+    for i, lyric in enumerate(parsed):
+        if seconds >= lyric["time"]:
+            index = i
+        else:
+            break
+    return index
+
+
+def bench(label, fn, items):
+    """Print the best-of-5 time of ``fn`` divided by the ``items`` it handles."""
+    seconds = min(timeit.repeat(fn, number=1, repeat=5))
+    print(f"{label:<34} {seconds / items * 1e6:10.2f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=60, help="lyric lines per song")
+    parser.add_argument("--songs", type=int, default=200, help="number of synthetic songs")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    texts = [synthetic_lrc(rng, args.lines) for _ in range(args.songs)]
+    old = [old_parse_lyrics(text) for text in texts]
+    new = [lyrics.parse_lyrics(text) for text in texts]
+    assert all(len(a) == len(b) for a, b in zip(old, new))
+
+    old_stored = [json.dumps(parsed) for parsed in old]
+    new_stored = [parsed.encode() for parsed in new]
+    old_bytes = sum(len(s.encode()) for s in old_stored) / args.songs
+    new_bytes = sum(len(s.encode()) for s in new_stored) / args.songs
+
+    print(f"{args.songs} songs x {args.lines} lines, per song:")
+    bench("parse (old regex per line)", lambda: [old_parse_lyrics(t) for t in texts], args.songs)
+    bench("parse (new LRC parser)", lambda: [lyrics.parse_lyrics(t) for t in texts], args.songs)
+    bench("decode (old json list)", lambda: [json.loads(s) for s in old_stored], args.songs)
+    bench("decode (new compact)", lambda: [lyrics.decode(s) for s in new_stored], args.songs)
+    print(f"{'stored size (old)':<34} {old_bytes:10.0f} B")
+    print(f"{'stored size (new)':<34} {new_bytes:10.0f} B  ({new_bytes / old_bytes:.0%})")
+
+    probes = [rng.uniform(0, old[0][-1]["time"]) for _ in range(1000)]
+    print("active line lookup, per call:")
+    bench("linear scan (old)", lambda: [old_active_line(old[0], p) for p in probes], len(probes))
+    bench("bisect (new)", lambda: [new[0].index_at(p) for p in probes], len(probes))
+
+
+if __name__ == "__main__":
+    main()
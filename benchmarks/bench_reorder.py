@@ -0,0 +1,111 @@
+"""Playlist reordering: single-song moves vs rewriting the whole order.
+
+Run from the repository root:
+
+    python benchmarks/bench_reorder.py [--songs 5000] [--moves 200]
+
+Works on a throwaway database built with the real migrations.
+"""
+import argparse
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import db  # noqa: E402
+
+PLAYLIST = "Big"
+
+
+def setup(path: Path, songs: int):
+    conn = db.connect(path)
+    db.migrate(conn)
+    with conn:
+        conn.execute("INSERT INTO playlists (name, image_path) VALUES (?, 'default.jpg')", (PLAYLIST,))
+        conn.executemany("INSERT INTO songs (title, artist, filename, playlist, position) VALUES (?, ?, ?, ?, ?)",
+                         [(f"Song {i}", f"Artist {i % 97}", f"{PLAYLIST}/{i}.mp3", PLAYLIST, i * db.POSITION_GAP)
+                          for i in range(songs)])
+    return conn
+
+
+def order(conn):
+    return [row[0] for row in conn.execute("SELECT id FROM songs WHERE playlist = ? ORDER BY position, id",
+                                           (PLAYLIST,))]
+
+
+def timed(label, fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{label:<44} {elapsed * 1000:9.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--songs", type=int, default=5000)
+    parser.add_argument("--moves", type=int, default=200)
+    args = parser.parse_args()
+    rng = random.Random(7)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = setup(Path(tmp) / "bench.db", args.songs)
+        ids = order(conn)
+        print(f"playlist of {args.songs} songs, mean per operation:")
+
+        def per_row_rewrite():
+            rng.shuffle(ids)
+            with conn:
+                for position, song_id in enumerate(ids):
+                    conn.execute("UPDATE songs SET position = ? WHERE id = ? AND playlist = ?",
+                                 (position * db.POSITION_GAP, song_id, PLAYLIST))
+
+        def bulk_rewrite():
+            rng.shuffle(ids)
+            with conn:
+                conn.executemany("UPDATE songs SET position = ? WHERE id = ? AND playlist = ?",
+                                 [(position * db.POSITION_GAP, song_id, PLAYLIST)
+                                  for position, song_id in enumerate(ids)])
+
+        timed("full reorder, one execute per row", per_row_rewrite, 5)
+        timed("full reorder, single executemany", bulk_rewrite, 5)
+
+        compactions = 0
+
+        def random_move():
+            nonlocal compactions
+            song_id, after_id = rng.sample(ids, 2)
+            with conn:
+                _, compacted = db.move_song(conn, song_id, after_id)
+            compactions += compacted
+
+        timed("move one song (move_song)", random_move, args.moves)
+
+        hot = order(conn)
+        target = hot[10]
+        compactions = 0
+
+        def same_gap_move():
+            # Keep dropping songs into the same slot to force the gap to run out
+            nonlocal compactions
+            song_id = rng.choice(hot[100:])
+            with conn:
+                _, compacted = db.move_song(conn, song_id, target)
+            compactions += compacted
+            hot.remove(song_id)
+            hot.insert(hot.index(target) + 1, song_id)
+
+        timed("move into the same slot repeatedly", same_gap_move, args.moves)
+        print(f"{'  compactions during those moves':<44} {compactions:9d}")
+        assert order(conn) == hot, "move_song order diverged from the expected order"
+
+        with conn:
+            timed("compact_playlist", lambda: db.compact_playlist(conn, PLAYLIST), 1)
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Cold start: how soon a freshly started server answers, serves the library and is ready.
+
+Run from the repository root (needs uvicorn):
+
+    python benchmarks/bench_startup.py [--songs 10000] [--runs 3]
+
+Builds a synthetic library in a temporary directory (or --workdir), then
+starts the app factory under uvicorn in a new process ``--runs`` times and
+polls it. The first run starts on an empty database, so it includes the
+migrations and a full index; later runs reuse the database. Per run:
+
+* import: seconds for a fresh interpreter to import main, and whether
+  that pulled in yt_dlp
+* first byte: process start until /healthz answers
+* first /songs: until a page of /songs is returned
+* ready: until /readyz returns 200, i.e. the first index run has finished
+"""
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+from benchmarks import synthetic  # noqa: E402
+
+POLL_INTERVAL = 0.005
+TIMEOUT = 600.0
+
+IMPORT_PROBE = ("import sys, time; start = time.perf_counter(); import main; "
+                "print(time.perf_counter() - start, 'yt_dlp' in sys.modules)")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get(port: int, path: str) -> int:
+    """Status of GET ``path``, or 0 while nothing is listening yet."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=TIMEOUT)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    except ConnectionError:
+        return 0
+    finally:
+        conn.close()
+
+
+def wait_for(port: int, path: str, started: float, server: subprocess.Popen) -> float:
+    """Seconds from ``started`` until GET ``path`` returns 200."""
+    while time.perf_counter() - started < TIMEOUT:
+        if get(port, path) == 200:
+            return time.perf_counter() - started
+        if server.poll() is not None:
+            sys.exit(f"server exited with {server.returncode}")
+        time.sleep(POLL_INTERVAL)
+    sys.exit(f"{path} not answered within {TIMEOUT:.0f}s")
+
+
+def measure_import(env: dict):
+    out = subprocess.run([sys.executable, "-c", IMPORT_PROBE], env=env, check=True, capture_output=True,
+                         text=True).stdout.split()
+    return float(out[0]), out[1] == "True"
+
+
+def measure_start(env: dict) -> dict:
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "--factory", "main:create_app",
+                               "--port", str(port), "--log-level", "warning"], env=env)
+    try:
+        return {
+            "first_byte": wait_for(port, "/healthz", started, server),
+            "first_songs": wait_for(port, "/songs?limit=500", started, server),
+            "ready": wait_for(port, "/readyz", started, server),
+        }
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--playlists", type=int, default=50)
+    parser.add_argument("--songs", type=int, default=10000)
+    parser.add_argument("--frames", type=int, default=4, help="mp3 frames per file (about 26 ms each)")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--workdir", type=Path, help="keep the synthetic data here instead of a temp dir")
+    args = parser.parse_args()
+
+    tmp = None
+    if args.workdir is None:
+        tmp = tempfile.TemporaryDirectory(prefix="echo-startup-")
+        args.workdir = Path(tmp.name)
+    args.workdir = args.workdir.resolve()
+
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    synthetic.prepare_workdir(args.workdir, REPO)
+    for stale in args.workdir.glob("songs.db*"):
+        stale.unlink()
+    synthetic.build_library(args.workdir / "music", args.playlists, args.songs, args.frames)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(REPO), os.environ.get("PYTHONPATH")])))
+
+    import_s, with_ytdlp = measure_import(env)
+    print(f"import main: {import_s * 1000:.0f} ms, yt_dlp imported: {'yes' if with_ytdlp else 'no'}")
+    print(f"{args.songs} songs in {args.playlists} playlists, seconds from process start:")
+    print(f"  {'run':<6} {'first byte':>11} {'first /songs':>13} {'ready':>9}")
+    for run in range(args.runs):
+        timings = measure_start(env)
+        label = "cold" if run == 0 else "warm"
+        print(f"  {label:<6} {timings['first_byte']:11.3f} {timings['first_songs']:13.3f} {timings['ready']:9.3f}")
+
+    os.chdir(REPO)
+    if tmp is not None:
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
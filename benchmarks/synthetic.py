@@ -0,0 +1,134 @@
+"""Synthetic fixtures for the benchmarks: a music library, LRC lyrics, users and an offline yt_dlp.
+
+Everything is generated from a seed so two runs with the same arguments
+measure the same data. Import after putting the repository root on sys.path.
+"""
+import os
+import random
+import sys
+import time
+import types
+import zlib
+from pathlib import Path
+from typing import List
+
+import auth
+import lyrics
+
+# One MPEG-1 Layer III frame: 128 kbps, 44.1 kHz, mono, no CRC. An all-zero
+# body decodes as silence, and each frame is 417 bytes (about 26 ms).
+MP3_FRAME = bytes([0xFF, 0xFB, 0x90, 0xC0]) + bytes(413)
+
+WORDS = "love night heart fire dream light road home rain sky time away tonight forever".split()
+
+
+def silent_mp3(frames: int = 4) -> bytes:
+    return MP3_FRAME * frames
+
+
+def build_library(root: Path, playlists: int, songs: int, frames: int = 4, seed: int = 1) -> List[Path]:
+    """Write ``songs`` silent mp3s spread over ``playlists`` directories under ``root``.
+
+    File names follow the "Title - Artist.mp3" pattern the indexer parses,
+    with artists drawn from a pool so shuffles have repeats to spread.
+    """
+    rng = random.Random(seed)
+    data = silent_mp3(frames)
+    artists = [f"Artist {i}" for i in range(max(1, songs // 20))]
+    dirs = []
+    for p in range(playlists):
+        path = root / f"Playlist {p:04d}"
+        path.mkdir(parents=True, exist_ok=True)
+        dirs.append(path)
+    for i in range(songs):
+        name = f"Track {i:06d} - {rng.choice(artists)}.mp3"
+        with open(dirs[i % playlists] / name, "wb") as f:
+            f.write(data)
+    return dirs
+
+
+def synthetic_lrc(rng: random.Random, lines: int = 60) -> str:
+    """LRC text in the plain [mm:ss.xx] form that both the old and new parsers read."""
+    out = ["[ar:Someone]", "[ti:Something]"]
+    t = 5.0
+    for _ in range(lines):
+        t += rng.uniform(1.5, 6.0)
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 9)))
+        out.append(f"[{int(t // 60):02d}:{t % 60:05.2f}]{text}")
+    return "\n".join(out)
+
+
+def add_lyrics(conn, fraction: float, lines: int = 60, seed: int = 2) -> int:
+    """Attach parsed synthetic lyrics to roughly ``fraction`` of the songs."""
+    rng = random.Random(seed)
+    ids = [row[0] for row in conn.execute("SELECT id FROM songs")]
+    chosen = [song_id for song_id in ids if rng.random() < fraction]
+    with conn:
+        conn.executemany("UPDATE songs SET lyrics_text = ? WHERE id = ?",
+                         [(lyrics.parse_lyrics(synthetic_lrc(rng, lines)).encode(), song_id) for song_id in chosen])
+    return len(chosen)
+
+
+def add_users(conn, count: int, password: str = "benchmark") -> List[str]:
+    """Create ``count`` users sharing ``password``; hashing is the slow part, so it is done once."""
+    password_hash = auth.hash_password(password)
+    names = [f"user{i}" for i in range(count)]
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
+                         [(name, password_hash, time.time()) for name in names])
+    return names
+
+
+class FakeYoutubeDL:
+    """Just enough of yt_dlp.YoutubeDL for youtube.py: canned searches, silent downloads."""
+
+    def __init__(self, opts=None):
+        self.opts = opts or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url, download=False):
+        if url.startswith("ytsearch"):
+            prefix, _, query = url.partition(":")
+            limit = int(prefix[len("ytsearch"):] or 1)
+            return {"_type": "playlist", "entries": [
+                {"id": f"{zlib.crc32(query.encode()):08x}{i}", "title": f"{query} {i}", "uploader": f"Channel {i}"}
+                for i in range(limit)]}
+        if "list=" in url and not self.opts.get("noplaylist"):
+            return {"_type": "playlist", "entries": [{"id": f"fake{i}"} for i in range(3)]}
+        video_id = url.rsplit("=", 1)[-1]
+        info = {"id": video_id, "title": f"Fake {video_id}", "uploader": "Fake Artist - Topic", "ext": "mp3"}
+        if download:
+            path = Path(self.prepare_filename(info))
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(silent_mp3())
+        return info
+
+    def prepare_filename(self, info):
+        return self.opts.get("outtmpl", "%(title)s.%(ext)s") % info
+
+
+def install_fake_ytdlp():
+    """Register the fake as ``yt_dlp`` so importing the app never touches the network."""
+    module = types.ModuleType("yt_dlp")
+    module.YoutubeDL = FakeYoutubeDL
+    sys.modules["yt_dlp"] = module
+    return module
+
+
+def prepare_workdir(workdir: Path, repo: Path):
+    """Point the app at ``workdir``: env paths for its data and links to static/ and templates/."""
+    workdir.mkdir(parents=True, exist_ok=True)
+    for name in ("static", "templates"):
+        link = workdir / name
+        if not link.exists():
+            link.symlink_to(repo / name, target_is_directory=True)
+    os.environ["DB_PATH"] = str(workdir / "songs.db")
+    os.environ["MUSIC_DIR"] = str(workdir / "music")
+    os.environ["IMAGES_DIR"] = str(workdir / "images")
+    (workdir / "music").mkdir(exist_ok=True)
+    os.chdir(workdir)
@@ -0,0 +1,151 @@
+"""Library change log for delta sync and push updates.
+
+Triggers on ``songs`` and ``playlists`` append a row to ``changes`` for
+every insert, update and delete, whichever route, job or indexer run made
+it, and the row's AUTOINCREMENT id is the library version. ``delta`` folds
+everything after a version into the current state of each song and
+playlist it touched, so a client that is behind applies a small diff
+instead of refetching the library. Old rows are pruned; a client that
+fell further behind than that is told to reset.
+
+ChangeFeed polls the latest version and wakes /changes/stream
+subscribers when it moves. Polling the database rather than hooking the
+write paths also sees writes made by other processes.
+"""
+import asyncio
+import logging
+import sqlite3
+from typing import Dict, List, Optional
+
+import db
+from playqueue import SONG_COLUMNS, song_dict
+
+logger = logging.getLogger(__name__)
+
+RETAIN = 100_000  # newest change rows kept
+POLL_INTERVAL = 1.0  # seconds between version checks
+PRUNE_EVERY = 600  # polls between prunes
+DELTA_LIMIT_DEFAULT = 1000
+DELTA_LIMIT_MAX = 5000
+_ID_CHUNK = 500
+
+PLAYLIST_COLUMNS = "name, image_path, id, thumbnails"
+
+
+def current_version(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+    return row[0] if row else 0
+
+
+def _fetch_by_id(conn: sqlite3.Connection, sql: str, ids: List[int]) -> Dict[int, tuple]:
+    """Rows of ``sql`` (whose first column is the id) for ``ids``, chunked to stay under the variable limit."""
+    found = {}
+    for start in range(0, len(ids), _ID_CHUNK):
+        chunk = ids[start:start + _ID_CHUNK]
+        for row in conn.execute(sql.format(placeholders=", ".join("?" * len(chunk))), chunk):
+            found[row[0]] = row
+    return found
+
+
+def delta(conn: sqlite3.Connection, since: int, limit: int = DELTA_LIMIT_DEFAULT) -> dict:
+    """Everything that changed after version ``since``, as current rows and deleted ids.
+
+    At most ``limit`` songs and playlists are returned, oldest change first;
+    ``more`` says whether to ask again with the returned ``version``.
+    Playlists are raw (name, image_path, id, thumbnails) rows for the
+    caller to format. ``reset`` means ``since`` is older than the log and
+    the client has to refetch everything.
+    """
+    version = current_version(conn)
+    oldest = conn.execute("SELECT MIN(version) FROM changes").fetchone()[0]
+    if since < version and since < (oldest or version + 1) - 1:
+        return {"version": version, "reset": True}
+
+    touched = conn.execute(
+        """SELECT entity, entity_id, MAX(version) AS last FROM changes WHERE version > ? AND version <= ?
+           GROUP BY entity, entity_id ORDER BY last LIMIT ?""", (since, version, limit + 1)).fetchall()
+    more = len(touched) > limit
+    touched = touched[:limit]
+    song_ids = [entity_id for entity, entity_id, _ in touched if entity == "song"]
+    playlist_ids = [entity_id for entity, entity_id, _ in touched if entity == "playlist"]
+    # Ids that no longer exist were deleted; their last change says so too
+    songs = _fetch_by_id(conn, f"SELECT {SONG_COLUMNS} FROM songs s WHERE s.id IN ({{placeholders}})", song_ids)
+    playlists = _fetch_by_id(conn, f"SELECT id, {PLAYLIST_COLUMNS} FROM playlists WHERE id IN ({{placeholders}})",
+                             playlist_ids)
+    return {
+        "version": touched[-1][2] if more else version,
+        "reset": False,
+        "more": more,
+        "songs": [song_dict(songs[song_id]) for song_id in song_ids if song_id in songs],
+        "deleted_songs": [song_id for song_id in song_ids if song_id not in songs],
+        "playlists": [playlists[playlist_id][1:] for playlist_id in playlist_ids if playlist_id in playlists],
+        "deleted_playlists": [playlist_id for playlist_id in playlist_ids if playlist_id not in playlists],
+    }
+
+
+def prune(conn: sqlite3.Connection, retain: int = RETAIN) -> int:
+    """Drop all but the newest ``retain`` change rows."""
+    cursor = conn.execute("DELETE FROM changes WHERE version <= ?", (current_version(conn) - retain,))
+    return cursor.rowcount
+
+
+class ChangeFeed:
+    """Tracks the library version and lets coroutines wait for it to move."""
+
+    def __init__(self, poll_interval: float = POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.version = 0
+        self.closing = False
+        self._event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="change-feed")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def close(self):
+        """Wake every waiter for good, so open streams end before the server waits for them to close."""
+        self.closing = True
+        self._event.set()
+
+    async def wait(self, since: int, timeout: float) -> bool:
+        """Wait until the version passes ``since``; False if ``timeout`` seconds went by or the feed closed first."""
+        while self.version <= since:
+            if self.closing:
+                return False
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def _publish(self, version: int):
+        self.version = version
+        # Wake everyone waiting on the old event; later waiters get a fresh one
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    async def _run(self):
+        polls = 0
+        while True:
+            try:
+                version = await db.read(current_version)
+                if version != self.version:
+                    self._publish(version)
+                polls += 1
+                if polls % PRUNE_EVERY == 0:
+                    pruned = await db.run(prune)
+                    if pruned:
+                        logger.debug("Pruned %s change log rows", pruned)
+            except Exception as e:
+                logger.error(f"Change feed poll failed: {e}")
+            await asyncio.sleep(self.poll_interval)
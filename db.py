@@ -0,0 +1,543 @@
+"""Shared SQLite data layer: pooled connections, pragmas and schema migrations.
+
+Route handlers should go through the async helpers at the bottom of this
+module so that queries run in the thread pool instead of on the event loop.
+"""
+import logging
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from metrics import DB_SECONDS
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = Path("songs.db")
+POOL_SIZE = 8
+BUSY_TIMEOUT_MS = 5000
+POSITION_GAP = 1024  # spacing between songs.position keys, so a move usually touches one row
+
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA foreign_keys = ON",
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+    "PRAGMA cache_size = -16000",  # 16 MiB page cache per connection
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 134217728",
+]
+
+# Plain lyric text out of the JSON list stored in songs.lyrics_text
+LYRICS_TEXT_SQL = ("CASE WHEN json_valid({col}) THEN "
+                   "(SELECT group_concat(json_extract(value, '$.text'), ' ') FROM json_each({col})) END")
+
+# Same, understanding both the legacy list and the compact {"t": [...], "l": [...]} object
+LYRICS_TEXT_SQL_V2 = ("CASE WHEN json_valid({col}) THEN CASE json_type({col}) "
+                      "WHEN 'object' THEN (SELECT group_concat(value, ' ') FROM json_each({col}, '$.l')) "
+                      "ELSE (SELECT group_concat(json_extract(value, '$.text'), ' ') FROM json_each({col})) END END")
+
+# Each entry upgrades the schema by one version; PRAGMA user_version records
+# how many have been applied. Never edit an entry once released, append instead.
+MIGRATIONS: List[List[str]] = [
+    # 1: original schema
+    [
+        '''CREATE TABLE IF NOT EXISTS songs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            artist TEXT,
+            filename TEXT NOT NULL UNIQUE,
+            playlist TEXT,
+            position INTEGER,
+            lyrics_text TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS playlists (
+            name TEXT,
+            image_path TEXT,
+            id INTEGER PRIMARY KEY AUTOINCREMENT
+        )''',
+    ],
+    # 2: unique playlist names, songs.playlist as a foreign key, ordering index
+    [
+        "DELETE FROM playlists WHERE name IS NULL OR id NOT IN (SELECT MIN(id) FROM playlists GROUP BY name)",
+        '''INSERT INTO playlists (name, image_path)
+           SELECT DISTINCT playlist, 'default.jpg' FROM songs
+           WHERE playlist IS NOT NULL AND playlist NOT IN (SELECT name FROM playlists)''',
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_playlists_name ON playlists(name)",
+        '''CREATE TABLE songs_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            artist TEXT,
+            filename TEXT NOT NULL UNIQUE,
+            playlist TEXT REFERENCES playlists(name) ON UPDATE CASCADE ON DELETE CASCADE,
+            position INTEGER,
+            lyrics_text TEXT
+        )''',
+        '''INSERT INTO songs_new (id, title, artist, filename, playlist, position, lyrics_text)
+           SELECT id, title, artist, filename, playlist, position, lyrics_text FROM songs''',
+        "DROP TABLE songs",
+        "ALTER TABLE songs_new RENAME TO songs",
+        "CREATE INDEX IF NOT EXISTS idx_songs_playlist_position ON songs(playlist, position)",
+    ],
+    # 3: file stats so the indexer can skip unchanged files
+    [
+        "ALTER TABLE songs ADD COLUMN mtime REAL",
+        "ALTER TABLE songs ADD COLUMN size INTEGER",
+    ],
+    # 4: full-text index over title, artist, playlist and lyric text, kept in
+    # sync by triggers so every writer (including FK cascades) is covered
+    [
+        '''CREATE VIRTUAL TABLE songs_fts USING fts5(
+            title, artist, playlist, lyrics,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3 4'
+        )''',
+        f'''INSERT INTO songs_fts (rowid, title, artist, playlist, lyrics)
+           SELECT id, title, artist, playlist, {LYRICS_TEXT_SQL.format(col="lyrics_text")} FROM songs''',
+        f'''CREATE TRIGGER songs_fts_insert AFTER INSERT ON songs BEGIN
+            INSERT INTO songs_fts (rowid, title, artist, playlist, lyrics)
+            VALUES (new.id, new.title, new.artist, new.playlist, {LYRICS_TEXT_SQL.format(col="new.lyrics_text")});
+        END''',
+        '''CREATE TRIGGER songs_fts_delete AFTER DELETE ON songs BEGIN
+            DELETE FROM songs_fts WHERE rowid = old.id;
+        END''',
+        f'''CREATE TRIGGER songs_fts_update AFTER UPDATE OF title, artist, playlist, lyrics_text ON songs BEGIN
+            DELETE FROM songs_fts WHERE rowid = old.id;
+            INSERT INTO songs_fts (rowid, title, artist, playlist, lyrics)
+            VALUES (new.id, new.title, new.artist, new.playlist, {LYRICS_TEXT_SQL.format(col="new.lyrics_text")});
+        END''',
+    ],
+    # 5: users and server-side sessions, replacing users.json
+    [
+        '''CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            password_hash TEXT NOT NULL,
+            email TEXT,
+            broj TEXT,
+            created_at REAL
+        )''',
+        '''CREATE TABLE sessions (
+            token TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID''',
+        "CREATE INDEX idx_sessions_expires_at ON sessions(expires_at)",
+    ],
+    # 6: compact lyrics ({"t": [ms, ...], "l": [text, ...]}); FTS triggers read both formats
+    [
+        "DROP TRIGGER songs_fts_insert",
+        "DROP TRIGGER songs_fts_update",
+        f'''CREATE TRIGGER songs_fts_insert AFTER INSERT ON songs BEGIN
+            INSERT INTO songs_fts (rowid, title, artist, playlist, lyrics)
+            VALUES (new.id, new.title, new.artist, new.playlist, {LYRICS_TEXT_SQL_V2.format(col="new.lyrics_text")});
+        END''',
+        f'''CREATE TRIGGER songs_fts_update AFTER UPDATE OF title, artist, playlist, lyrics_text ON songs BEGIN
+            DELETE FROM songs_fts WHERE rowid = old.id;
+            INSERT INTO songs_fts (rowid, title, artist, playlist, lyrics)
+            VALUES (new.id, new.title, new.artist, new.playlist, {LYRICS_TEXT_SQL_V2.format(col="new.lyrics_text")});
+        END''',
+        """UPDATE songs SET lyrics_text = json_object(
+               't', json((SELECT json_group_array(CAST(round(json_extract(value, '$.time') * 1000) AS INTEGER))
+                          FROM json_each(songs.lyrics_text))),
+               'l', json((SELECT json_group_array(json_extract(value, '$.text'))
+                          FROM json_each(songs.lyrics_text))))
+           WHERE json_valid(lyrics_text) AND json_type(lyrics_text) = 'array'""",
+    ],
+    # 7: append-only play history with per-song counters, and server-side queues
+    [
+        # No foreign key on song_id: history outlives the songs it mentions
+        '''CREATE TABLE play_events (
+            id INTEGER PRIMARY KEY,
+            song_id INTEGER NOT NULL,
+            user_id INTEGER,
+            event TEXT NOT NULL CHECK (event IN ('play', 'complete', 'skip')),
+            created_at REAL NOT NULL
+        )''',
+        '''CREATE TABLE song_stats (
+            song_id INTEGER PRIMARY KEY REFERENCES songs(id) ON DELETE CASCADE,
+            plays INTEGER NOT NULL DEFAULT 0,
+            completes INTEGER NOT NULL DEFAULT 0,
+            skips INTEGER NOT NULL DEFAULT 0,
+            last_played_at REAL
+        )''',
+        '''CREATE TRIGGER play_events_stats AFTER INSERT ON play_events
+           WHEN EXISTS (SELECT 1 FROM songs WHERE id = new.song_id) BEGIN
+            INSERT INTO song_stats (song_id, plays, completes, skips, last_played_at)
+            VALUES (new.song_id, new.event = 'play', new.event = 'complete', new.event = 'skip',
+                    CASE WHEN new.event = 'play' THEN new.created_at END)
+            ON CONFLICT (song_id) DO UPDATE SET
+                plays = plays + excluded.plays,
+                completes = completes + excluded.completes,
+                skips = skips + excluded.skips,
+                last_played_at = coalesce(excluded.last_played_at, last_played_at);
+        END''',
+        '''CREATE TABLE queues (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            cursor INTEGER NOT NULL DEFAULT 0,
+            length INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID''',
+        "CREATE INDEX idx_queues_updated_at ON queues(updated_at)",
+        '''CREATE TABLE queue_items (
+            queue_id TEXT NOT NULL REFERENCES queues(id) ON DELETE CASCADE,
+            idx INTEGER NOT NULL,
+            song_id INTEGER NOT NULL,
+            PRIMARY KEY (queue_id, idx)
+        ) WITHOUT ROWID''',
+    ],
+    # 8: spread positions POSITION_GAP apart within each playlist
+    [
+        f'''UPDATE songs SET position = ranked.rank * {POSITION_GAP}
+           FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY playlist ORDER BY position, id) - 1 AS rank
+                 FROM songs) AS ranked
+           WHERE songs.id = ranked.id''',
+    ],
+    # 9: thumbnail file names of each playlist's cover, as JSON {size: {format: name}}
+    [
+        "ALTER TABLE playlists ADD COLUMN thumbnails TEXT",
+    ],
+    # 10: tag metadata, with the mtime and size of the file it was read from
+    [
+        "ALTER TABLE songs ADD COLUMN album TEXT",
+        "ALTER TABLE songs ADD COLUMN duration REAL",
+        "ALTER TABLE songs ADD COLUMN bitrate INTEGER",
+        "ALTER TABLE songs ADD COLUMN tags_mtime REAL",
+        "ALTER TABLE songs ADD COLUMN tags_size INTEGER",
+    ],
+    # 11: waveform peaks, one byte per bucket; NULL peaks mark a file ffmpeg couldn't decode
+    [
+        '''CREATE TABLE song_peaks (
+            song_id INTEGER PRIMARY KEY REFERENCES songs(id) ON DELETE CASCADE,
+            mtime REAL,
+            size INTEGER,
+            peaks BLOB
+        )''',
+    ],
+    # 12: change log behind /changes; triggers record every write to songs and playlists
+    [
+        '''CREATE TABLE changes (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL CHECK (entity IN ('song', 'playlist')),
+            entity_id INTEGER NOT NULL,
+            op TEXT NOT NULL CHECK (op IN ('upsert', 'delete')),
+            created_at REAL NOT NULL DEFAULT ((julianday('now') - 2440587.5) * 86400.0)
+        )''',
+        '''CREATE TRIGGER changes_song_insert AFTER INSERT ON songs BEGIN
+            INSERT INTO changes (entity, entity_id, op) VALUES ('song', new.id, 'upsert');
+        END''',
+        # Only columns clients see; mtime, size and tag stamps alone don't count
+        '''CREATE TRIGGER changes_song_update AFTER UPDATE ON songs
+           WHEN old.title IS NOT new.title OR old.artist IS NOT new.artist OR old.playlist IS NOT new.playlist
+             OR old.position IS NOT new.position OR old.lyrics_text IS NOT new.lyrics_text
+             OR old.album IS NOT new.album OR old.duration IS NOT new.duration OR old.bitrate IS NOT new.bitrate
+           BEGIN
+            INSERT INTO changes (entity, entity_id, op) VALUES ('song', new.id, 'upsert');
+        END''',
+        '''CREATE TRIGGER changes_song_delete AFTER DELETE ON songs BEGIN
+            INSERT INTO changes (entity, entity_id, op) VALUES ('song', old.id, 'delete');
+        END''',
+        '''CREATE TRIGGER changes_playlist_insert AFTER INSERT ON playlists BEGIN
+            INSERT INTO changes (entity, entity_id, op) VALUES ('playlist', new.id, 'upsert');
+        END''',
+        '''CREATE TRIGGER changes_playlist_update AFTER UPDATE ON playlists
+           WHEN old.name IS NOT new.name OR old.image_path IS NOT new.image_path
+             OR old.thumbnails IS NOT new.thumbnails
+           BEGIN
+            INSERT INTO changes (entity, entity_id, op) VALUES ('playlist', new.id, 'upsert');
+        END''',
+        '''CREATE TRIGGER changes_playlist_delete AFTER DELETE ON playlists BEGIN
+            INSERT INTO changes (entity, entity_id, op) VALUES ('playlist', old.id, 'delete');
+        END''',
+    ],
+    # 13: state shared by server worker processes (see workers.py): leases, job
+    # records, and epochs that triggers bump when other workers' caches go stale
+    [
+        '''CREATE TABLE leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            requested_at REAL,
+            status TEXT
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE jobs (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID''',
+        "CREATE INDEX idx_jobs_updated_at ON jobs(updated_at)",
+        '''CREATE TABLE epochs (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID''',
+        "INSERT INTO epochs (name) VALUES ('sessions'), ('songs')",
+        # Expired sessions are pruned on every login; only revoking a live one counts
+        '''CREATE TRIGGER epochs_session_delete AFTER DELETE ON sessions
+           WHEN old.expires_at > (julianday('now') - 2440587.5) * 86400.0
+           BEGIN
+            UPDATE epochs SET value = value + 1 WHERE name = 'sessions';
+        END''',
+        # Song paths and lyrics are cached per worker
+        '''CREATE TRIGGER epochs_song_update AFTER UPDATE OF filename, lyrics_text ON songs BEGIN
+            UPDATE epochs SET value = value + 1 WHERE name = 'songs';
+        END''',
+        '''CREATE TRIGGER epochs_song_delete AFTER DELETE ON songs BEGIN
+            UPDATE epochs SET value = value + 1 WHERE name = 'songs';
+        END''',
+    ],
+    # 14: a file replaced in place changes only mtime and size, and cached paths carry both
+    [
+        "DROP TRIGGER epochs_song_update",
+        '''CREATE TRIGGER epochs_song_update AFTER UPDATE OF filename, lyrics_text, mtime, size ON songs
+           WHEN old.filename IS NOT new.filename OR old.lyrics_text IS NOT new.lyrics_text
+             OR old.mtime IS NOT new.mtime OR old.size IS NOT new.size
+           BEGIN
+            UPDATE epochs SET value = value + 1 WHERE name = 'songs';
+        END''',
+    ],
+]
+
+
+def connect(path: Path = DB_PATH) -> sqlite3.Connection:
+    """Open a connection with the standard pragmas applied."""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Apply any pending MIGRATIONS and return the resulting schema version."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return version
+    # Table rebuilds must not trip foreign key checks half way through
+    conn.execute("PRAGMA foreign_keys = OFF")
+    try:
+        while True:
+            with conn:
+                # Re-read the version under the write lock, so workers starting
+                # together don't apply the same migration twice
+                conn.execute("BEGIN IMMEDIATE")
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    break
+                for statement in MIGRATIONS[version]:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version + 1}")
+            version += 1
+            logger.info(f"Migrated database schema to version {version}")
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON")
+    return version
+
+
+class ConnectionPool:
+    """A fixed-size pool of SQLite connections shared across threads.
+
+    Connections are created lazily up to ``size``; callers beyond that block
+    until one is returned.
+    """
+
+    def __init__(self, path: Path = DB_PATH, size: int = POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return connect(self.path)
+        return self._idle.get()
+
+    def release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self):
+        with self._lock:
+            while True:
+                try:
+                    self._idle.get_nowait().close()
+                except queue.Empty:
+                    break
+            self._created = 0
+
+
+pool: Optional[ConnectionPool] = None
+
+
+def init_db(path: Path = DB_PATH, size: int = POOL_SIZE) -> ConnectionPool:
+    """Migrate the database at ``path`` and install the shared pool."""
+    global pool
+    conn = connect(path)
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
+    if pool is not None:
+        pool.close()
+    pool = ConnectionPool(path, size)
+    logger.debug("Database initialized")
+    return pool
+
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection without opening a transaction."""
+    if pool is None:
+        raise RuntimeError("Database not initialized, call db.init_db() first")
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+@contextmanager
+def transaction():
+    """Borrow a pooled connection and commit on success, roll back on error.
+
+    The write lock is taken up front (BEGIN IMMEDIATE) so read-then-write
+    sequences from concurrent workers serialize instead of failing with
+    SQLITE_BUSY half way through.
+    """
+    with connection() as conn:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+
+
+# Library writes shared by route handlers and background workers.
+
+def insert_song(conn: sqlite3.Connection, title: str, artist: str, filename: str, playlist: str,
+                default_image: str = "default.jpg") -> int:
+    """Append a song to the end of ``playlist``, creating the playlist row if needed."""
+    # songs.playlist references playlists(name), so make sure the row exists
+    conn.execute("INSERT OR IGNORE INTO playlists (name, image_path) VALUES (?, ?)", (playlist, default_image))
+    cursor = conn.execute("INSERT INTO songs (title, artist, filename, playlist, position) VALUES (?, ?, ?, ?, ?)",
+                          (title, artist, filename, playlist, next_position(conn, playlist)))
+    return cursor.lastrowid
+
+
+def next_position(conn: sqlite3.Connection, playlist: str) -> int:
+    """Position key for a song appended to ``playlist``.
+
+    MAX over idx_songs_playlist_position is a single index seek, not a scan.
+    """
+    max_position = conn.execute("SELECT MAX(position) FROM songs WHERE playlist = ?", (playlist,)).fetchone()[0]
+    return 0 if max_position is None else max_position + POSITION_GAP
+
+
+def compact_playlist(conn: sqlite3.Connection, playlist: str) -> int:
+    """Renumber ``playlist`` to evenly spaced positions; returns the number of songs."""
+    ids = [row[0] for row in conn.execute("SELECT id FROM songs WHERE playlist = ? ORDER BY position, id",
+                                          (playlist,))]
+    conn.executemany("UPDATE songs SET position = ? WHERE id = ?",
+                     [(index * POSITION_GAP, song_id) for index, song_id in enumerate(ids)])
+    logger.debug("Compacted positions of playlist %s (%s songs)", playlist, len(ids))
+    return len(ids)
+
+
+def move_song(conn: sqlite3.Connection, song_id: int, after_id: Optional[int] = None) -> Tuple[int, bool]:
+    """Move ``song_id`` right after ``after_id`` in its playlist, or to the front if None.
+
+    Only the moved row is written unless its neighbours have no gap left,
+    in which case the playlist is compacted first. Returns (new position,
+    whether the playlist was compacted). Raises LookupError for unknown
+    songs or an ``after_id`` in another playlist.
+    """
+    row = conn.execute("SELECT playlist FROM songs WHERE id = ?", (song_id,)).fetchone()
+    if not row:
+        raise LookupError(f"Song {song_id} not found")
+    playlist = row[0]
+    compacted = False
+    while True:
+        if after_id is None:
+            before = None
+            first = conn.execute("SELECT position, id FROM songs WHERE playlist = ? AND id != ? "
+                                 "ORDER BY position, id LIMIT 1", (playlist, song_id)).fetchone()
+        else:
+            before = conn.execute("SELECT position FROM songs WHERE id = ? AND playlist = ?",
+                                  (after_id, playlist)).fetchone()
+            if not before:
+                raise LookupError(f"Song {after_id} not found in playlist {playlist}")
+            first = conn.execute("SELECT position, id FROM songs WHERE playlist = ? AND id != ? "
+                                 "AND (position, id) > (?, ?) ORDER BY position, id LIMIT 1",
+                                 (playlist, song_id, before[0], after_id)).fetchone()
+        if first is None:  # moving to the end (or into an otherwise empty playlist)
+            position = 0 if before is None else before[0] + POSITION_GAP
+            break
+        if before is None:
+            position = first[0] - POSITION_GAP
+            break
+        if first[0] - before[0] > 1:
+            position = (before[0] + first[0]) // 2
+            break
+        if compacted:
+            raise RuntimeError(f"No room to move song {song_id} after compacting {playlist}")
+        compact_playlist(conn, playlist)
+        compacted = True
+    conn.execute("UPDATE songs SET position = ? WHERE id = ?", (position, song_id))
+    return position, compacted
+
+
+# Async helpers: run the work in the thread pool so the event loop stays free.
+
+async def fetchone(sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+    def _fetchone():
+        with DB_SECONDS.time(op="fetchone"), connection() as conn:
+            return conn.execute(sql, params).fetchone()
+    return await run_in_threadpool(_fetchone)
+
+
+async def fetchall(sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+    def _fetchall():
+        with DB_SECONDS.time(op="fetchall"), connection() as conn:
+            return conn.execute(sql, params).fetchall()
+    return await run_in_threadpool(_fetchall)
+
+
+async def execute(sql: str, params: Sequence[Any] = ()) -> sqlite3.Cursor:
+    def _execute():
+        with DB_SECONDS.time(op="execute"), transaction() as conn:
+            return conn.execute(sql, params)
+    return await run_in_threadpool(_execute)
+
+
+async def executemany(sql: str, seq_of_params: Iterable[Sequence[Any]]) -> int:
+    def _executemany():
+        with DB_SECONDS.time(op="executemany"), transaction() as conn:
+            return conn.executemany(sql, seq_of_params).rowcount
+    return await run_in_threadpool(_executemany)
+
+
+async def run(fn: Callable[..., Any], *args: Any) -> Any:
+    """Call ``fn(conn, *args)`` inside a single transaction, off the event loop."""
+    def _run():
+        with DB_SECONDS.time(op=f"run:{getattr(fn, '__name__', 'fn')}"), transaction() as conn:
+            return fn(conn, *args)
+    return await run_in_threadpool(_run)
+
+
+async def read(fn: Callable[..., Any], *args: Any) -> Any:
+    """Call ``fn(conn, *args)`` for read-only work, without taking the write lock."""
+    def _read():
+        with DB_SECONDS.time(op=f"read:{getattr(fn, '__name__', 'fn')}"), connection() as conn:
+            return fn(conn, *args)
+    return await run_in_threadpool(_read)
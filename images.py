@@ -0,0 +1,334 @@
+"""Playlist cover images: bounded uploads, content-hashed originals and thumbnails.
+
+Uploads are parsed straight off the request stream and written to disk as
+they arrive, so a request announcing more than MAX_UPLOAD_BYTES (plus
+FORM_OVERHEAD for the rest of the form) is refused before its body is read,
+and one that turns out larger is cut off as soon as it passes the limit.
+
+The stored original and its thumbnails are named after a hash of the
+uploaded bytes, so a URL always refers to the same content and
+ImmutableStaticFiles can let browsers cache it forever. Thumbnails are
+square JPEG and WebP crops at THUMBNAIL_SIZES, rendered in a process pool
+because decoding, resizing and encoding are CPU-bound.
+
+Pillow is optional: without it uploads are stored as-is, no thumbnails are
+made and clients fall back to the original.
+"""
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+from python_multipart import MultipartParser
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import parse_options_header
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+
+from streaming import CachedStaticFiles
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - depends on the install
+    Image = ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+MAX_UPLOAD_BYTES = 10 * 1024 ** 2
+FORM_OVERHEAD = 64 * 1024  # boundaries, part headers and the other fields around the image
+MAX_FIELD_BYTES = 1024  # any form field other than the image
+MAX_PIXELS = 40_000_000  # larger images are refused rather than decoded
+THUMBNAIL_SIZES = (128, 256, 512)  # square edge in pixels
+MAX_WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Pillow format -> extension of the stored original; anything else is refused
+ORIGINAL_FORMATS = {"JPEG": "jpg", "PNG": "png", "GIF": "gif", "WEBP": "webp"}
+# Used to validate uploads by name when Pillow is not installed
+EXTENSIONS = {"jpg", "jpeg", "png", "gif", "webp"}
+# Thumbnail format -> (extension, Pillow save options)
+THUMBNAIL_FORMATS = {
+    "jpeg": ("jpg", {"format": "JPEG", "quality": 85, "optimize": True, "progressive": True}),
+    "webp": ("webp", {"format": "WEBP", "quality": 80, "method": 4}),
+}
+
+_HASHED_NAME = re.compile(r"^[0-9a-f]{16}(-\d+)?\.[a-z]+$")
+
+Thumbnails = Dict[str, Dict[str, str]]  # size -> format -> file name
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+class InvalidImage(Exception):
+    pass
+
+
+@dataclass
+class Upload:
+    """A received form: the image part is in the file at ``path``, the other fields in ``fields``."""
+    path: Path
+    filename: str
+    digest: str  # sha256 hex of the image bytes
+    fields: Dict[str, str]
+
+
+class _FormReader:
+    """Callbacks for python-multipart's streaming parser that enforce the per-part caps.
+
+    Bytes of part ``file_field`` are hashed and left in ``pending`` for the
+    caller to write out; every other part is kept as a short text field.
+    """
+
+    def __init__(self, file_field: str, max_bytes: int):
+        self.file_field = file_field
+        self.max_bytes = max_bytes
+        self.fields: Dict[str, str] = {}
+        self.filename: Optional[str] = None
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self.pending: List[bytes] = []
+        self._headers: Dict[bytes, bytes] = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._name = ""
+        self._value = bytearray()
+        self._is_file = False
+
+    def callbacks(self) -> dict:
+        return {
+            "on_part_begin": self.on_part_begin, "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value, "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished, "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        }
+
+    def on_part_begin(self):
+        self._headers = {}
+        self._value = bytearray()
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._name = options.get(b"name", b"").decode("utf-8", "replace")
+        self._is_file = self._name == self.file_field
+        if self._is_file:
+            if self.filename is not None:
+                raise InvalidImage("Expected a single image")
+            self.filename = options.get(b"filename", b"").decode("utf-8", "replace")
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        chunk = data[start:end]
+        if not self._is_file:
+            self._value += chunk
+            if len(self._value) > MAX_FIELD_BYTES:
+                raise ImageTooLarge(f"Form field {self._name} is larger than {MAX_FIELD_BYTES} bytes")
+            return
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise ImageTooLarge(f"Image is larger than {self.max_bytes / 1024 ** 2:g} MB")
+        self.digest.update(chunk)
+        self.pending.append(chunk)
+
+    def on_part_end(self):
+        if not self._is_file:
+            self.fields[self._name] = self._value.decode("utf-8", "replace")
+
+
+async def receive_form(chunks: AsyncIterator[bytes], content_type: str, file_field: str, target: Path,
+                       max_bytes: int) -> Upload:
+    """Parse a multipart/form-data body from ``chunks``, writing part ``file_field`` to ``target``.
+
+    Raises ImageTooLarge as soon as the image passes ``max_bytes``, another
+    field passes MAX_FIELD_BYTES or the body passes both plus FORM_OVERHEAD,
+    and InvalidImage if the body is not a form carrying a non-empty image.
+    """
+    kind, options = parse_options_header(content_type)
+    if kind != b"multipart/form-data" or not options.get(b"boundary"):
+        raise InvalidImage("Expected a multipart/form-data upload")
+    reader = _FormReader(file_field, max_bytes)
+    parser = MultipartParser(options[b"boundary"], reader.callbacks())
+    max_body = max_bytes + FORM_OVERHEAD
+    received = 0
+    f = await run_in_threadpool(open, target, "wb")
+    try:
+        async for chunk in chunks:
+            received += len(chunk)
+            if received > max_body:
+                raise ImageTooLarge(f"Upload is larger than {max_body / 1024 ** 2:g} MB")
+            parser.write(chunk)
+            if reader.pending:
+                data = b"".join(reader.pending)
+                reader.pending.clear()
+                await run_in_threadpool(f.write, data)
+        parser.finalize()
+    except MultipartParseError as e:
+        raise InvalidImage(f"Malformed upload: {e}")
+    finally:
+        await run_in_threadpool(f.close)
+    if reader.filename is None:
+        raise InvalidImage("No image in the upload")
+    if not reader.size:
+        raise InvalidImage("Image is empty")
+    return Upload(target, reader.filename, reader.digest.hexdigest(), reader.fields)
+
+
+def _save(image, path: Path, options: dict):
+    # Write next to the target and rename, so a cached URL never sees a partial file
+    tmp = path.with_name(path.name + ".part")
+    image.save(tmp, **options)
+    os.replace(tmp, path)
+
+
+def render(source: str, directory: str, stem: str, sizes: Sequence[int]) -> Tuple[str, Thumbnails]:
+    """Validate ``source`` and write its thumbnails; runs in a worker process.
+
+    Sizes larger than the image's short edge are skipped (but the smallest
+    is always made). Returns the extension for the original and the
+    thumbnail names by size and format.
+    """
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    try:
+        with Image.open(source) as image:
+            extension = ORIGINAL_FORMATS.get(image.format)
+            if extension is None:
+                raise InvalidImage(f"Unsupported image format {image.format}")
+            if image.width * image.height > MAX_PIXELS:
+                raise ImageTooLarge(f"Image has more than {MAX_PIXELS} pixels")
+            image = ImageOps.exif_transpose(image)
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    except Image.DecompressionBombError:
+        raise ImageTooLarge(f"Image has more than {MAX_PIXELS} pixels")
+    except (OSError, SyntaxError, ValueError):
+        raise InvalidImage("Not a readable image")
+
+    short_edge = min(image.size)
+    wanted = [size for size in sorted(sizes) if size <= short_edge] or sorted(sizes)[:1]
+    thumbnails: Thumbnails = {}
+    for size in wanted:
+        square = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        names = thumbnails[str(size)] = {}
+        for name, (ext, options) in THUMBNAIL_FORMATS.items():
+            frame = square.convert("RGB") if options["format"] == "JPEG" else square
+            filename = f"{stem}-{size}.{ext}"
+            _save(frame, Path(directory) / filename, options)
+            names[name] = filename
+    return extension, thumbnails
+
+
+class ImageStore:
+    """Stores uploaded covers and their thumbnails under ``directory``."""
+
+    def __init__(self, directory: Path, max_bytes: int = MAX_UPLOAD_BYTES,
+                 sizes: Sequence[int] = THUMBNAIL_SIZES, max_workers: int = MAX_WORKERS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.sizes = tuple(sizes)
+        self.max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        if Image is None:
+            logger.warning("Pillow not installed, playlist image thumbnails are disabled")
+
+    @property
+    def available(self) -> bool:
+        return Image is not None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # Started on first upload so importing the app doesn't spawn processes
+        if self._executor is None:
+            # Spawned, not forked: a fork of the threaded server can inherit a held lock and hang
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    @asynccontextmanager
+    async def receive(self, chunks: AsyncIterator[bytes], content_type: str, content_length: Optional[str] = None,
+                      file_field: str = "image") -> AsyncIterator[Upload]:
+        """Stream a form upload into a temporary file and yield it as an Upload.
+
+        Raises ImageTooLarge without reading the body when ``content_length``
+        already exceeds the limit; see receive_form for the rest. The
+        temporary file is removed on exit unless ``store`` took it.
+        """
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes + FORM_OVERHEAD:
+            raise ImageTooLarge(f"Image is larger than {self.max_bytes / 1024 ** 2:g} MB")
+        tmp = self.directory / f".upload-{uuid.uuid4().hex}.part"
+        try:
+            yield await receive_form(chunks, content_type, file_field, tmp, self.max_bytes)
+        finally:
+            await run_in_threadpool(tmp.unlink, missing_ok=True)
+
+    async def store(self, upload: Upload) -> Tuple[str, Thumbnails]:
+        """Save a received upload; returns (original's file name, thumbnails).
+
+        Raises ImageTooLarge or InvalidImage. Uploading the same bytes
+        again yields the same names.
+        """
+        stem = upload.digest[:16]
+        if self.available:
+            extension, thumbnails = await asyncio.get_running_loop().run_in_executor(
+                self._pool(), render, str(upload.path), str(self.directory), stem, self.sizes)
+        else:
+            filename = upload.filename
+            extension = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+            if extension not in EXTENSIONS:
+                raise InvalidImage(f"Unsupported image type .{extension}")
+            thumbnails = {}
+        name = f"{stem}.{extension}"
+        await run_in_threadpool(os.replace, upload.path, self.directory / name)
+        logger.debug("Stored image %s with %s thumbnail sizes", name, len(thumbnails))
+        return name, thumbnails
+
+    def remove(self, name: str, thumbnails: Optional[Thumbnails] = None):
+        """Delete an original and its thumbnails; blocking."""
+        names = [name] + [filename for formats in (thumbnails or {}).values() for filename in formats.values()]
+        for filename in names:
+            try:
+                os.remove(self.directory / filename)
+            except FileNotFoundError:
+                pass
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def thumbnail_urls(thumbnails: Optional[Thumbnails], prefix: str = "/images") -> Dict[str, Dict[str, str]]:
+    return {size: {fmt: f"{prefix}/{filename}" for fmt, filename in formats.items()}
+            for size, formats in (thumbnails or {}).items()}
+
+
+class ImmutableStaticFiles(CachedStaticFiles):
+    """Serves content-hashed names with a year-long immutable Cache-Control.
+
+    Other files (the default cover, images uploaded before hashing) are
+    revalidated on every use, which costs a 304 at most.
+    """
+
+    def __init__(self, *args, cache_control: str = "no-cache", **kwargs):
+        super().__init__(*args, cache_control=cache_control, **kwargs)
+
+    def file_response(self, full_path, *args, **kwargs) -> Response:
+        response = super().file_response(full_path, *args, **kwargs)
+        if _HASHED_NAME.match(os.path.basename(full_path)):
+            response.headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+        return response
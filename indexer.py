@@ -0,0 +1,269 @@
+"""Incremental library indexer.
+
+Walks MUSIC_DIR, compares each mp3's mtime and size with what is stored in
+``songs`` and only writes the difference: new files are inserted, changed
+files are refreshed, renamed files keep their row (and lyrics), and rows
+whose files have vanished are deleted. All writes happen in one transaction.
+
+Tags, duration and bitrate are then read (see tags.py) for every song whose
+file changed since they were last read, outside that transaction, and
+stored in batches.
+"""
+import logging
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import db
+import tags
+from metrics import FILE_IO_SECONDS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IMAGE = "default.jpg"
+TAG_BATCH = 500  # songs whose tags are stored per transaction
+
+
+@dataclass
+class IndexProgress:
+    state: str = "idle"  # idle, running, done or failed
+    playlists: int = 0
+    scanned: int = 0
+    added: int = 0
+    updated: int = 0
+    renamed: int = 0
+    removed: int = 0
+    tagged: int = 0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class ScannedFile:
+    filename: str  # "<playlist>/<file name>", as stored in songs.filename
+    playlist: str
+    name: str
+    mtime: float
+    size: int
+
+
+def guess_title_artist(name: str) -> Tuple[str, str]:
+    """Split "Title - Artist.mp3" into its parts, as the indexer always has."""
+    stem = name.replace(".mp3", "")
+    parts = name.split(" - ")
+    title = stem.split(" - ")[0] if " - " in name else stem
+    artist = parts[1].replace(".mp3", "") if " - " in name and len(parts) > 1 else "Unknown"
+    return title, artist
+
+
+def scan_library(music_dir: Path, progress: Optional[IndexProgress] = None) -> Tuple[List[str], List[ScannedFile]]:
+    """Return the playlist directory names and every mp3 below them."""
+    playlists, files = [], []
+    with os.scandir(music_dir) as playlist_entries:
+        for playlist_entry in playlist_entries:
+            if not playlist_entry.is_dir():
+                continue
+            playlists.append(playlist_entry.name)
+            with os.scandir(playlist_entry.path) as song_entries:
+                for entry in song_entries:
+                    if not entry.name.endswith(".mp3") or not entry.is_file():
+                        continue
+                    st = entry.stat()
+                    files.append(ScannedFile(f"{playlist_entry.name}/{entry.name}", playlist_entry.name,
+                                             entry.name, st.st_mtime, st.st_size))
+            if progress is not None:
+                progress.playlists = len(playlists)
+                progress.scanned = len(files)
+    return playlists, files
+
+
+def apply_changes(conn, playlists: List[str], files: List[ScannedFile], progress: IndexProgress):
+    """Diff the scanned files against ``songs`` and write the changes using ``conn``."""
+    existing: Dict[str, Tuple[int, Optional[float], Optional[int], str]] = {
+        row[1]: (row[0], row[2], row[3], row[4])
+        for row in conn.execute("SELECT id, filename, mtime, size, playlist FROM songs")
+    }
+    scanned = {f.filename: f for f in files}
+
+    new_files = [f for f in files if f.filename not in existing]
+    changed = [f for f in files if f.filename in existing
+               and (existing[f.filename][1], existing[f.filename][2]) != (f.mtime, f.size)]
+    vanished = {filename: row for filename, row in existing.items() if filename not in scanned}
+    if existing and not files:
+        # Most likely an unmounted or misconfigured MUSIC_DIR; don't wipe the library
+        logger.warning(f"No mp3 files found but {len(existing)} songs are indexed, skipping removals")
+        vanished = {}
+
+    # A vanished row and a new file in the same playlist with identical mtime and
+    # size is a rename; update the row in place so its id and lyrics survive.
+    vanished_by_stat: Dict[Tuple[str, float, int], List[str]] = {}
+    for filename, (_, mtime, size, playlist) in vanished.items():
+        vanished_by_stat.setdefault((playlist, mtime, size), []).append(filename)
+    renames, inserts = [], []
+    for f in new_files:
+        candidates = vanished_by_stat.get((f.playlist, f.mtime, f.size))
+        if candidates and len(candidates) == 1:
+            old_filename = candidates.pop()
+            title, artist = guess_title_artist(f.name)
+            renames.append((f.filename, title, artist, vanished.pop(old_filename)[0]))
+        else:
+            inserts.append(f)
+
+    conn.executemany("INSERT OR IGNORE INTO playlists (name, image_path) VALUES (?, ?)",
+                     [(name, DEFAULT_IMAGE) for name in playlists])
+
+    # New files go after the current end of their playlist, in name order
+    next_position = {name: db.next_position(conn, name) for name in {f.playlist for f in inserts}}
+    rows = []
+    for f in sorted(inserts, key=lambda f: (f.playlist, f.name)):
+        position = next_position[f.playlist]
+        next_position[f.playlist] = position + db.POSITION_GAP
+        title, artist = guess_title_artist(f.name)
+        rows.append((title, artist, f.filename, f.playlist, position, f.mtime, f.size))
+    conn.executemany("INSERT OR IGNORE INTO songs (title, artist, filename, playlist, position, mtime, size) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    # Renaming resets title and artist to the name's guess, so have the tags read again
+    conn.executemany("UPDATE songs SET filename = ?, title = ?, artist = ?, tags_mtime = NULL WHERE id = ?", renames)
+    conn.executemany("UPDATE songs SET mtime = ?, size = ? WHERE filename = ?",
+                     [(f.mtime, f.size, f.filename) for f in changed])
+    conn.executemany("DELETE FROM songs WHERE id = ?", [(row[0],) for row in vanished.values()])
+
+    progress.added = len(rows)
+    progress.updated = len(changed)
+    progress.renamed = len(renames)
+    progress.removed = len(vanished)
+
+
+def pending_tags(conn) -> List[Tuple[int, str, float, int]]:
+    """(id, filename, mtime, size) of songs whose tags were never read at their current mtime and size."""
+    return conn.execute("SELECT id, filename, mtime, size FROM songs "
+                        "WHERE tags_mtime IS NOT mtime OR tags_size IS NOT size").fetchall()
+
+
+def store_tags(conn, batch: List[Tuple[Tuple[int, str, float, int], Optional[tags.Tags]]]):
+    """Write read tags; files that couldn't be parsed are stamped too so they aren't retried.
+
+    A missing title or artist tag keeps the stored one: the indexer's guess
+    from the file name, or the metadata a download was added with.
+    """
+    rows = []
+    for (song_id, filename, mtime, size), found in batch:
+        found = found or tags.Tags()
+        rows.append((found.title, found.artist, found.album, found.duration, found.bitrate,
+                     mtime, size, song_id, mtime, size))
+    # Skip rows the file changed under since they were read; the next run picks them up
+    conn.executemany("UPDATE songs SET title = COALESCE(?, title), artist = COALESCE(?, artist), album = ?, "
+                     "duration = ?, bitrate = ?, tags_mtime = ?, tags_size = ? "
+                     "WHERE id = ? AND mtime = ? AND size = ?", rows)
+
+
+def read_library_tags(music_dir: Path, progress: IndexProgress):
+    """Read and store tags for every song pending_tags returns."""
+    with db.connection() as conn:
+        pending = pending_tags(conn)
+    if not pending:
+        return
+    results = tags.read_many([str(music_dir / filename) for _, filename, _, _ in pending])
+    batch = []
+    with FILE_IO_SECONDS.time(op="read_tags"):
+        for row, found in zip(pending, results):
+            batch.append((row, found))
+            if len(batch) >= TAG_BATCH:
+                with db.transaction() as conn:
+                    store_tags(conn, batch)
+                progress.tagged += len(batch)
+                batch = []
+        if batch:
+            with db.transaction() as conn:
+                store_tags(conn, batch)
+            progress.tagged += len(batch)
+
+
+def index_library(music_dir: Path, progress: Optional[IndexProgress] = None) -> IndexProgress:
+    """Bring ``songs`` in line with the files under ``music_dir``."""
+    progress = progress or IndexProgress()
+    progress.state = "running"
+    progress.started_at = time.time()
+    progress.finished_at = None
+    progress.error = None
+    try:
+        if not music_dir.exists():
+            music_dir.mkdir(parents=True)
+            logger.debug("Created music directory %s", music_dir)
+        with FILE_IO_SECONDS.time(op="scan_library"):
+            playlists, files = scan_library(music_dir, progress)
+        with db.transaction() as conn:
+            apply_changes(conn, playlists, files, progress)
+        if tags.available():
+            read_library_tags(music_dir, progress)
+        progress.state = "done"
+    except Exception as e:
+        progress.state = "failed"
+        progress.error = str(e)
+        logger.error(f"Indexing {music_dir} failed: {e}")
+        raise
+    finally:
+        progress.finished_at = time.time()
+    logger.info(f"Indexed {progress.scanned} files in {progress.finished_at - progress.started_at:.2f}s: "
+                f"{progress.added} added, {progress.updated} updated, {progress.renamed} renamed, "
+                f"{progress.removed} removed, {progress.tagged} tagged")
+    return progress
+
+
+class Indexer:
+    """Runs index_library in a background thread, one run at a time."""
+
+    def __init__(self, music_dir: Path, on_change: Optional[Callable[[IndexProgress], None]] = None):
+        self.music_dir = music_dir
+        self.on_change = on_change
+        self.progress = IndexProgress()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        if not tags.available():
+            logger.warning("mutagen not installed, song tags and durations are not read")
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> bool:
+        """Start a background run; returns False if one is already in progress."""
+        with self._lock:
+            if self.running:
+                return False
+            self.progress = IndexProgress(state="running")
+            self._thread = threading.Thread(target=self._run, name="library-indexer", daemon=True)
+            self._thread.start()
+            return True
+
+    def run(self) -> IndexProgress:
+        """Index synchronously in the calling thread, after any background run."""
+        with self._lock:
+            self.wait()
+            self.progress = IndexProgress()
+            index_library(self.music_dir, self.progress)
+            self._notify()
+            return self.progress
+
+    def wait(self, timeout: Optional[float] = None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            index_library(self.music_dir, self.progress)
+        except Exception:
+            return  # already logged and recorded on self.progress
+        self._notify()
+
+    def _notify(self):
+        p = self.progress
+        if self.on_change is not None and (p.added or p.updated or p.renamed or p.removed or p.tagged):
+            self.on_change(p)
@@ -0,0 +1,187 @@
+"""Background job subsystem.
+
+Long-running work such as downloads is submitted to a JobManager, which runs
+it on a bounded thread pool and keeps a Job record that clients poll through
+/jobs/{id}. Workers report progress by updating their Job.
+
+Records are also written to the ``jobs`` table, so a server worker process
+can answer a poll for a job another worker is running.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+import db
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 3
+MAX_FINISHED_JOBS = 1000
+STORE_INTERVAL = 1.0  # seconds between progress writes of a running job
+STORED_RETENTION = 86400  # seconds a finished job stays in the jobs table
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    description: str
+    status: str = QUEUED
+    progress: Dict[str, Any] = field(default_factory=dict)
+    result: Any = None
+    error: Optional[str] = None
+    children: List[str] = field(default_factory=list)
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    listener: Optional[Callable[["Job"], None]] = field(default=None, repr=False, compare=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def update(self, **progress):
+        self.progress.update(progress)
+        if self.listener is not None:
+            self.listener(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "description": self.description,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "result": self.result,
+            "error": self.error,
+            "children": list(self.children),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+def _fold_children(data: dict, children: List[dict]) -> dict:
+    """Replace the child ids in a Job.to_dict() with the state of those children."""
+    child_ids = data.pop("children")
+    if child_ids:
+        counts = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)}
+        for child in children:
+            counts[child["status"]] += 1
+        data["children"] = [{"id": child["id"], "description": child["description"], "status": child["status"]}
+                            for child in children]
+        data["progress"].update(total=len(child_ids), **counts)
+        if data["status"] == DONE and counts[DONE] + counts[FAILED] < len(children):
+            data["status"] = RUNNING
+    return data
+
+
+class JobManager:
+    """Runs jobs on a bounded thread pool and keeps their status for polling.
+
+    Threads rather than processes are used because the work is dominated by
+    network I/O and ffmpeg subprocesses, and progress hooks need to write to
+    the shared Job records.
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS, max_finished: int = MAX_FINISHED_JOBS, store: bool = True):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        # One writer keeps a job's stored records in order and submit() off the database
+        self._store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store") if store else None
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._stored_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.max_finished = max_finished
+
+    def submit(self, kind: str, description: str, fn: Callable[..., Any], *args: Any) -> Job:
+        """Queue ``fn(job, *args)``; its return value becomes ``job.result``."""
+        job = Job(id=uuid.uuid4().hex, kind=kind, description=description, listener=self._progressed)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        self._store(job)
+        self._executor.submit(self._run, job, fn, args)
+        logger.debug("Queued %s job %s: %s", kind, job.id, description)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def queue_depth(self) -> int:
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.status == QUEUED)
+
+    def describe(self, job: Job) -> dict:
+        """Serialize a job, folding in the state of any child jobs."""
+        children = [self._jobs[child_id].to_dict() for child_id in job.children if child_id in self._jobs]
+        return _fold_children(job.to_dict(), children)
+
+    def describe_stored(self, job_id: str) -> Optional[dict]:
+        """describe() from the jobs table, for jobs submitted to another process; blocking."""
+        with db.connection() as conn:
+            row = conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            data = json.loads(row[0])
+            rows = conn.execute("SELECT data FROM jobs WHERE id IN (SELECT value FROM json_each(?))",
+                                (json.dumps(data["children"]),)).fetchall() if data["children"] else []
+        by_id = {child["id"]: child for child in map(json.loads, (r[0] for r in rows))}
+        return _fold_children(data, [by_id[child_id] for child_id in data["children"] if child_id in by_id])
+
+    def shutdown(self, wait: bool = False):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+        if self._store_executor is not None:
+            self._store_executor.shutdown(wait=wait)
+
+    def _store(self, job: Job):
+        if self._store_executor is None:
+            return
+        self._stored_at[job.id] = time.time()
+        # Serialized now, so the record is the state at this point
+        self._store_executor.submit(self._write, job.id, json.dumps(job.to_dict(), default=str), job.finished)
+
+    def _progressed(self, job: Job):
+        if time.time() - self._stored_at.get(job.id, 0.0) >= STORE_INTERVAL:
+            self._store(job)
+
+    def _write(self, job_id: str, data: str, finished: bool):
+        now = time.time()
+        try:
+            with db.transaction() as conn:
+                conn.execute("""INSERT INTO jobs (id, data, updated_at) VALUES (?, ?, ?)
+                                ON CONFLICT (id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at""",
+                             (job_id, data, now))
+                if finished:
+                    conn.execute("DELETE FROM jobs WHERE updated_at < ?", (now - STORED_RETENTION,))
+        except Exception as e:
+            logger.error(f"Storing job {job_id} failed: {e}")
+
+    def _run(self, job: Job, fn: Callable[..., Any], args: tuple):
+        job.status = RUNNING
+        job.started_at = time.time()
+        self._store(job)
+        try:
+            job.result = fn(job, *args)
+            job.status = DONE
+            logger.debug("Job %s finished", job.id)
+        except Exception as e:
+            job.error = str(e)
+            job.status = FAILED
+            logger.error(f"Job {job.id} ({job.description}) failed: {e}")
+        finally:
+            job.finished_at = time.time()
+            self._store(job)
+            self._stored_at.pop(job.id, None)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
@@ -0,0 +1,156 @@
+"""LRC parsing, compact lyric storage and time-indexed lookup.
+
+Lyrics are stored in ``songs.lyrics_text`` as ``{"t": [ms, ...], "l": [text, ...]}``:
+parallel arrays of start times in integer milliseconds and line texts, sorted
+by time. The older list-of-dicts format (``[{"time": s, "text": ...}]``) is
+still read.
+"""
+import json
+import logging
+import re
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from dataclasses import dataclass
+from operator import itemgetter
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+MAX_TIME_MS = 3600 * 1000  # timestamps past an hour are treated as bogus
+CACHE_SIZE = 512
+
+# A time tag: [mm:ss], [mm:ss.x], [mm:ss.xx], [mm:ss.xxx] or [mm:ss:xx]; lines may start with several
+_TIME_TAG = re.compile(r"\s*\[(\d{1,3}):(\d{1,2})(?:[.:](\d{1,3}))?\]")
+_OFFSET_TAG = re.compile(r"^\[offset:\s*([+-]?\d+)\s*\]$", re.IGNORECASE)
+
+
+@dataclass
+class Lyrics:
+    times: List[int]  # milliseconds, ascending
+    lines: List[str]
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def index_at(self, seconds: float) -> int:
+        """Index of the line active at ``seconds``, or -1 before the first line."""
+        return bisect_right(self.times, int(seconds * 1000)) - 1
+
+    def window(self, seconds: float, before: int = 1, after: int = 2) -> dict:
+        index = self.index_at(seconds)
+        start = max(0, index - before)
+        end = min(len(self.times), max(index, 0) + after + 1)
+        return {
+            "index": index,
+            "start": start,
+            "lines": [{"time": self.times[i] / 1000, "text": self.lines[i]} for i in range(start, end)],
+            "next_time": self.times[index + 1] / 1000 if index + 1 < len(self.times) else None,
+        }
+
+    def to_client(self) -> dict:
+        return {"times": [t / 1000 for t in self.times], "lines": self.lines}
+
+    def encode(self) -> str:
+        return json.dumps({"t": self.times, "l": self.lines}, ensure_ascii=False, separators=(",", ":"))
+
+
+def parse_lyrics(lyrics_text: str) -> Lyrics:
+    """Parse LRC text, including lines with several time tags and [offset:].
+
+    [offset:] is a file-level header: the first one found shifts every
+    stamp, wherever it appears. Lines without a time tag and metadata tags
+    such as [ar:] are skipped.
+    """
+    offset_ms = None
+    entries = []
+    skipped = 0
+    for line in lyrics_text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        tag = _TIME_TAG.match(line)
+        if not tag:
+            offset = _OFFSET_TAG.match(line)
+            if offset:  # a positive offset shows lyrics earlier
+                if offset_ms is None:
+                    offset_ms = int(offset.group(1))
+            else:
+                skipped += 1
+            continue
+        stamps = []
+        while tag:
+            minutes, seconds, fraction = tag.groups()
+            ms = (int(minutes) * 60 + int(seconds)) * 1000
+            if fraction:
+                ms += int(fraction.ljust(3, "0"))
+            stamps.append(ms)
+            end = tag.end()
+            tag = _TIME_TAG.match(line, end)
+        text = line[end:].strip()
+        for ms in stamps:
+            entries.append((ms, text))
+    if skipped:
+        logger.debug("Skipped %s lyric lines without a time tag", skipped)
+    offset_ms = offset_ms or 0
+    entries = [(ms - offset_ms, text) for ms, text in entries if 0 <= ms - offset_ms < MAX_TIME_MS]
+    entries.sort(key=itemgetter(0))
+    return Lyrics([ms for ms, _ in entries], [text for _, text in entries])
+
+
+def decode(stored: Optional[str]) -> Optional[Lyrics]:
+    """Read ``songs.lyrics_text`` in either the compact or the legacy format."""
+    if not stored:
+        return None
+    try:
+        data = json.loads(stored)
+    except json.JSONDecodeError as e:
+        logger.error(f"Failed to parse stored lyrics: {e}")
+        return None
+    if isinstance(data, dict):
+        return Lyrics(data.get("t", []), data.get("l", []))
+    times, lines = [], []
+    for lyric in data:
+        time = lyric.get("time")
+        if not isinstance(time, (int, float)) or time < 0 or time >= MAX_TIME_MS / 1000:
+            time = 0
+        times.append(int(round(time * 1000)))
+        lines.append(lyric.get("text", ""))
+    return Lyrics(times, lines)
+
+
+class LyricsCache:
+    """Small LRU of decoded lyrics by song id, so playback lookups skip JSON parsing."""
+
+    MISSING = object()
+
+    def __init__(self, maxsize: int = CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[int, Optional[Lyrics]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, song_id: int):
+        """Return the cached value, or the ``LyricsCache.MISSING`` sentinel."""
+        with self._lock:
+            if song_id in self._entries:
+                self._entries.move_to_end(song_id)
+                self.hits += 1
+                return self._entries[song_id]
+        self.misses += 1
+        return self.MISSING
+
+    def put(self, song_id: int, lyrics: Optional[Lyrics]):
+        with self._lock:
+            self._entries[song_id] = lyrics
+            self._entries.move_to_end(song_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, song_id: Optional[int] = None):
+        with self._lock:
+            if song_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(song_id, None)
@@ -1,282 +1,524 @@
-from fastapi import FastAPI, HTTPException, Form, File, UploadFile, Request
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, FastAPI, HTTPException, Form, File, UploadFile, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from typing import List, Dict
-import hashlib
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional, Tuple
+import asyncio
+import base64
+import html
 import json
-import sqlite3
 from pathlib import Path
-import yt_dlp
+import auth
+import changes
+import db
+import images
+import youtube
+import lyrics
+import metrics
+import peaks
+import playqueue
+import snapshots
+from jobs import JobManager
+from indexer import Indexer
+import streaming
+import transcode
+import workers
 import os
 import shutil
-import uuid
 import logging
 import re
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging; set LOG_LEVEL=DEBUG for verbose output
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
-# Initialize database and index songs at module load
-DB_PATH = Path("songs.db")
+# Nothing here touches the database or the disk at import; setup() and the
+# lifespan below do, once per worker process
+DB_PATH = Path(os.environ.get("DB_PATH", "songs.db"))
 DEFAULT_IMAGE = "default.jpg"
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Create tables if they don't exist
-    c.execute('''CREATE TABLE IF NOT EXISTS songs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        title TEXT NOT NULL,
-        artist TEXT,
-        filename TEXT NOT NULL UNIQUE,
-        playlist TEXT,
-        position INTEGER,
-        lyrics_text TEXT
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS playlists (
-        name TEXT,
-        image_path TEXT,
-        id INTEGER PRIMARY KEY AUTOINCREMENT
-    )''')
-    conn.commit()
-    conn.close()
-    logger.debug("Database initialized")
+MUSIC_DIR = Path(os.environ.get("MUSIC_DIR", r"C:\Users\Ashwa\Music\music"))
+def _song_filename(song_id: int) -> Optional[str]:
+    with db.connection() as conn:
+        row = conn.execute("SELECT filename FROM songs WHERE id = ?", (song_id,)).fetchone()
+    return row[0] if row else None
+
+song_paths = streaming.SongPathCache(MUSIC_DIR, _song_filename)
+lyrics_cache = lyrics.LyricsCache()
+transcoder = transcode.Transcoder()
+peak_analyzer = peaks.PeakAnalyzer(MUSIC_DIR)
+change_feed = changes.ChangeFeed()
+# /songs and /playlists bodies; every write below that they show calls invalidate()
+snapshot_cache = snapshots.SnapshotCache(lambda: change_feed.version)
+
+def _library_changed(progress):
+    song_paths.invalidate()
+    lyrics_cache.invalidate()
+    snapshot_cache.invalidate()
+    peak_analyzer.start()
+
+library_indexer = Indexer(MUSIC_DIR, on_change=_library_changed)
+job_manager = JobManager()
+youtube_search = youtube.SearchService()
 
 def index_songs():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    MUSIC_DIR = Path(r"C:\Users\Ashwa\Music\music")
-    if not MUSIC_DIR.exists():
-        MUSIC_DIR.mkdir(parents=True)
-        logger.debug(f"Created music directory {MUSIC_DIR}")
-    for playlist_dir in MUSIC_DIR.iterdir():
-        if playlist_dir.is_dir():
-            playlist_name = playlist_dir.name
-            c.execute("SELECT COUNT(*) FROM playlists WHERE name = ?", (playlist_name,))
-            if c.fetchone()[0] == 0:
-                c.execute("INSERT INTO playlists (name, image_path) VALUES (?, ?)", (playlist_name, DEFAULT_IMAGE))
-                logger.debug(f"Added playlist {playlist_name} to database")
-            songs = sorted(playlist_dir.glob("*.mp3"))
-            for position, file in enumerate(songs):
-                filename = f"{playlist_name}/{file.name}"
-                title = file.name.replace(".mp3", "").split(" - ")[0] if " - " in file.name else file.name.replace(".mp3", "")
-                artist = file.name.split(" - ")[1].replace(".mp3", "") if " - " in file.name and len(file.name.split(" - ")) > 1 else "Unknown"
-                c.execute("INSERT OR IGNORE INTO songs (title, artist, filename, playlist, position) VALUES (?, ?, ?, ?, ?)", 
-                         (title, artist, filename, playlist_name, position))
-                logger.debug(f"Indexed: {filename} in playlist {playlist_name} at position {position}")
-    conn.commit()
-    conn.close()
-
-# Initialize database and index songs
-init_db()
-index_songs()
-
-app = FastAPI()
-
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allow all origins for testing (restrict in production)
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    """Synchronously bring the songs table in line with MUSIC_DIR."""
+    return library_indexer.run()
 
-templates = Jinja2Templates(directory="templates")
+def _elected():
+    # Only the worker holding the indexer lease scans the library and computes peaks
+    library_indexer.start()
+    # Catch up on songs left without peaks; runs that change the library start it again
+    peak_analyzer.start()
+
+def _indexer_status() -> dict:
+    return library_indexer.progress.to_dict()
 
-# Mount static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
-MUSIC_DIR = Path(r"C:\Users\Ashwa\Music\music")
-IMAGES_DIR = Path(r"C:\Users\Ashwa\Desktop\echo-main\static\images")
-IMAGES_DIR.mkdir(exist_ok=True)
-app.mount("/music", StaticFiles(directory=MUSIC_DIR), name="music")
-app.mount("/images", StaticFiles(directory=IMAGES_DIR), name="images")
+coordinator = workers.Coordinator(workers.INDEXER_LEASE, on_elected=_elected, on_requested=library_indexer.start,
+                                  status=_indexer_status)
+# Writes made through any worker reach the caches of every other one
+coordinator.watch("songs", song_paths.invalidate)
+coordinator.watch("songs", lyrics_cache.invalidate)
+coordinator.watch("sessions", auth.session_cache.clear)
+
+templates = Jinja2Templates(directory="templates")
+IMAGES_DIR = Path(os.environ.get("IMAGES_DIR", r"C:\Users\Ashwa\Desktop\echo-main\static\images"))
+image_store = images.ImageStore(IMAGES_DIR)
 
-# In-memory user storage (use a database in production)
+# Users and sessions live in SQLite; import the legacy users.json once
 USERS_FILE = Path("users.json")
-if USERS_FILE.exists():
-    try:
-        with open(USERS_FILE, "r") as f:
-            content = f.read().strip()
-            if content:
-                users = json.loads(content)
-            else:
-                users = {}
-    except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse users.json: {e}. Initializing with empty users dictionary.")
-        users = {}
-else:
-    users = {}
-    try:
-        with open(USERS_FILE, "w") as f:
-            json.dump(users, f, indent=4)
-        logger.debug("Created empty users.json")
-    except Exception as e:
-        logger.error(f"Failed to create users.json: {e}")
-        raise
 
-def save_users():
+def setup():
+    """Migrate the database and create the data directories; blocking.
+
+    Safe to run in every worker at once, and the launcher runs it before
+    starting any so migrations are out of the way.
+    """
+    db.init_db(DB_PATH)
+    transcoder.open()
+    IMAGES_DIR.mkdir(parents=True, exist_ok=True)
+    MUSIC_DIR.mkdir(parents=True, exist_ok=True)
+    auth.migrate_users_json(USERS_FILE)
+
+router = APIRouter()
+
+def _collect_metrics():
+    caches = [("song_paths", song_paths), ("lyrics", lyrics_cache), ("transcode", transcoder),
+              ("youtube_search", youtube_search), ("sessions", auth.session_cache), ("snapshots", snapshot_cache)]
+    # The exposition format wants each family's samples together, so loop over families first
+    families = [
+        ("echo_cache_hits_total", "counter", "Cache hits.", lambda cache: cache.hits),
+        ("echo_cache_misses_total", "counter", "Cache misses.", lambda cache: cache.misses),
+        ("echo_cache_hit_ratio", "gauge", "Cache hits over lookups since start.",
+         lambda cache: metrics.hit_ratio(cache.hits, cache.misses)),
+    ]
+    for metric, kind, documentation, value in families:
+        for name, cache in caches:
+            yield metric, kind, documentation, {"cache": name}, value(cache)
+    yield ("echo_youtube_search_coalesced_total", "counter", "Searches served by an identical in-flight search.",
+           {}, youtube_search.coalesced)
+    yield "echo_transcode_cache_bytes", "gauge", "Bytes held in the transcode cache.", {}, transcoder.total_bytes
+    yield "echo_snapshot_cache_bytes", "gauge", "Bytes held in the response snapshot cache.", {}, snapshot_cache.total_bytes
+    yield ("echo_snapshot_not_modified_total", "counter", "Snapshot requests answered with 304.", {},
+           snapshot_cache.not_modified)
+    yield "echo_job_queue_depth", "gauge", "Background jobs waiting for a worker.", {}, job_manager.queue_depth()
+    yield "echo_indexer_running", "gauge", "1 while a library index run is in progress.", {}, int(library_indexer.running)
+    yield "echo_indexer_leader", "gauge", "1 in the worker that holds the indexer lease.", {}, int(coordinator.leader)
+    for result, count in [("ok", peak_analyzer.analyzed), ("failed", peak_analyzer.failed)]:
+        yield "echo_peaks_computed_total", "counter", "Waveform peak computations.", {"result": result}, count
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(setup)
+    change_feed.start()
+    await coordinator.start()
     try:
-        with open(USERS_FILE, "w") as f:
-            json.dump(users, f, indent=4)
-        logger.debug(f"Successfully saved users to {USERS_FILE}: {users}")
-    except Exception as e:
-        logger.error(f"Failed to save users to {USERS_FILE}: {e}")
-        raise
-
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
-
-def parse_lyrics(lyrics_text: str) -> List[Dict[str, float | str]]:
-    lines = lyrics_text.split('\n')
-    parsed_lyrics = []
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        match = re.match(r'^\[(\d{2}):(\d{2}\.\d{2})\](.*)$', line)
-        if match:
-            minutes = int(match.group(1))
-            seconds = float(match.group(2))
-            text = match.group(3).strip()
-            time = minutes * 60 + seconds
-            if 0 <= time < 3600:  # Ensure time is reasonable (less than 1 hour)
-                parsed_lyrics.append({"time": time, "text": text})
-            else:
-                logger.warning(f"Invalid timestamp {time} seconds in line: {line}, skipping")
-        else:
-            logger.warning(f"Unrecognized line format, skipping: {line}")
-    # Sort by timestamp to ensure correct order
-    parsed_lyrics.sort(key=lambda x: x["time"])
-    return parsed_lyrics
+        with workers.on_exit_signal(change_feed.close):
+            yield
+    finally:
+        await coordinator.stop()
+        job_manager.shutdown()
+        peak_analyzer.stop()
+        await change_feed.stop()
+        image_store.shutdown()
 
 # Routes
-@app.get("/", response_class=HTMLResponse)
+@router.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     logger.debug("Serving intro.html")
     return templates.TemplateResponse("intro.html", {"request": request})
 
-@app.get("/login", response_class=HTMLResponse)
+@router.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request):
     logger.debug("Serving login.html")
     return templates.TemplateResponse("login.html", {"request": request, "error": None})
 
-@app.post("/login", response_class=HTMLResponse)
+@router.post("/login", response_class=HTMLResponse)
 async def login(request: Request, username: str = Form(...), password: str = Form(...)):
-    logger.debug(f"Login attempt with username: {username}")
-    hashed_password = hash_password(password)
-    if username in users and users[username]["password"] == hashed_password:
-        logger.debug(f"Login successful for username: {username}, redirecting to /index")
+    logger.debug("Login attempt with username: %s", username)
+    user = await auth.authenticate(username, password)
+    if user:
+        logger.debug("Login successful for username: %s, redirecting to /index", username)
+        token = await auth.create_session(user)
         response = RedirectResponse(url="/index", status_code=303)  # Change to /index route
-        response.set_cookie(key="session_username", value=username, httponly=True, max_age=3600, samesite="Lax")
+        response.set_cookie(key=auth.SESSION_COOKIE, value=token, httponly=True, max_age=auth.SESSION_TTL, samesite="Lax")
         return response
     logger.warning(f"Login failed for username: {username} - Invalid credentials")
     return templates.TemplateResponse("login.html", {"request": request, "error": "Invalid credentials, try again"})
 
-@app.get("/index", response_class=HTMLResponse)
+@router.get("/index", response_class=HTMLResponse)
 async def index(request: Request):
-    username = request.cookies.get("session_username")
-    logger.debug(f"Session cookie username: {username}")
-    if not username or username not in users:
+    user = await auth.get_session_user(request.cookies.get(auth.SESSION_COOKIE))
+    if not user:
         logger.debug("No valid session found, redirecting to /login")
         return RedirectResponse(url="/login", status_code=303)
-    logger.debug(f"Serving index.html for user: {username}")
-    return templates.TemplateResponse("index.html", {"request": request, "username": username})
+    logger.debug("Serving index.html for user: %s", user.username)
+    return templates.TemplateResponse("index.html", {"request": request, "username": user.username})
 
-@app.get("/logout")
+@router.get("/logout")
 async def logout(request: Request):
     logger.debug("Logging out user, redirecting to /login")
+    await auth.delete_session(request.cookies.get(auth.SESSION_COOKIE))
     response = RedirectResponse(url="/login")
-    response.delete_cookie("session_username")
+    response.delete_cookie(auth.SESSION_COOKIE)
     return response
 
-@app.get("/songs")
-async def get_songs():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id, title, artist, filename, playlist, position, lyrics_text FROM songs ORDER BY playlist, position")
-    songs = []
-    for row in c.fetchall():
-        lyrics = row[6]
-        if lyrics:
-            try:
-                lyrics_data = json.loads(lyrics)
-                # Ensure all times are valid floats
-                for lyric in lyrics_data:
-                    if not isinstance(lyric.get("time"), (int, float)) or lyric["time"] < 0 or lyric["time"] >= 3600:
-                        logger.warning(f"Invalid time value {lyric.get('time')} for song id {row[0]}, resetting to 0")
-                        lyric["time"] = 0
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse lyrics for song id {row[0]}: {e}")
-                lyrics_data = None
+# Fields a client may request from /songs via ?fields=, mapped to the columns they need.
+# Lyrics are deliberately not listed here; they are served by /song/{song_id}/lyrics.
+SONG_FIELDS = {
+    "id": "id",
+    "title": "title",
+    "artist": "artist",
+    "url": "id",
+    "playlist": "playlist",
+    "position": "position",
+    "has_lyrics": "lyrics_text IS NOT NULL",
+    "album": "album",
+    "duration": "duration",
+    "bitrate": "bitrate",
+}
+SONGS_PAGE_DEFAULT = 500
+SONGS_PAGE_MAX = 5000
+
+def encode_cursor(playlist, position, song_id) -> str:
+    raw = json.dumps([playlist, position, song_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        playlist, position, song_id = json.loads(raw)
+        return playlist, int(position), int(song_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _json_body(content) -> bytes:
+    # Same encoding as JSONResponse
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+@router.get("/songs")
+async def get_songs(request: Request, limit: int = SONGS_PAGE_DEFAULT, cursor: Optional[str] = None,
+                    playlist: Optional[str] = None, fields: Optional[str] = None):
+    """Return one page of the catalogue ordered by playlist and position.
+
+    Pagination is keyset-based: pass the returned ``next_cursor`` back as
+    ``cursor`` to fetch the following page. ``fields`` is a comma-separated
+    subset of SONG_FIELDS; lyrics are never included. Pages are served from
+    snapshot_cache until the library changes.
+    """
+    async def build():
+        return _json_body(await _songs_page(limit, cursor, playlist, fields))
+    return await snapshot_cache.respond(request, build)
+
+async def _songs_page(limit: int = SONGS_PAGE_DEFAULT, cursor: Optional[str] = None,
+                      playlist: Optional[str] = None, fields: Optional[str] = None) -> dict:
+    """The /songs body for these parameters, straight from the database."""
+    limit = max(1, min(limit, SONGS_PAGE_MAX))
+    if fields:
+        selected = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in selected if f not in SONG_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    else:
+        selected = list(SONG_FIELDS)
+
+    # playlist, position and id are always selected since the cursor is built from them
+    columns = ["playlist", "position", "id"] + [SONG_FIELDS[f] for f in selected]
+    where, params = [], []
+    if playlist is not None:
+        where.append("playlist = ?")
+        params.append(playlist)
+    if cursor:
+        after_playlist, after_position, after_id = decode_cursor(cursor)
+        if playlist is not None:
+            where.append("(position, id) > (?, ?)")
+            params.extend([after_position, after_id])
         else:
-            lyrics_data = None
-        songs.append({
-            "id": row[0],
-            "title": row[1],
-            "artist": row[2],
-            "url": f"/music/{row[3]}",
-            "playlist": row[4],
-            "position": row[5],
-            "lyrics": lyrics_data
-        })
-    conn.close()
-    logger.debug(f"Fetched {len(songs)} songs")
-    return JSONResponse(content=songs)
-
-@app.get("/playlists")
-async def get_playlists():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT name, image_path, id FROM playlists")
-    playlists = [{"name": row[0], "image": f"/images/{row[1]}" if row[1] else f"/images/{DEFAULT_IMAGE}", "id": row[2]} for row in c.fetchall()]
-    conn.close()
-    logger.debug(f"Fetched {len(playlists)} playlists")
-    return {"playlists": playlists}
-
-@app.get("/song/{song_id}")
-async def get_song(song_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT filename FROM songs WHERE id = ?", (song_id,))
-    song = c.fetchone()
-    conn.close()
-    if not song:
-        logger.warning(f"Song with id {song_id} not found")
+            where.append("(playlist, position, id) > (?, ?, ?)")
+            params.extend([after_playlist, after_position, after_id])
+    query = f"SELECT {', '.join(columns)} FROM songs"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY playlist, position, id LIMIT ?"
+    params.append(limit + 1)
+
+    rows = await db.fetchall(query, params)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    songs = []
+    for row in rows:
+        song = {}
+        for field, value in zip(selected, row[3:]):
+            if field == "url":
+                value = f"/song/{value}"
+            elif field == "has_lyrics":
+                value = bool(value)
+            song[field] = value
+        songs.append(song)
+    next_cursor = encode_cursor(*rows[-1][:3]) if has_more else None
+    logger.debug("Fetched %s songs (playlist=%s, more=%s)", len(songs), playlist, has_more)
+    return {"songs": songs, "next_cursor": next_cursor}
+
+def _load_lyrics(song_id: int):
+    """Decoded lyrics for ``song_id`` (None if it has none); blocking, call off the event loop."""
+    with db.connection() as conn:
+        row = conn.execute("SELECT lyrics_text FROM songs WHERE id = ?", (song_id,)).fetchone()
+    if not row:
         raise HTTPException(status_code=404, detail="Song not found")
-    file_path = MUSIC_DIR / song[0]
-    if not file_path.exists():
-        logger.warning(f"Song file {file_path} not found on disk")
-        raise HTTPException(status_code=404, detail="Song file not found on disk")
-    logger.debug(f"Serving song file: {file_path}")
-    return FileResponse(file_path, media_type="audio/mpeg")
-
-@app.get("/signup", response_class=HTMLResponse)
+    song_lyrics = lyrics.decode(row[0])
+    lyrics_cache.put(song_id, song_lyrics)
+    return song_lyrics
+
+async def get_lyrics(song_id: int):
+    song_lyrics = lyrics_cache.get(song_id)
+    if song_lyrics is lyrics_cache.MISSING:
+        song_lyrics = await run_in_threadpool(_load_lyrics, song_id)
+    return song_lyrics
+
+@router.get("/song/{song_id}/lyrics")
+async def get_song_lyrics(song_id: int):
+    """All lyric lines as parallel arrays: {"times": [seconds], "lines": [text]}."""
+    song_lyrics = await get_lyrics(song_id)
+    return {"id": song_id, "lyrics": song_lyrics.to_client() if song_lyrics else None}
+
+@router.get("/song/{song_id}/lyrics/at")
+async def get_lyrics_at(song_id: int, t: float = 0.0, before: int = 1, after: int = 2):
+    """The line active at playback time ``t`` (seconds) with a few lines of context."""
+    song_lyrics = await get_lyrics(song_id)
+    if not song_lyrics:
+        raise HTTPException(status_code=404, detail="Song has no lyrics")
+    return {"id": song_id, **song_lyrics.window(t, max(0, min(before, 50)), max(0, min(after, 50)))}
+
+PEAKS_WAIT = 5.0  # seconds a request waits for an on-demand analysis
+PEAKS_RETRY_AFTER = 3
+
+@router.get("/song/{song_id}/peaks")
+async def get_song_peaks(request: Request, song_id: int, resolution: int = peaks.DEFAULT_RESOLUTION):
+    """Waveform overview as ``resolution`` bytes, each the peak level (0-255) of one slice of the track.
+
+    Peaks not computed yet by the background analyzer are computed on demand
+    by its own threads; if that takes longer than PEAKS_WAIT the answer is 202
+    with Retry-After, and the peaks are stored once ready.
+    """
+    if not peaks.MIN_RESOLUTION <= resolution <= peaks.PEAK_COUNT:
+        raise HTTPException(status_code=400,
+                            detail=f"resolution must be between {peaks.MIN_RESOLUTION} and {peaks.PEAK_COUNT}")
+    row = await db.fetchone(
+        """SELECT s.filename, s.mtime, s.size, p.mtime, p.size, p.peaks
+           FROM songs s LEFT JOIN song_peaks p ON p.song_id = s.id WHERE s.id = ?""", (song_id,))
+    if not row:
+        raise HTTPException(status_code=404, detail="Song not found")
+    filename, mtime, size, peaks_mtime, peaks_size, data = row
+    etag = f'"{size or 0:x}-{int((mtime or 0) * 1000):x}-{resolution}"'
+    headers = {"etag": etag, "cache-control": streaming.CACHE_CONTROL}
+    if streaming.not_modified(request, etag, mtime or 0):
+        return Response(status_code=304, headers=headers)
+    if (peaks_mtime, peaks_size) != (mtime, size):
+        if not peak_analyzer.available:
+            raise HTTPException(status_code=404, detail="Waveform peaks are not available")
+        pending = Response(status_code=202, headers={"retry-after": str(PEAKS_RETRY_AFTER)})
+        future = peak_analyzer.submit(song_id, filename, mtime, size)
+        if future is None:
+            return pending
+        try:
+            # Shielded: giving up on the wait must not cancel the queued analysis
+            data = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), PEAKS_WAIT)
+        except asyncio.TimeoutError:
+            return pending
+    if not data:
+        raise HTTPException(status_code=404, detail="No waveform for this song")
+    return Response(peaks.downsample(data, resolution), media_type="application/octet-stream", headers=headers)
+
+CHANGES_HEARTBEAT = 15.0  # seconds between keep-alive comments on an idle stream
+CHANGES_RETRY_MS = 3000
+
+async def _library_delta(since: int, limit: int) -> dict:
+    delta = await db.read(changes.delta, since, limit)
+    if not delta["reset"]:
+        delta["playlists"] = [_playlist_dict(row) for row in delta["playlists"]]
+    return delta
+
+@router.get("/changes")
+async def get_changes(since: Optional[int] = None, limit: int = changes.DELTA_LIMIT_DEFAULT):
+    """Songs and playlists changed after library version ``since``.
+
+    Without ``since`` only the current version is returned; take it before
+    a full /songs and /playlists load and pass it back later. Keep asking
+    with the returned ``version`` while ``more`` is true. ``reset`` means
+    the log no longer reaches back that far and everything must be
+    refetched.
+    """
+    if since is None:
+        return {"version": await db.read(changes.current_version)}
+    return await _library_delta(since, max(1, min(limit, changes.DELTA_LIMIT_MAX)))
+
+@router.get("/changes/stream")
+async def stream_changes(request: Request, since: Optional[int] = None):
+    """Server-sent events: one ``changes`` event (a /changes body) whenever the library changes.
+
+    Reconnecting clients resume from the Last-Event-ID the browser sends.
+    """
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+    if since is None:
+        since = await db.read(changes.current_version)
+
+    async def events():
+        version = since
+        yield f"retry: {CHANGES_RETRY_MS}\n\n"
+        while not change_feed.closing:
+            if not await change_feed.wait(version, CHANGES_HEARTBEAT):
+                if not change_feed.closing:
+                    yield ": keep-alive\n\n"
+                continue
+            delta = await _library_delta(version, changes.DELTA_LIMIT_MAX)
+            version = delta["version"]
+            yield f"event: changes\nid: {version}\ndata: {json.dumps(delta)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"cache-control": "no-cache", "x-accel-buffering": "no"})
+
+SEARCH_PAGE_DEFAULT = 20
+SEARCH_PAGE_MAX = 100
+# Control characters mark the matches in snippet() so the text can be escaped before they become <b>
+SNIPPET_START, SNIPPET_END = "\x02", "\x03"
+
+def fts_query(text: str) -> str:
+    """Turn free text into an FTS5 query matching every term as a prefix."""
+    terms = re.findall(r"\w+", text)
+    return " ".join('"' + term.replace('"', '""') + '"*' for term in terms)
+
+def highlight_snippet(snippet: Optional[str]) -> Optional[str]:
+    """HTML-escape an FTS snippet and wrap its marked matches in <b>."""
+    if not snippet:
+        return None
+    return html.escape(snippet).replace(SNIPPET_START, "<b>").replace(SNIPPET_END, "</b>")
+
+@router.get("/search")
+async def search_library(q: str, limit: int = SEARCH_PAGE_DEFAULT, offset: int = 0, playlist: Optional[str] = None):
+    """Ranked full-text search over titles, artists, playlists and lyrics."""
+    match = fts_query(q)
+    if not match:
+        return {"results": [], "next_offset": None}
+    limit = max(1, min(limit, SEARCH_PAGE_MAX))
+    offset = max(0, offset)
+    query = """SELECT s.id, s.title, s.artist, s.playlist, s.position, s.lyrics_text IS NOT NULL,
+                      snippet(songs_fts, 3, ?, ?, '…', 8)
+               FROM songs_fts JOIN songs s ON s.id = songs_fts.rowid
+               WHERE songs_fts MATCH ?"""
+    params = [SNIPPET_START, SNIPPET_END, match]
+    if playlist is not None:
+        query += " AND s.playlist = ?"
+        params.append(playlist)
+    # Title matches outrank artist, playlist and then lyric matches
+    query += " ORDER BY bm25(songs_fts, 10.0, 5.0, 2.0, 1.0) LIMIT ? OFFSET ?"
+    params.extend([limit + 1, offset])
+    rows = await db.fetchall(query, params)
+    results = [{
+        "id": row[0],
+        "title": row[1],
+        "artist": row[2],
+        "url": f"/song/{row[0]}",
+        "playlist": row[3],
+        "position": row[4],
+        "has_lyrics": bool(row[5]),
+        "lyrics_snippet": highlight_snippet(row[6]),
+    } for row in rows[:limit]]
+    return {"results": results, "next_offset": offset + limit if len(rows) > limit else None}
+
+def _playlist_dict(row) -> dict:
+    name, image_path, playlist_id, thumbnails = row
+    return {"name": name, "image": f"/images/{image_path}" if image_path else f"/images/{DEFAULT_IMAGE}",
+            "id": playlist_id, "thumbnails": images.thumbnail_urls(json.loads(thumbnails) if thumbnails else None)}
+
+@router.get("/playlists")
+async def get_playlists(request: Request):
+    async def build():
+        rows = await db.fetchall(f"SELECT {changes.PLAYLIST_COLUMNS} FROM playlists")
+        playlists = [_playlist_dict(row) for row in rows]
+        logger.debug("Fetched %s playlists", len(playlists))
+        return _json_body({"playlists": playlists})
+    return await snapshot_cache.respond(request, build)
+
+@router.get("/song/{song_id}")
+async def get_song(request: Request, song_id: int, quality: Optional[str] = None):
+    """Stream a song with Range, ETag and Last-Modified support.
+
+    ``quality`` (64, 96, 128, opus or original) or the Save-Data/ECT client
+    hints select a transcoded variant instead of the stored mp3.
+    """
+    try:
+        profile = transcode.select_profile(quality, request.headers)
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"Unknown quality {quality}")
+    entry = song_paths.cached(song_id)
+    if entry is None:
+        try:
+            with metrics.FILE_IO_SECONDS.time(op="song_lookup"):
+                entry = await run_in_threadpool(song_paths.load, song_id)
+        except FileNotFoundError:
+            logger.warning(f"Song file for id {song_id} not found on disk")
+            raise HTTPException(status_code=404, detail="Song file not found on disk")
+        if entry is None:
+            logger.warning(f"Song with id {song_id} not found")
+            raise HTTPException(status_code=404, detail="Song not found")
+    file_path, size, mtime = entry
+    media_type = "audio/mpeg"
+    if profile is not None and transcoder.available:
+        try:
+            file_path, size, mtime = await transcoder.variant(song_id, file_path, size, mtime, profile)
+            media_type = profile.media_type
+        except Exception as e:
+            logger.error(f"Transcoding song {song_id} to {profile.name} failed, serving original: {e}")
+    # Without ?quality the variant follows the client hints, so caches must key on them
+    extra_headers = {"vary": "Save-Data, ECT"} if quality is None else None
+    return streaming.stream_file(request, file_path, size, mtime, media_type=media_type, extra_headers=extra_headers)
+
+@router.get("/signup", response_class=HTMLResponse)
 async def signup_page(request: Request):
     logger.debug("Serving login.html for signup")
     return templates.TemplateResponse("login.html", {"request": request})
 
-@app.post("/signup")
+@router.post("/signup")
 async def signup(username: str = Form(...), password: str = Form(...), email: str = Form(...), broj: str = Form(...)):
-    logger.debug(f"Signup attempt with username: {username}")
-    if username in users:
-        logger.warning(f"Username {username} already exists")
-        return JSONResponse(status_code=400, content={"message": "Username already exists"})
+    logger.debug("Signup attempt with username: %s", username)
     if not username or not password:
         logger.warning("Signup failed due to empty username or password")
         return JSONResponse(status_code=400, content={"message": "Username and password cannot be empty"})
-    hashed_password = hash_password(password)
-    users[username] = {"password": hashed_password, "email": email, "broj": broj}
-    save_users()
-    logger.debug(f"Signup successful for username: {username}, redirecting to /login")
+    try:
+        await auth.create_user(username, password, email, broj)
+    except auth.UsernameTaken:
+        logger.warning(f"Username {username} already exists")
+        return JSONResponse(status_code=400, content={"message": "Username already exists"})
+    logger.debug("Signup successful for username: %s, redirecting to /login", username)
     return RedirectResponse(url="/login", status_code=303)
 
-@app.post("/create_playlist")
+@router.post("/create_playlist")
 async def create_playlist(playlist_name: str = Form(...)):
     if not playlist_name.strip():
         logger.warning("Attempted to create playlist with empty name")
@@ -284,217 +526,374 @@ async def create_playlist(playlist_name: str = Form(...)):
     playlist_dir = MUSIC_DIR / playlist_name
     playlist_dir.mkdir(exist_ok=True)
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM playlists WHERE name = ?", (playlist_name,))
-    if c.fetchone()[0] > 0:
-        conn.close()
+    cursor = await db.execute("INSERT OR IGNORE INTO playlists (name, image_path) VALUES (?, ?)", (playlist_name, DEFAULT_IMAGE))
+    if cursor.rowcount == 0:
         logger.warning(f"Playlist {playlist_name} already exists")
         return JSONResponse(status_code=400, content={"message": f"Playlist {playlist_name} already exists"})
-    c.execute("INSERT INTO playlists (name, image_path) VALUES (?, ?)", (playlist_name, DEFAULT_IMAGE))
-    conn.commit()
-    conn.close()
-    logger.debug(f"Created playlist: {playlist_name}")
+    snapshot_cache.invalidate()
+    logger.debug("Created playlist: %s", playlist_name)
     return {"message": f"Playlist {playlist_name} created"}
 
-@app.post("/update_playlist_image")
-async def update_playlist_image(playlist_id: int = Form(...), image: UploadFile = File(...)):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT image_path, name FROM playlists WHERE id = ?", (playlist_id,))
-    existing_playlist = c.fetchone()
-    if not existing_playlist:
-        conn.close()
-        logger.warning(f"Playlist with id {playlist_id} not found")
-        raise HTTPException(status_code=404, detail="Playlist not found")
-
-    if existing_playlist[0] and existing_playlist[0] != DEFAULT_IMAGE:
-        old_image_path = IMAGES_DIR / existing_playlist[0]
-        if old_image_path.exists():
-            os.remove(old_image_path)
-
-    file_extension = image.filename.split('.')[-1].lower()
-    image_filename = f"{uuid.uuid4()}.{file_extension}"
-    image_path = IMAGES_DIR / image_filename
-    with open(image_path, "wb") as buffer:
-        shutil.copyfileobj(image.file, buffer)
-
-    c.execute("UPDATE playlists SET image_path = ? WHERE id = ?", (image_filename, playlist_id))
-    conn.commit()
-    conn.close()
-    logger.debug(f"Updated image for playlist {existing_playlist[1]}")
-    return {"message": f"Image updated for playlist {existing_playlist[1]}"}
+async def _release_image(image_path: Optional[str], thumbnails: Optional[str]):
+    """Delete a cover's files unless another playlist still uses them."""
+    if not image_path or image_path == DEFAULT_IMAGE:
+        return
+    # Names are content hashes, so playlists with the same cover share files
+    if await db.fetchone("SELECT 1 FROM playlists WHERE image_path = ?", (image_path,)):
+        return
+    with metrics.FILE_IO_SECONDS.time(op="playlist_image_delete"):
+        await run_in_threadpool(image_store.remove, image_path, json.loads(thumbnails) if thumbnails else None)
+
+@router.post("/update_playlist_image")
+async def update_playlist_image(request: Request):
+    # The form is parsed off the stream here: UploadFile would only arrive after the whole body was spooled
+    try:
+        async with image_store.receive(request.stream(), request.headers.get("content-type", ""),
+                                       request.headers.get("content-length")) as upload:
+            if not upload.fields.get("playlist_id", "").isdigit():
+                raise HTTPException(status_code=422, detail="playlist_id must be an integer")
+            playlist_id = int(upload.fields["playlist_id"])
+            existing_playlist = await db.fetchone("SELECT image_path, name, thumbnails FROM playlists WHERE id = ?",
+                                                  (playlist_id,))
+            if not existing_playlist:
+                logger.warning(f"Playlist with id {playlist_id} not found")
+                raise HTTPException(status_code=404, detail="Playlist not found")
+            with metrics.FILE_IO_SECONDS.time(op="playlist_image"):
+                image_filename, thumbnails = await image_store.store(upload)
+    except images.ImageTooLarge as e:
+        logger.warning(f"Rejected playlist image: {e}")
+        raise HTTPException(status_code=413, detail=str(e))
+    except images.InvalidImage as e:
+        logger.warning(f"Rejected playlist image: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+    await db.execute("UPDATE playlists SET image_path = ?, thumbnails = ? WHERE id = ?",
+                     (image_filename, json.dumps(thumbnails) if thumbnails else None, playlist_id))
+    snapshot_cache.invalidate()
+    if existing_playlist[0] != image_filename:
+        await _release_image(existing_playlist[0], existing_playlist[2])
+    logger.debug("Updated image for playlist %s", existing_playlist[1])
+    return {"message": f"Image updated for playlist {existing_playlist[1]}",
+            "image": f"/images/{image_filename}", "thumbnails": images.thumbnail_urls(thumbnails)}
+
+def _move_playlist_files(old_dir: Path, new_dir: Path, moves: List[Tuple[str, str]]):
+    """Move renamed songs' files from ``old_dir`` to ``new_dir``, putting them back if any move fails; blocking.
+
+    ``moves`` holds (old, new) filenames relative to MUSIC_DIR.
+    """
+    if not old_dir.exists():
+        return
+    if not new_dir.exists():
+        old_dir.rename(new_dir)
+        return
+    done = []
+    try:
+        for old, new in moves:
+            source, target = MUSIC_DIR / old, MUSIC_DIR / new
+            if source.exists() and not target.exists():
+                shutil.move(str(source), str(target))
+                done.append((source, target))
+    except OSError:
+        for source, target in reversed(done):
+            shutil.move(str(target), str(source))
+        raise
+    try:
+        old_dir.rmdir()
+    except OSError:
+        pass
 
-@app.post("/rename_playlist")
+@router.post("/rename_playlist")
 async def rename_playlist(playlist_id: int = Form(...), new_name: str = Form(...)):
     if not new_name.strip():
         logger.warning("Attempted to rename playlist to empty name")
         return JSONResponse(status_code=400, content={"message": "New playlist name cannot be empty"})
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT name FROM playlists WHERE id = ?", (playlist_id,))
-    old_name_row = c.fetchone()
-    if not old_name_row:
-        conn.close()
-        logger.warning(f"Playlist with id {playlist_id} not found")
-        raise HTTPException(status_code=404, detail="Playlist not found")
-    old_name = old_name_row[0]
 
-    c.execute("SELECT COUNT(*) FROM playlists WHERE name = ?", (new_name,))
-    if c.fetchone()[0] > 0:
-        conn.close()
-        logger.warning(f"Playlist name {new_name} already exists")
+    def _rename(c):
+        old_name_row = c.execute("SELECT name FROM playlists WHERE id = ?", (playlist_id,)).fetchone()
+        if not old_name_row:
+            logger.warning(f"Playlist with id {playlist_id} not found")
+            raise HTTPException(status_code=404, detail="Playlist not found")
+        old_name = old_name_row[0]
+
+        if c.execute("SELECT COUNT(*) FROM playlists WHERE name = ?", (new_name,)).fetchone()[0] > 0:
+            logger.warning(f"Playlist name {new_name} already exists")
+            return old_name, None
+
+        c.execute("UPDATE playlists SET name = ? WHERE id = ?", (new_name, playlist_id))
+        c.execute("UPDATE songs SET playlist = ? WHERE playlist = ?", (new_name, old_name))
+        moves = []
+        for song_id, filename in c.execute("SELECT id, filename FROM songs WHERE playlist = ?", (new_name,)).fetchall():
+            target = f"{new_name}/{filename.rsplit('/', 1)[-1]}"
+            if filename != target and not c.execute("SELECT 1 FROM songs WHERE filename = ?", (target,)).fetchone():
+                c.execute("UPDATE songs SET filename = ? WHERE id = ?", (target, song_id))
+                moves.append((song_id, filename, target))
+        return old_name, moves
+
+    def _undo(c, old_name, moves):
+        c.execute("UPDATE playlists SET name = ? WHERE id = ?", (old_name, playlist_id))
+        c.execute("UPDATE songs SET playlist = ? WHERE playlist = ?", (old_name, new_name))
+        c.executemany("UPDATE songs SET filename = ? WHERE id = ?", [(old, song_id) for song_id, old, _ in moves])
+
+    # Files are moved after the commit, so the write lock isn't held across disk work
+    old_name, moves = await db.run(_rename)
+    if moves is None:
         return JSONResponse(status_code=400, content={"message": f"Playlist name {new_name} already exists"})
-
-    playlist_dir = MUSIC_DIR / old_name
-    new_playlist_dir = MUSIC_DIR / new_name
-
-    c.execute("UPDATE playlists SET name = ? WHERE id = ?", (new_name, playlist_id))
-    c.execute("UPDATE songs SET playlist = ? WHERE playlist = ?", (new_name, old_name))
-
-    if playlist_dir.exists():
-        if new_playlist_dir.exists():
-            for song_file in playlist_dir.glob("*.mp3"):
-                target_path = new_playlist_dir / song_file.name
-                if not target_path.exists():
-                    shutil.move(str(song_file), str(target_path))
-                relative_filename = f"{new_name}/{song_file.name}"
-                c.execute("UPDATE songs SET filename = ? WHERE filename = ?", 
-                         (relative_filename, f"{old_name}/{song_file.name}"))
-            try:
-                playlist_dir.rmdir()
-            except OSError:
-                pass
-        else:
-            playlist_dir.rename(new_playlist_dir)
-
-    conn.commit()
-    conn.close()
-    logger.debug(f"Renamed playlist from {old_name} to {new_name}")
+    try:
+        with metrics.FILE_IO_SECONDS.time(op="playlist_rename"):
+            await run_in_threadpool(_move_playlist_files, MUSIC_DIR / old_name, MUSIC_DIR / new_name,
+                                    [(old, new) for _, old, new in moves])
+    except OSError as e:
+        logger.error(f"Failed to move files of playlist {old_name} to {new_name}: {e}")
+        await db.run(_undo, old_name, moves)
+        raise HTTPException(status_code=500, detail="Failed to move the playlist's files")
+    finally:
+        song_paths.invalidate()
+        snapshot_cache.invalidate()
+    logger.debug("Renamed playlist from %s to %s", old_name, new_name)
     return {"message": f"Playlist renamed from {old_name} to {new_name}"}
 
-@app.post("/add_song")
+def _download_song(job, playlist_name: str, youtube_url: str):
+    result = youtube.download_song(job, MUSIC_DIR, playlist_name, youtube_url)
+    snapshot_cache.invalidate()
+    return result
+
+def _add_from_url(job, playlist_name: str, youtube_url: str):
+    """Download a single video, or fan a playlist URL out into one job per entry."""
+    entries = youtube.playlist_entries(youtube_url) if youtube.looks_like_playlist(youtube_url) else None
+    if entries is None:
+        return _download_song(job, playlist_name, youtube_url)
+    for entry_url in entries:
+        child = job_manager.submit("download", entry_url, _download_song, playlist_name, entry_url)
+        job.children.append(child.id)
+    return {"entries": len(entries)}
+
+def _add_many(job, playlist_name: str, youtube_urls: List[str]):
+    for youtube_url in youtube_urls:
+        child = job_manager.submit("add_song", youtube_url, _add_from_url, playlist_name, youtube_url)
+        job.children.append(child.id)
+    return {"entries": len(youtube_urls)}
+
+@router.post("/add_song", status_code=202)
 async def add_song(playlist_name: str = Form(...), youtube_url: str = Form(...)):
-    playlist_dir = MUSIC_DIR / playlist_name
-    playlist_dir.mkdir(exist_ok=True)
-
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'outtmpl': str(playlist_dir / '%(title)s.%(ext)s'),
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
-        'quiet': True,
-    }
-
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(youtube_url, download=True)
-            downloaded_file = Path(ydl.prepare_filename(info)).with_suffix('.mp3')
-            filename = f"{playlist_name}/{downloaded_file.name}"
-            title = info.get('title', 'Unknown Title')
-            artist = info.get('uploader', 'Unknown Artist').replace(" - Topic", "")
-            os.rename(downloaded_file, playlist_dir / downloaded_file.name)  # Ensure file is in correct directory
-
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT MAX(position) FROM songs WHERE playlist = ?", (playlist_name,))
-        max_position = c.fetchone()[0] or -1
-        c.execute("INSERT INTO songs (title, artist, filename, playlist, position) VALUES (?, ?, ?, ?, ?)",
-                  (title, artist, filename, playlist_name, max_position + 1))
-        conn.commit()
-        conn.close()
-        logger.debug(f"Added song {title} to playlist {playlist_name}")
-        return {"message": f"Added {title} to {playlist_name}"}
-    except Exception as e:
-        logger.error(f"Failed to download song: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to download song: {str(e)}")
-
-@app.post("/delete_playlist")
+    job = job_manager.submit("add_song", youtube_url, _add_from_url, playlist_name, youtube_url)
+    return {"message": f"Queued {youtube_url} for {playlist_name}", "job_id": job.id}
+
+@router.post("/add_songs", status_code=202)
+async def add_songs(playlist_name: str = Form(...), youtube_urls: str = Form(...)):
+    """Queue several URLs (one per line or comma-separated) as one bulk job."""
+    urls = [url.strip() for url in re.split(r"[\n,]", youtube_urls) if url.strip()]
+    if not urls:
+        return JSONResponse(status_code=400, content={"message": "No URLs given"})
+    job = job_manager.submit("bulk", f"{len(urls)} URLs", _add_many, playlist_name, urls)
+    return {"message": f"Queued {len(urls)} URLs for {playlist_name}", "job_id": job.id}
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job:
+        return job_manager.describe(job)
+    # Submitted through another worker
+    data = await run_in_threadpool(job_manager.describe_stored, job_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return data
+
+@router.post("/delete_playlist")
 async def delete_playlist(playlist_id: int = Form(...)):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT name, image_path FROM playlists WHERE id = ?", (playlist_id,))
-    playlist = c.fetchone()
+    playlist = await db.fetchone("SELECT name, image_path, thumbnails FROM playlists WHERE id = ?", (playlist_id,))
     if not playlist:
-        conn.close()
         logger.warning(f"Playlist with id {playlist_id} not found")
         raise HTTPException(status_code=404, detail="Playlist not found")
     playlist_name = playlist[0]
 
-    playlist_dir = MUSIC_DIR / playlist_name
-    if playlist_dir.exists():
-        shutil.rmtree(playlist_dir)
-    
-    if playlist[1] and playlist[1] != DEFAULT_IMAGE:
-        image_path = IMAGES_DIR / playlist[1]
-        if image_path.exists():
-            os.remove(image_path)
-    
-    c.execute("DELETE FROM playlists WHERE id = ?", (playlist_id,))
-    c.execute("DELETE FROM songs WHERE playlist = ?", (playlist_name,))
-    conn.commit()
-    conn.close()
-    logger.debug(f"Deleted playlist {playlist_name}")
+    def _remove_files():
+        playlist_dir = MUSIC_DIR / playlist_name
+        if playlist_dir.exists():
+            shutil.rmtree(playlist_dir)
+
+    def _delete(c):
+        c.execute("DELETE FROM songs WHERE playlist = ?", (playlist_name,))
+        c.execute("DELETE FROM playlists WHERE id = ?", (playlist_id,))
+
+    with metrics.FILE_IO_SECONDS.time(op="delete_playlist_files"):
+        await run_in_threadpool(_remove_files)
+    await db.run(_delete)
+    await _release_image(playlist[1], playlist[2])
+    song_paths.invalidate()
+    lyrics_cache.invalidate()
+    snapshot_cache.invalidate()
+    logger.debug("Deleted playlist %s", playlist_name)
     return {"message": f"Deleted playlist {playlist_name}"}
 
-@app.post("/delete_song")
+@router.post("/delete_song")
 async def delete_song(song_id: int = Form(...)):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT filename FROM songs WHERE id = ?", (song_id,))
-    song = c.fetchone()
+    song = await db.fetchone("SELECT filename FROM songs WHERE id = ?", (song_id,))
     if not song:
         logger.warning(f"Song with id {song_id} not found")
         raise HTTPException(status_code=404, detail="Song not found")
     file_path = MUSIC_DIR / song[0]
     if file_path.exists():
-        os.remove(file_path)
-    c.execute("DELETE FROM songs WHERE id = ?", (song_id,))
-    conn.commit()
-    conn.close()
-    logger.debug(f"Deleted song with id {song_id}")
+        with metrics.FILE_IO_SECONDS.time(op="delete_song_file"):
+            await run_in_threadpool(os.remove, file_path)
+    await db.execute("DELETE FROM songs WHERE id = ?", (song_id,))
+    song_paths.invalidate(song_id)
+    lyrics_cache.invalidate(song_id)
+    snapshot_cache.invalidate()
+    logger.debug("Deleted song with id %s", song_id)
     return {"message": "Song deleted"}
 
-@app.post("/rearrange_playlist")
+@router.post("/rearrange_playlist")
 async def rearrange_playlist(playlist_name: str = Form(...), song_ids: str = Form(...)):
+    """Bulk reorder: rewrite every listed song's position in one transaction."""
     song_ids = [int(id) for id in song_ids.split(",")]
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    for position, song_id in enumerate(song_ids):
-        c.execute("UPDATE songs SET position = ? WHERE id = ? AND playlist = ?", (position, song_id, playlist_name))
-    conn.commit()
-    conn.close()
-    logger.debug(f"Rearranged playlist {playlist_name}")
+    await db.executemany("UPDATE songs SET position = ? WHERE id = ? AND playlist = ?",
+                         [(position * db.POSITION_GAP, song_id, playlist_name)
+                          for position, song_id in enumerate(song_ids)])
+    snapshot_cache.invalidate()
+    logger.debug("Rearranged playlist %s", playlist_name)
     return {"message": f"Rearranged playlist {playlist_name}"}
 
-@app.get("/search_youtube")
+@router.post("/move_song")
+async def move_song(song_id: int = Form(...), after_id: Optional[int] = Form(None)):
+    """Move one song right after ``after_id`` in its playlist (to the front when omitted)."""
+    try:
+        position, compacted = await db.run(db.move_song, song_id, after_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    snapshot_cache.invalidate()
+    logger.debug("Moved song %s after %s (compacted=%s)", song_id, after_id, compacted)
+    return {"id": song_id, "position": position, "compacted": compacted}
+
+QUEUE_PAGE_MAX = 500
+
+async def _current_user_id(request: Request) -> Optional[int]:
+    user = await auth.get_session_user(request.cookies.get(auth.SESSION_COOKIE))
+    return user.id if user else None
+
+@router.post("/queue")
+async def create_queue(request: Request, playlists: List[str] = Form([]), song_ids: Optional[str] = Form(None),
+                       top: int = Form(0), shuffle: bool = Form(True), start_song_id: Optional[int] = Form(None)):
+    """Build a play queue on the server and return its id.
+
+    The queue covers ``song_ids`` (comma-separated), else the given
+    ``playlists``, else the ``top`` most played playlists, else the whole
+    library. Pull songs from it with /queue/next.
+    """
+    ids = []
+    if song_ids:
+        try:
+            ids = [int(song_id) for song_id in song_ids.split(",") if song_id.strip()]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="song_ids must be comma-separated integers")
+        if len(ids) > SONGS_PAGE_MAX:
+            raise HTTPException(status_code=400, detail=f"At most {SONGS_PAGE_MAX} song_ids")
+    user_id = await _current_user_id(request)
+
+    def _build(conn):
+        names = playlists
+        if not ids and not names and top > 0:
+            names = [name for name, _ in playqueue.top_playlists(conn, top)]
+        return playqueue.build_queue(conn, names, ids, shuffle, start_song_id, user_id)
+
+    queue_id, length = await db.run(_build)
+    return {"queue_id": queue_id, "length": length}
+
+@router.post("/queue/next")
+async def queue_next(queue_id: str = Form(...), count: int = Form(1)):
+    """Pop the next ``count`` songs off a queue."""
+    count = max(1, min(count, QUEUE_PAGE_MAX))
+    try:
+        songs, remaining = await db.run(playqueue.next_songs, queue_id, count)
+    except playqueue.QueueNotFound:
+        raise HTTPException(status_code=404, detail="Queue not found")
+    return {"queue_id": queue_id, "songs": songs, "remaining": remaining}
+
+@router.get("/queue/{queue_id}")
+async def get_queue(queue_id: str, offset: int = 0, limit: int = 100):
+    """Read part of a queue without advancing it."""
+    limit = max(1, min(limit, QUEUE_PAGE_MAX))
+    try:
+        return await db.read(playqueue.peek, queue_id, max(0, offset), limit)
+    except playqueue.QueueNotFound:
+        raise HTTPException(status_code=404, detail="Queue not found")
+
+@router.post("/plays")
+async def record_play(request: Request, song_id: int = Form(...), event: str = Form("play")):
+    """Append a play, complete or skip event to the play history."""
+    if event not in playqueue.EVENTS:
+        raise HTTPException(status_code=400, detail=f"event must be one of {', '.join(playqueue.EVENTS)}")
+    await db.run(playqueue.record_event, song_id, event, await _current_user_id(request))
+    return {"success": True}
+
+@router.get("/stats/top_playlists")
+async def get_top_playlists(count: int = 2):
+    rows = await db.read(playqueue.top_playlists, max(1, min(count, 100)))
+    return {"playlists": [{"name": name, "plays": plays} for name, plays in rows]}
+
+@router.post("/reindex", status_code=202)
+async def reindex():
+    if not coordinator.leader:
+        # The worker holding the lease picks this up within a second
+        await db.run(workers.request_run, workers.INDEXER_LEASE)
+        return {"started": False, "requested": True, "progress": await _index_progress()}
+    started = library_indexer.start()
+    if not started:
+        logger.debug("Reindex requested while a run is already in progress")
+    return {"started": started, "progress": library_indexer.progress.to_dict()}
+
+@router.get("/reindex")
+async def reindex_status():
+    progress = await _index_progress()
+    return {"running": progress.get("state") == "running", "progress": progress}
+
+async def _index_progress() -> dict:
+    """Progress of the current or last index run, wherever the indexer runs."""
+    if coordinator.leader:
+        return library_indexer.progress.to_dict()
+    return await db.read(workers.read_status, workers.INDEXER_LEASE) or {}
+
+_ready = False
+
+@router.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and its event loop is answering."""
+    return {"status": "ok"}
+
+@router.get("/readyz")
+async def readyz():
+    """Readiness: the library has been indexed since the indexer started.
+
+    Until then requests are served from what the database already holds;
+    this is for deployments that want to wait for a current library.
+    """
+    global _ready
+    if not _ready:
+        progress = await _index_progress()
+        # A failed run still leaves the database as usable as it was
+        _ready = progress.get("state") in ("done", "failed")
+        if not _ready:
+            return JSONResponse(status_code=503, content={"status": "indexing", "progress": progress})
+    return {"status": "ready"}
+
+@router.get("/metrics")
+async def get_metrics():
+    """Prometheus text exposition of request, database, yt_dlp and cache metrics."""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@router.get("/search_youtube")
 async def search_youtube(query: str):
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'quiet': True,
-        'default_search': 'ytsearch10',
-    }
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            result = ydl.extract_info(f"ytsearch10:{query}", download=False)
-            videos = result.get('entries', [])
-            logger.debug(f"YouTube search returned {len(videos)} results for query: {query}")
-            return {
-                "results": [{"title": v['title'], "url": v['webpage_url'], "artist": v.get('uploader', 'Unknown')} for v in videos]
-            }
+        results = await youtube_search.search(query)
     except Exception as e:
         logger.error(f"Failed to search YouTube: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to search YouTube: {str(e)}")
+    return {"results": results}
 
-@app.post("/upload_lyrics")
+@router.post("/upload_lyrics")
 async def upload_lyrics(request: Request, song_id: int = Form(...), lyrics_file: UploadFile = File(...)):
     """Handle lyrics file upload and store them in the database."""
     # Verify user session
-    username = request.cookies.get("session_username")
-    if not username or username not in users:
+    if not await auth.get_session_user(request.cookies.get(auth.SESSION_COOKIE)):
         logger.warning("Unauthorized lyrics upload attempt")
         raise HTTPException(status_code=401, detail="Unauthorized")
 
@@ -510,29 +909,54 @@ async def upload_lyrics(request: Request, song_id: int = Form(...), lyrics_file:
         logger.warning(f"Empty lyrics file uploaded for song_id {song_id}")
         return JSONResponse(status_code=400, content={"success": False, "message": "Lyrics file cannot be empty"})
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id FROM songs WHERE id = ?", (song_id,))
-    if not c.fetchone():
-        conn.close()
+    if not await db.fetchone("SELECT id FROM songs WHERE id = ?", (song_id,)):
         logger.warning(f"Song with id {song_id} not found")
         raise HTTPException(status_code=404, detail="Song not found")
 
-    # Parse the lyrics (support .lrc format or plain text)
-    parsed_lyrics = parse_lyrics(lyrics_text)
-    lyrics_json = json.dumps(parsed_lyrics)  # Store as JSON for flexibility
+    # Parse the lyrics (.lrc format) into the compact stored form
+    parsed_lyrics = lyrics.parse_lyrics(lyrics_text)
 
-    c.execute("UPDATE songs SET lyrics_text = ? WHERE id = ?", (lyrics_json, song_id))
-    conn.commit()
-    conn.close()
-    logger.debug(f"Updated lyrics for song_id {song_id} from uploaded file")
+    await db.execute("UPDATE songs SET lyrics_text = ? WHERE id = ?", (parsed_lyrics.encode(), song_id))
+    lyrics_cache.put(song_id, parsed_lyrics)
+    snapshot_cache.invalidate()
+    logger.debug("Updated lyrics for song_id %s from uploaded file", song_id)
 
     return JSONResponse({
         "success": True,
         "message": "Lyrics uploaded successfully",
-        "lyrics": parsed_lyrics
+        "lyrics": parsed_lyrics.to_client()
     })
 
+def create_app() -> FastAPI:
+    """Build the ASGI app; uvicorn and gunicorn workers each call this once.
+
+    There is no module-level app: serve with ``uvicorn --factory
+    main:create_app`` (or ``python main.py``), and call this in tests.
+    """
+    metrics.register_collector(_collect_metrics)
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # Allow all origins for testing (restrict in production)
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.add_middleware(metrics.MetricsMiddleware)
+    # Directories are created by setup(), which runs before the first request
+    app.mount("/static", StaticFiles(directory="static"), name="static")
+    app.mount("/music", streaming.CachedStaticFiles(directory=MUSIC_DIR, check_dir=False), name="music")
+    app.mount("/images", images.ImmutableStaticFiles(directory=IMAGES_DIR, check_dir=False), name="images")
+    app.include_router(router)
+    return app
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host=" 192.168.2.21", port=8000, reload=True, log_level="debug")
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve echo with one worker process per core.")
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=workers.default_workers())
+    args = parser.parse_args()
+    setup()
+    workers.serve("main:create_app", args.host, args.port, args.workers, log_level=os.environ.get("LOG_LEVEL", "info").lower())
\ No newline at end of file
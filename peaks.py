@@ -0,0 +1,223 @@
+"""Waveform peaks for the player's seek bar.
+
+Each track is decoded once by the local ffmpeg to 8 kHz mono PCM and
+reduced to PEAK_COUNT peak levels (one byte each, 0-255), stored as a BLOB
+in ``song_peaks`` along with the mtime and size of the file they were
+computed from. /song/{id}/peaks serves them downsampled to the resolution
+the client asks for, a few hundred bytes per track.
+
+PeakAnalyzer fills the table in a background thread after each library
+index, only touching songs that have no peaks yet or whose file changed.
+Songs requested before it gets to them are queued on its own small thread
+pool with ``submit``, so waiting for a decode never ties up the server's
+thread pool.
+"""
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import db
+from metrics import FILE_IO_SECONDS
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 8000
+BLOCK = 256  # samples per block peak, ~32 ms at SAMPLE_RATE
+READ_SIZE = BLOCK * 2 * 64  # bytes of s16le PCM per read, a whole number of blocks
+PEAK_COUNT = 2048  # stored resolution, and the most a client can ask for
+MIN_RESOLUTION = 16
+DEFAULT_RESOLUTION = 512
+MAX_CONCURRENT = max(1, (os.cpu_count() or 2) // 2)
+MAX_QUEUED_REQUESTS = 64  # on-demand analyses waiting; past this, requests are left to the background pass
+
+
+def _block_peaks(ffmpeg: str, path: Path) -> array:
+    """Absolute peak of every BLOCK samples of the decoded track."""
+    process = subprocess.Popen(
+        [ffmpeg, "-nostdin", "-v", "error", "-i", str(path), "-vn", "-ac", "1", "-ar", str(SAMPLE_RATE),
+         "-f", "s16le", "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    blocks = array("H")
+    try:
+        while True:
+            chunk = process.stdout.read(READ_SIZE)
+            if not chunk:
+                break
+            samples = array("h")
+            samples.frombytes(chunk[:len(chunk) - len(chunk) % 2])
+            if sys.byteorder == "big":
+                samples.byteswap()
+            for start in range(0, len(samples), BLOCK):
+                block = samples[start:start + BLOCK]
+                blocks.append(max(max(block), -min(block)))
+        stderr = process.stderr.read()
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace').strip()}")
+    return blocks
+
+
+def reduce_peaks(values, count: int) -> bytes:
+    """Group ``values`` into ``count`` buckets, keep each bucket's maximum and scale to 0-255."""
+    n = len(values)
+    if not n:
+        return bytes(count)
+    reduced = []
+    for i in range(count):
+        lo = i * n // count
+        hi = max(lo + 1, (i + 1) * n // count)
+        reduced.append(max(values[lo:hi]))
+    top = max(reduced) or 1
+    return bytes(round(value * 255 / top) for value in reduced)
+
+
+def compute_peaks(ffmpeg: str, path: Path, count: int = PEAK_COUNT) -> bytes:
+    """Decode ``path`` and return ``count`` peak levels, normalised to the track's loudest."""
+    return reduce_peaks(_block_peaks(ffmpeg, path), count)
+
+
+def downsample(peaks: bytes, resolution: int) -> bytes:
+    if resolution >= len(peaks):
+        return peaks
+    n = len(peaks)
+    return bytes(max(peaks[i * n // resolution:(i + 1) * n // resolution]) for i in range(resolution))
+
+
+def pending(conn) -> List[Tuple[int, str, float, int]]:
+    """(id, filename, mtime, size) of songs with no peaks computed from their current file."""
+    return conn.execute(
+        """SELECT s.id, s.filename, s.mtime, s.size FROM songs s LEFT JOIN song_peaks p ON p.song_id = s.id
+           WHERE p.song_id IS NULL OR p.mtime IS NOT s.mtime OR p.size IS NOT s.size
+           ORDER BY s.id""").fetchall()
+
+
+class PeakAnalyzer:
+    """Computes and stores peaks in the background; see the module docstring.
+
+    A failed decode is stored as NULL peaks so the song is not retried until
+    its file changes.
+    """
+
+    def __init__(self, music_dir: Path, ffmpeg: Optional[str] = None, concurrency: int = MAX_CONCURRENT):
+        self.music_dir = music_dir
+        self.ffmpeg = ffmpeg or shutil.which("ffmpeg")
+        self.concurrency = concurrency
+        self.analyzed = 0
+        self.failed = 0
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._requests: Optional[ThreadPoolExecutor] = None
+        self._requested: Dict[int, Future] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._again = False
+        self._stopping = threading.Event()
+        if not self.ffmpeg:
+            logger.warning("ffmpeg not found, waveform peaks are disabled")
+
+    @property
+    def available(self) -> bool:
+        return self.ffmpeg is not None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> bool:
+        """Process pending songs in the background; a running pass goes round once more instead."""
+        if not self.available:
+            return False
+        with self._lock:
+            if self.running:
+                self._again = True
+                return False
+            self._again = False
+            self._thread = threading.Thread(target=self._run, name="peak-analyzer", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stopping.set()
+        with self._lock:
+            if self._requests is not None:
+                self._requests.shutdown(wait=False, cancel_futures=True)
+                self._requests = None
+
+    def submit(self, song_id: int, filename: str, mtime: float, size: int) -> Optional[Future]:
+        """Queue ``analyze`` for one song; a request for a song already queued shares its future.
+
+        Returns None when MAX_QUEUED_REQUESTS are already waiting.
+        """
+        with self._lock:
+            future = self._requested.get(song_id)
+            if future is not None:
+                return future
+            if len(self._requested) >= MAX_QUEUED_REQUESTS or self._stopping.is_set():
+                return None
+            if self._requests is None:
+                self._requests = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="peaks-request")
+            future = self._requests.submit(self.analyze, song_id, filename, mtime, size)
+            self._requested[song_id] = future
+        future.add_done_callback(lambda _: self._forget(song_id, future))
+        return future
+
+    def _forget(self, song_id: int, future: Future):
+        with self._lock:
+            if self._requested.get(song_id) is future:
+                del self._requested[song_id]
+
+    def wait(self, timeout: Optional[float] = None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def analyze(self, song_id: int, filename: str, mtime: float, size: int) -> Optional[bytes]:
+        """Compute and store one song's peaks; blocking. Returns None if decoding failed."""
+        with self._slots:
+            try:
+                with FILE_IO_SECONDS.time(op="peaks"):
+                    peaks = compute_peaks(self.ffmpeg, self.music_dir / filename)
+                self.analyzed += 1
+            except Exception as e:
+                logger.warning(f"Computing peaks for song {song_id} failed: {e}")
+                peaks = None
+                self.failed += 1
+        with db.transaction() as conn:
+            # The song may have been deleted meanwhile; only store for an existing row
+            conn.execute(
+                """INSERT INTO song_peaks (song_id, mtime, size, peaks) SELECT id, ?, ?, ? FROM songs WHERE id = ?
+                   ON CONFLICT (song_id) DO UPDATE SET mtime = excluded.mtime, size = excluded.size,
+                       peaks = excluded.peaks""",
+                (mtime, size, peaks, song_id))
+        return peaks
+
+    def _analyze_pending(self, song: Tuple[int, str, float, int]):
+        if self._stopping.is_set():
+            return
+        try:
+            self.analyze(*song)
+        except Exception as e:
+            logger.error(f"Storing peaks for song {song[0]} failed: {e}")
+
+    def _run(self):
+        while not self._stopping.is_set():
+            with db.connection() as conn:
+                songs = pending(conn)
+            if songs:
+                logger.info(f"Computing waveform peaks for {len(songs)} songs")
+                with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="peaks") as executor:
+                    executor.map(self._analyze_pending, songs)
+            with self._lock:
+                if not self._again:
+                    self._thread = None
+                    return
+                self._again = False
@@ -0,0 +1,158 @@
+"""Server-side play queues, artist-interleaved shuffle and play history.
+
+Play events are appended to ``play_events``; a trigger folds each one into
+the per-song counters in ``song_stats`` so "most played" questions never
+scan the history. A queue is a precomputed song order stored in
+``queue_items`` with a cursor in ``queues``, so clients can pull the next
+songs a few at a time instead of loading the whole library to decide what
+plays next.
+"""
+import logging
+import random
+import secrets
+import sqlite3
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+EVENTS = ("play", "complete", "skip")
+QUEUE_TTL = 7 * 24 * 3600  # seconds since last use before a queue is dropped
+JITTER = 0.1  # fraction of an artist's spacing a song may drift, so rotations don't repeat
+
+# Same fields and order as the default /songs projection
+SONG_COLUMNS = ("s.id, s.title, s.artist, s.playlist, s.position, s.lyrics_text IS NOT NULL, "
+                "s.album, s.duration, s.bitrate")
+
+
+class QueueNotFound(Exception):
+    pass
+
+
+def song_dict(row: Sequence) -> dict:
+    song_id, title, artist, playlist, position, has_lyrics, album, duration, bitrate = row
+    return {"id": song_id, "title": title, "artist": artist, "url": f"/song/{song_id}",
+            "playlist": playlist, "position": position, "has_lyrics": bool(has_lyrics),
+            "album": album, "duration": duration, "bitrate": bitrate}
+
+
+def interleave_artists(songs: Sequence[Tuple[int, str]], rng: Optional[random.Random] = None) -> List[int]:
+    """Shuffle (song id, artist) pairs so each artist's songs are spread evenly.
+
+    Every artist with k songs gets positions about 1/k apart in [0, 1)
+    from a random start, plus a little jitter; the positions are then
+    bucket-sorted into n buckets. That is expected O(n), unlike sorting
+    or repeatedly picking a random artist.
+    """
+    rng = rng or random.Random()
+    n = len(songs)
+    if n < 2:
+        return [song_id for song_id, _ in songs]
+    groups: Dict[str, List[int]] = {}
+    for song_id, artist in songs:
+        groups.setdefault((artist or "").strip().lower(), []).append(song_id)
+    buckets: List[List[Tuple[float, int]]] = [[] for _ in range(n)]
+    for ids in groups.values():
+        rng.shuffle(ids)
+        step = 1.0 / len(ids)
+        start = rng.random() * step
+        for i, song_id in enumerate(ids):
+            position = start + (i + rng.uniform(-JITTER, JITTER)) * step
+            position = min(max(position, 0.0), 1.0 - 1e-9)
+            buckets[int(position * n)].append((position, song_id))
+    order = []
+    for bucket in buckets:
+        if len(bucket) > 1:
+            bucket.sort()
+        order.extend(song_id for _, song_id in bucket)
+    return order
+
+
+def record_event(conn: sqlite3.Connection, song_id: int, event: str, user_id: Optional[int] = None):
+    if event not in EVENTS:
+        raise ValueError(f"Unknown play event {event!r}")
+    conn.execute("INSERT INTO play_events (song_id, user_id, event, created_at) VALUES (?, ?, ?, ?)",
+                 (song_id, user_id, event, time.time()))
+
+
+def top_playlists(conn: sqlite3.Connection, count: int = 2) -> List[Tuple[str, int]]:
+    """The most played playlists as (name, plays), from the aggregated counters."""
+    return conn.execute(
+        """SELECT s.playlist, SUM(st.plays) AS plays FROM song_stats st JOIN songs s ON s.id = st.song_id
+           GROUP BY s.playlist HAVING plays > 0 ORDER BY plays DESC, s.playlist LIMIT ?""", (count,)).fetchall()
+
+
+def build_queue(conn: sqlite3.Connection, playlists: Sequence[str] = (), song_ids: Sequence[int] = (),
+                shuffle: bool = True, start_song_id: Optional[int] = None, user_id: Optional[int] = None,
+                rng: Optional[random.Random] = None) -> Tuple[str, int]:
+    """Create a queue over ``song_ids`` or ``playlists`` (the whole library if neither).
+
+    ``start_song_id``, if it is part of the selection, plays first.
+    Returns (queue id, length).
+    """
+    if song_ids:
+        placeholders = ", ".join("?" * len(song_ids))
+        rows = conn.execute(f"SELECT id, artist FROM songs WHERE id IN ({placeholders})", list(song_ids)).fetchall()
+        found = dict(rows)
+        rows = [(song_id, found[song_id]) for song_id in dict.fromkeys(song_ids) if song_id in found]
+    elif playlists:
+        placeholders = ", ".join("?" * len(playlists))
+        rows = conn.execute(f"SELECT id, artist FROM songs WHERE playlist IN ({placeholders}) "
+                            f"ORDER BY playlist, position, id", list(playlists)).fetchall()
+    else:
+        rows = conn.execute("SELECT id, artist FROM songs ORDER BY playlist, position, id").fetchall()
+
+    if start_song_id is not None and any(song_id == start_song_id for song_id, _ in rows):
+        rows = [row for row in rows if row[0] != start_song_id]
+    else:
+        start_song_id = None
+    order = interleave_artists(rows, rng) if shuffle else [song_id for song_id, _ in rows]
+    if start_song_id is not None:
+        order.insert(0, start_song_id)
+
+    now = time.time()
+    queue_id = secrets.token_urlsafe(12)
+    conn.execute("DELETE FROM queues WHERE updated_at < ?", (now - QUEUE_TTL,))
+    conn.execute("INSERT INTO queues (id, user_id, cursor, length, created_at, updated_at) VALUES (?, ?, 0, ?, ?, ?)",
+                 (queue_id, user_id, len(order), now, now))
+    conn.executemany("INSERT INTO queue_items (queue_id, idx, song_id) VALUES (?, ?, ?)",
+                     [(queue_id, idx, song_id) for idx, song_id in enumerate(order)])
+    logger.debug("Built queue %s with %s songs (shuffle=%s)", queue_id, len(order), shuffle)
+    return queue_id, len(order)
+
+
+def _queue_row(conn: sqlite3.Connection, queue_id: str) -> Tuple[int, int]:
+    row = conn.execute("SELECT cursor, length FROM queues WHERE id = ?", (queue_id,)).fetchone()
+    if not row:
+        raise QueueNotFound(queue_id)
+    return row
+
+
+def _items(conn: sqlite3.Connection, queue_id: str, offset: int, limit: int) -> List[tuple]:
+    # Songs deleted since the queue was built simply drop out of the join
+    return conn.execute(
+        f"""SELECT q.idx, {SONG_COLUMNS} FROM queue_items q JOIN songs s ON s.id = q.song_id
+            WHERE q.queue_id = ? AND q.idx >= ? ORDER BY q.idx LIMIT ?""", (queue_id, offset, limit)).fetchall()
+
+
+def next_songs(conn: sqlite3.Connection, queue_id: str, count: int = 1) -> Tuple[List[dict], int]:
+    """Pop the next ``count`` songs and advance the cursor; returns (songs, remaining)."""
+    cursor, length = _queue_row(conn, queue_id)
+    rows = _items(conn, queue_id, cursor, count)
+    cursor = rows[-1][0] + 1 if rows else length
+    conn.execute("UPDATE queues SET cursor = ?, updated_at = ? WHERE id = ?", (cursor, time.time(), queue_id))
+    return [song_dict(row[1:]) for row in rows], length - cursor
+
+
+def peek(conn: sqlite3.Connection, queue_id: str, offset: int = 0, limit: int = 100) -> dict:
+    """A slice of the queue by position, without moving the cursor."""
+    cursor, length = _queue_row(conn, queue_id)
+    rows = _items(conn, queue_id, offset, limit)
+    next_offset = rows[-1][0] + 1 if rows else length
+    return {
+        "queue_id": queue_id,
+        "cursor": cursor,
+        "length": length,
+        "songs": [song_dict(row[1:]) for row in rows],
+        "next_offset": next_offset if next_offset < length else None,
+    }
@@ -0,0 +1,44 @@
+"""Single-flight: callers asking for the same key while it is being worked on share one run.
+
+Used by the YouTube search service and the transcoder, where the work
+(an extraction, an ffmpeg run) is expensive and duplicate requests tend to
+arrive together.
+"""
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Runs ``fn`` once per key at a time; ``coalesced`` counts callers that waited on another's run.
+
+    Waiters are shielded: a waiter being cancelled doesn't cancel the run,
+    while the leading caller being cancelled cancels it for everyone.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await fn()
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved so an unawaited failure isn't logged twice
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if not future.done():  # the leading caller was cancelled
+                future.cancel()
+            del self._inflight[key]
@@ -0,0 +1,174 @@
+"""Serialized response snapshots for hot, rarely changing GET endpoints.
+
+A snapshot is the JSON body of one request (path plus query string) along
+with gzip and, if the brotli package is installed, brotli copies and a
+strong ETag over the body. Snapshots are tagged with the library version
+they were built at: a local generation that write paths bump through
+``invalidate()``, plus the change log version that ChangeFeed follows,
+so writes from other processes are picked up too. While the version is
+unchanged a repeat request is answered from memory, and a matching
+If-None-Match gets a 304 without touching the database.
+"""
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the install
+    brotli = None
+
+MAX_ENTRIES = 256
+MAX_BYTES = 64 * 1024 ** 2  # across all bodies and their compressed copies
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+THREAD_THRESHOLD = 256 * 1024  # bodies this large are compressed off the event loop
+CACHE_CONTROL = "no-cache"  # always revalidate; the ETag makes that a 304
+
+Version = Tuple[int, int]
+
+
+@dataclass
+class Snapshot:
+    version: Version
+    etag: str
+    media_type: str
+    bodies: Dict[str, bytes]  # content coding ("identity", "gzip", "br") -> body
+
+    @property
+    def size(self) -> int:
+        return sum(len(body) for body in self.bodies.values())
+
+
+def _compress(body: bytes) -> Dict[str, bytes]:
+    bodies = {"identity": body}
+    if len(body) >= MIN_COMPRESS_SIZE:
+        bodies["gzip"] = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+        if brotli is not None:
+            bodies["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+    return bodies
+
+
+def _accepted_codings(request: Request) -> Dict[str, float]:
+    codings = {}
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        codings[name.strip().lower()] = q
+    return codings
+
+
+def choose_coding(request: Request, available) -> str:
+    """The best content coding of ``available`` the client accepts, preferring br over gzip."""
+    accepted = _accepted_codings(request)
+    for coding in ("br", "gzip"):
+        if coding in available and accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    return "identity"
+
+
+class SnapshotCache:
+    """LRU of Snapshots by request key; see the module docstring.
+
+    ``external_version`` returns a version maintained elsewhere (the change
+    log), checked on every lookup without I/O.
+    """
+
+    def __init__(self, external_version: Callable[[], int] = lambda: 0,
+                 max_entries: int = MAX_ENTRIES, max_bytes: int = MAX_BYTES):
+        self.external_version = external_version
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self._generation = 0
+        self._entries: "OrderedDict[str, Snapshot]" = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> Version:
+        return self._generation, self.external_version()
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total
+
+    def invalidate(self):
+        """Bump the local generation and drop every snapshot; call after library writes."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._total = 0
+
+    def _get(self, key: str, version: Version) -> Optional[Snapshot]:
+        with self._lock:
+            snapshot = self._entries.get(key)
+            if snapshot is None:
+                return None
+            if snapshot.version != version:
+                self._total -= self._entries.pop(key).size
+                return None
+            self._entries.move_to_end(key)
+            return snapshot
+
+    def _put(self, key: str, snapshot: Snapshot):
+        with self._lock:
+            if snapshot.version != self.version or snapshot.size > self.max_bytes:
+                return  # invalidated while it was being built
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total -= old.size
+            self._entries[key] = snapshot
+            self._total += snapshot.size
+            while self._entries and (len(self._entries) > self.max_entries or self._total > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._total -= evicted.size
+
+    async def respond(self, request: Request, build: Callable[[], Awaitable[bytes]],
+                      media_type: str = "application/json") -> Response:
+        """Serve ``request`` from its snapshot, calling ``build`` for the body on a miss."""
+        key = request.url.path + "?" + request.url.query
+        version = self.version
+        snapshot = self._get(key, version)
+        if snapshot is None:
+            self.misses += 1
+            body = await build()
+            if len(body) >= THREAD_THRESHOLD:
+                bodies = await run_in_threadpool(_compress, body)
+            else:
+                bodies = _compress(body)
+            etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+            snapshot = Snapshot(version, etag, media_type, bodies)
+            self._put(key, snapshot)
+        else:
+            self.hits += 1
+
+        coding = choose_coding(request, snapshot.bodies)
+        # Each coding is its own representation, so it gets its own strong validator
+        etag = snapshot.etag if coding == "identity" else f'{snapshot.etag[:-1]}-{coding}"'
+        headers = {"etag": etag, "cache-control": CACHE_CONTROL, "vary": "Accept-Encoding"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        if coding != "identity":
+            headers["content-encoding"] = coding
+        return Response(snapshot.bodies[coding], media_type=snapshot.media_type, headers=headers)
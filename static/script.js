@@ -9,8 +9,19 @@ let playlists = [];
 let selectedPlaylist = null;
 let isShuffling = false;
 let originalQueue = [];
-let history = {};
-let lyricsData = {}; // Store lyrics by song ID
+let lyricsData = {}; // Store lyrics by song ID as { times: [seconds], lines: [text] }
+let pendingLyrics = new Set(); // Song IDs with a lyrics request in flight
+let waveforms = {}; // Waveform image (data URL, or null if unavailable) by song ID
+let libraryVersion = null; // Change log version allSongs and playlists reflect
+let changeStream = null;
+let shuffleQueueId = null; // Server queue the shuffled songQueue is pulled from in batches
+let shuffleRemaining = 0; // Songs still left on that queue
+let shuffleRefill = null; // Pending /queue/next request
+const WAVEFORM_RESOLUTION = 256;
+const WAVEFORM_RETRIES = 5;
+const SONGS_PAGE_SIZE = 1000;
+const QUEUE_BATCH_SIZE = 50;
+const QUEUE_REFILL_AHEAD = 3; // Fetch the next batch once this few songs are left to play
 
 function initAudioPlayer() {
     console.log("initAudioPlayer called");
@@ -21,12 +32,14 @@ function initAudioPlayer() {
     }
     audioPlayer.addEventListener('ended', () => {
         console.log("Audio ended event triggered");
-        if (songQueue.length > 0 && currentSongIndex + 1 < songQueue.length) {
+        if (currentSong) recordPlayEvent(currentSong.id, 'complete');
+        // A shuffled batch can run out before the next one has arrived; playNext waits for it
+        const more = currentSongIndex + 1 < songQueue.length || (isShuffling && shuffleQueueId && shuffleRemaining > 0);
+        if (songQueue.length > 0 && more) {
             playNext();
         } else {
             stopPlayer();
         }
-        updateHistory();
     });
     audioPlayer.addEventListener('error', (e) => {
         console.error("Audio playback error:", e);
@@ -70,7 +83,7 @@ function attachControlPanelListeners() {
 
     if (previousBtn) previousBtn.addEventListener('click', playPrevious);
     if (playPauseBtn) playPauseBtn.addEventListener('click', togglePlayPause);
-    if (nextBtn) nextBtn.addEventListener('click', playNext);
+    if (nextBtn) nextBtn.addEventListener('click', skipSong);
     if (shuffleBtn) shuffleBtn.addEventListener('click', toggleShuffle);
     if (progress) {
         progress.addEventListener('input', seek);
@@ -90,9 +103,61 @@ function updateProgress() {
         progress.value = percent;
         currentTime.textContent = formatTime(current);
         duration.textContent = formatTime(songDuration);
+        applyWaveform(progress);
     }
 }
 
+// Draw the song's waveform behind the progress bar from /song/{id}/peaks
+function applyWaveform(progress) {
+    const song = currentSong || songQueue[currentSongIndex];
+    if (!song) return;
+    if (waveforms[song.id] === undefined) {
+        waveforms[song.id] = null;
+        fetchWaveform(song.id);
+        return;
+    }
+    const image = waveforms[song.id] ? `url(${waveforms[song.id]})` : 'none';
+    if (progress.dataset.waveform !== image) {
+        progress.dataset.waveform = image;
+        progress.style.backgroundImage = image;
+        progress.style.backgroundSize = '100% 100%';
+    }
+}
+
+async function fetchWaveform(songId, attempt = 0) {
+    try {
+        const response = await fetch(`/song/${songId}/peaks?resolution=${WAVEFORM_RESOLUTION}`, { credentials: 'include' });
+        if (response.status === 202) {
+            // Still being analyzed; ask again when the server suggests
+            if (attempt < WAVEFORM_RETRIES) {
+                const delay = (parseInt(response.headers.get('retry-after'), 10) || 3) * 1000;
+                setTimeout(() => fetchWaveform(songId, attempt + 1), delay);
+            }
+            return;
+        }
+        if (!response.ok) return;
+        const levels = new Uint8Array(await response.arrayBuffer());
+        const canvas = document.createElement('canvas');
+        canvas.width = levels.length;
+        canvas.height = 32;
+        const context = canvas.getContext('2d');
+        context.fillStyle = 'rgba(204, 204, 204, 0.35)';
+        levels.forEach((level, x) => {
+            const height = Math.max(1, (level / 255) * canvas.height);
+            context.fillRect(x, (canvas.height - height) / 2, 1, height);
+        });
+        waveforms[songId] = canvas.toDataURL();
+        updateProgress();
+    } catch (error) {
+        console.error("Error fetching waveform for song", songId, ":", error);
+    }
+}
+
+// Track length from the indexed tags, so lists don't have to load the audio
+function songDurationHtml(song) {
+    return song.duration ? `<m class="song-duration">${formatTime(song.duration)}</m>` : '';
+}
+
 function formatTime(seconds) {
     if (isNaN(seconds) || seconds < 0) return "0:00";
     const mins = Math.floor(seconds / 60);
@@ -137,9 +202,10 @@ async function playSong(songId) {
     currentSongIndex = playlistSongs.findIndex(s => s.id === song.id);
     currentSong = song; // Store the current song
     if (isShuffling) {
-        songQueue = smartShuffle(playlistSongs, song);
+        songQueue = await smartShuffle({ playlists: [song.playlist] }, song);
         currentSongIndex = songQueue.findIndex(s => s.id === song.id);
     }
+    recordPlayEvent(song.id, 'play');
     console.log("Setting audio src to:", song.url);
     audioPlayer.src = song.url;
     try {
@@ -176,15 +242,26 @@ function addToQueue(songId) {
     console.log("Queue after adding:", songQueue);
 }
 
-function playNext() {
+function skipSong() {
+    if (currentSong) recordPlayEvent(currentSong.id, 'skip');
+    playNext();
+}
+
+async function playNext() {
     console.log("playNext called");
     currentSongIndex++;
+    // The batch ran out before the prefetch came back (or it failed): wait, retrying once
+    for (let attempt = 0; attempt < 2 && currentSongIndex >= songQueue.length; attempt++) {
+        await refillShuffleQueue();
+    }
     if (currentSongIndex < songQueue.length) {
         const nextSong = songQueue[currentSongIndex];
         currentSong = nextSong; // Store the current song
+        recordPlayEvent(nextSong.id, 'play');
         audioPlayer.src = nextSong.url;
         audioPlayer.load();
         updatePlayerUI();
+        refillShuffleQueue();
         console.log("Next song:", nextSong, "Index:", currentSongIndex);
     } else {
         stopPlayer();
@@ -198,6 +275,7 @@ function playPrevious() {
     if (currentSongIndex >= 0) {
         const prevSong = songQueue[currentSongIndex];
         currentSong = prevSong; // Store the current song
+        recordPlayEvent(prevSong.id, 'play');
         audioPlayer.src = prevSong.url;
         audioPlayer.load();
         updatePlayerUI();
@@ -210,6 +288,7 @@ function stopPlayer() {
     audioPlayer.pause();
     audioPlayer.src = '';
     currentSong = null; // Clear the current song
+    shuffleQueueId = null;
     const playerInfo = document.getElementById('current-song-title');
     if (playerInfo) playerInfo.textContent = 'Select a song to play';
     songQueue = [];
@@ -223,6 +302,7 @@ function stopPlayer() {
 
 function clearQueue() {
     console.log("clearQueue called");
+    shuffleQueueId = null;
     songQueue = [];
     originalQueue = [];
     currentSongIndex = -1;
@@ -239,7 +319,7 @@ function togglePlayPause() {
     }
 }
 
-function toggleShuffle() {
+async function toggleShuffle() {
     console.log("toggleShuffle called");
     isShuffling = !isShuffling;
     const shuffleBtn = document.getElementById('shuffle-btn');
@@ -248,12 +328,13 @@ function toggleShuffle() {
     if (isShuffling) {
         if (songQueue.length > 0) {
             const currentSong = songQueue[currentSongIndex];
-            songQueue = smartShuffle(originalQueue, currentSong);
+            songQueue = await smartShuffle({ songIds: originalQueue.map(s => s.id) }, currentSong);
             currentSongIndex = songQueue.findIndex(s => s.id === currentSong.id);
         }
     } else {
         if (songQueue.length > 0) {
             const currentSong = songQueue[currentSongIndex];
+            shuffleQueueId = null;
             songQueue = [...originalQueue];
             currentSongIndex = songQueue.findIndex(s => s.id === currentSong.id);
         }
@@ -262,81 +343,81 @@ function toggleShuffle() {
     console.log("Shuffle toggled:", isShuffling, "Queue:", songQueue);
 }
 
-function randomInt(min, max) {
-    return Math.floor(Math.random() * (max - min + 1)) + min;
-}
-
-function smartShuffle(songs, currentSong = null) {
-    console.log("smartShuffle called with songs:", songs, "currentSong:", currentSong);
-    
-    if (songs.length === 0) return [];
-
-    let remainingSongs = songs.filter(song => song !== currentSong);
-    const artistGroups = new Map();
-    for (let song of remainingSongs) {
-        if (!artistGroups.has(song.artist)) {
-            artistGroups.set(song.artist, []);
-        }
-        artistGroups.get(song.artist).push(song);
-    }
-
-    let shuffled = [];
-    let artistList = Array.from(artistGroups.keys());
-    while (artistList.length > 0) {
-        const artistIndex = randomInt(0, artistList.length - 1);
-        const selectedArtist = artistList[artistIndex];
-        const artistSongs = artistGroups.get(selectedArtist);
-        const songIndex = randomInt(0, artistSongs.length - 1);
-        shuffled.push(artistSongs[songIndex]);
-        artistSongs.splice(songIndex, 1);
-        if (artistSongs.length === 0) {
-            artistList.splice(artistIndex, 1);
+// Shuffles are built server-side (artist-interleaved). This returns the first batch;
+// refillShuffleQueue appends the next one from /queue/next as playback nears the end.
+async function smartShuffle({ playlists = [], songIds = [] }, currentSong = null) {
+    console.log("smartShuffle called with:", playlists, songIds, "currentSong:", currentSong);
+    shuffleQueueId = null;
+    const body = new URLSearchParams();
+    playlists.forEach(name => body.append('playlists', name));
+    if (songIds.length) body.append('song_ids', songIds.join(','));
+    if (currentSong) body.append('start_song_id', currentSong.id);
+    try {
+        const response = await fetch('/queue', { method: 'POST', body });
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
         }
+        const { queue_id: queueId } = await response.json();
+        const batch = await fetchQueueBatch(queueId);
+        shuffleQueueId = queueId;
+        shuffleRemaining = batch.remaining;
+        return batch.songs;
+    } catch (error) {
+        console.error("Error building shuffled queue:", error);
+        const fallback = songIds.length
+            ? originalQueue
+            : allSongs.filter(s => playlists.includes(s.playlist));
+        return currentSong ? [currentSong, ...fallback.filter(s => s.id !== currentSong.id)] : [...fallback];
     }
-
-    if (currentSong) {
-        shuffled.unshift(currentSong);
-    }
-    return shuffled;
 }
 
-function shuffle(array) {
-    for (let i = array.length - 1; i > 0; i--) {
-        const j = randomInt(0, i);
-        [array[i], array[j]] = [array[j], array[i]];
+async function fetchQueueBatch(queueId) {
+    const body = new URLSearchParams({ queue_id: queueId, count: QUEUE_BATCH_SIZE });
+    const response = await fetch('/queue/next', { method: 'POST', body });
+    if (!response.ok) {
+        const error = new Error(`HTTP error! status: ${response.status}`);
+        error.status = response.status;
+        throw error;
     }
-    return array;
+    return response.json();
 }
 
-function getTopPlaylists(history, count = 2) {
-    const playlistCounts = {};
-    for (let songId in history) {
-        const song = allSongs.find(s => s.id === parseInt(songId));
-        if (song && song.playlist) {
-            playlistCounts[song.playlist] = (playlistCounts[song.playlist] || 0) + history[songId];
-        }
+// Appends the next batch of the shuffled queue once few songs are left; at most one request at a time.
+function refillShuffleQueue() {
+    if (shuffleRefill) return shuffleRefill;
+    const queueId = shuffleQueueId;
+    if (!isShuffling || !queueId || shuffleRemaining <= 0 || songQueue.length - currentSongIndex > QUEUE_REFILL_AHEAD) {
+        return Promise.resolve();
     }
-    return Object.entries(playlistCounts)
-        .sort((a, b) => b[1] - a[1])
-        .slice(0, count)
-        .map(entry => entry[0]);
+    shuffleRefill = fetchQueueBatch(queueId)
+        .then(batch => {
+            if (shuffleQueueId !== queueId) return; // The queue was replaced meanwhile
+            songQueue.push(...batch.songs);
+            shuffleRemaining = batch.remaining;
+        })
+        .catch(error => {
+            console.error("Error fetching the next queue batch:", error);
+            // Only a queue the server no longer has is given up; other failures are retried
+            if (error.status === 404 && shuffleQueueId === queueId) shuffleQueueId = null;
+        })
+        .finally(() => { shuffleRefill = null; });
+    return shuffleRefill;
 }
 
-function updateHistory() {
-    if (songQueue.length > 0 && currentSongIndex >= 0 && currentSongIndex < songQueue.length) {
-        const songId = songQueue[currentSongIndex].id;
-        history[songId] = (history[songId] || 0) + 1;
-    }
+function recordPlayEvent(songId, event) {
+    const body = new URLSearchParams({ song_id: songId, event });
+    fetch('/plays', { method: 'POST', body, credentials: 'include' })
+        .catch(error => console.error("Error recording play event:", error));
 }
 
-function playPlaylist(playlistName) {
+async function playPlaylist(playlistName) {
     console.log("playPlaylist called with:", playlistName);
     const playlistSongs = allSongs.filter(song => song.playlist === playlistName).sort((a, b) => a.position - b.position);
     songQueue = playlistSongs;
     originalQueue = [...playlistSongs];
     currentSongIndex = -1;
     if (isShuffling) {
-        songQueue = smartShuffle(playlistSongs);
+        songQueue = await smartShuffle({ playlists: [playlistName] });
         currentSongIndex = 0;
     }
     playNext();
@@ -406,12 +487,17 @@ function updatePlaylistImage(playlistId) {
                 body: formData
             })
             .then(response => {
-                if (!response.ok) throw new Error(`Image update failed: ${response.statusText}`);
+                if (!response.ok) {
+                    // 413/400 carry the reason (too large, not an image) in detail
+                    return response.json().catch(() => ({})).then(body => {
+                        throw new Error(`Image update failed: ${body.detail || response.statusText}`);
+                    });
+                }
                 return response.json();
             })
             .then(data => {
                 alert(data.message);
-                fetchPlaylists();
+                syncLibrary();
                 showMainView();
             })
             .catch(error => {
@@ -445,7 +531,7 @@ function renamePlaylist(playlistId, currentName) {
     })
     .then(data => {
         alert(data.message);
-        fetchPlaylists();
+        syncLibrary();
         if (selectedPlaylist === currentName) {
             selectedPlaylist = newName;
             showPlaylistSongs(newName);
@@ -502,6 +588,7 @@ function showPlaylistSongs(playlistName) {
                 <div class="song-item" draggable="true" data-id="${song.id}" data-song-id="${song.id}">
                     <i class="far fa-waveform"></i>
                     <span onclick="playSong(${song.id})" style="cursor: pointer;">${song.title} - ${song.artist}</span>
+                    ${songDurationHtml(song)}
                     <button onclick="addToQueue(${song.id})"><i class="fas fa-plus"></i></button>
                     <button onclick="deleteSong(${song.id})" class="delete-btn"><i class="fas fa-trash"></i></button>
                     <button onclick="uploadLyrics(${song.id})" class="upload-lyrics-btn"><i class="fas fa-file-upload"></i> Upload Lyrics</button>
@@ -563,7 +650,7 @@ function handleCreatePlaylist(event) {
     .then(response => response.json())
     .then(data => {
         alert(data.message);
-        fetchPlaylists();
+        syncLibrary();
         showMainView();
     })
     .catch(error => console.error('Error creating playlist:', error));
@@ -623,12 +710,31 @@ function handleAddSong(event) {
     .then(response => response.json())
     .then(data => {
         alert(data.message);
-        fetchSongs();
         showMainView();
+        if (data.job_id) {
+            waitForJob(data.job_id).then(job => {
+                if (job.status === 'failed') alert('Failed to add song: ' + job.error);
+                syncLibrary();
+            });
+        }
     })
     .catch(error => console.error('Error adding song:', error));
 }
 
+async function waitForJob(jobId, intervalMs = 2000) {
+    // Downloads run server-side in a job queue; poll until the job and its children finish
+    while (true) {
+        const response = await fetch(`/jobs/${jobId}`, { credentials: 'include' });
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        const job = await response.json();
+        console.log("Job", jobId, job.status, job.progress);
+        if (job.status === 'done' || job.status === 'failed') return job;
+        await new Promise(resolve => setTimeout(resolve, intervalMs));
+    }
+}
+
 function showPlaylistsView() {
     console.log("showPlaylistsView called");
     const contentArea = document.getElementById('content-area');
@@ -664,7 +770,7 @@ function showPlaylistsView() {
         <div class="playlist-grid" id="all-playlists-container">
             ${playlists.map(playlist => `
                 <div class="playlist-item" onclick="showPlaylistSongs('${playlist.name.replace(/'/g, "\\'")}')">
-                    <img src="${playlist.image}" alt="${playlist.name}">
+                    ${playlistImageHtml(playlist)}
                     <p>${playlist.name}</p>
                 </div>
             `).join('')}
@@ -817,6 +923,7 @@ function showQueueView() {
                 <div class="queue-item" draggable="true" data-id="${song.id}" data-index="${index}">
                     <i class="far fa-waveform"></i>
                     <span onclick="playSong(${song.id})" style="cursor: pointer;">${song.title} - ${song.artist}</span>
+                    ${songDurationHtml(song)}
                     <button onclick="removeFromQueue(${index})"><i class="fas fa-trash"></i></button>
                 </div>
             `).join('')}
@@ -850,7 +957,7 @@ function deletePlaylist(playlistId) {
     .then(data => {
         alert(data.message);
         selectedPlaylist = null;
-        fetchPlaylists();
+        syncLibrary();
         showMainView();
     })
     .catch(error => console.error("Error deleting playlist:", error));
@@ -867,7 +974,7 @@ function deleteSong(songId) {
     .then(response => response.json())
     .then(data => {
         alert(data.message);
-        fetchSongs();
+        syncLibrary();
         if (selectedPlaylist) showPlaylistSongs(selectedPlaylist);
     })
     .catch(error => console.error("Error deleting song:", error));
@@ -897,28 +1004,7 @@ function makeSortable() {
                 }));
 
                 if (container.id === 'songs-container' && selectedPlaylist) {
-                    const songIds = newOrder.map(item => parseInt(item.id));
-                    console.log("Reordering playlist:", selectedPlaylist, "New order:", songIds);
-                    fetch('/rearrange_playlist', {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
-                        body: `playlist_name=${encodeURIComponent(selectedPlaylist)}&song_ids=${songIds.join(',')}`
-                    })
-                    .then(response => {
-                        if (!response.ok) {
-                            throw new Error('Failed to rearrange playlist: ' + response.statusText);
-                        }
-                        return response.json();
-                    })
-                    .then(data => {
-                        console.log("Rearrange playlist success:", data.message);
-                        fetchSongs();
-                    })
-                    .catch(error => {
-                        console.error("Error rearranging playlist:", error);
-                        alert("Failed to rearrange playlist: " + error.message);
-                        showPlaylistSongs(selectedPlaylist);
-                    });
+                    if (evt.oldIndex !== evt.newIndex) moveSongItem(evt.item);
                 } else if (container.id === 'queue-container') {
                     songQueue = newOrder.map(item => 
                         allSongs.find(s => s.id === parseInt(item.id))
@@ -937,25 +1023,28 @@ function makeSortable() {
 async function fetchSongs() {
     console.log("fetchSongs called");
     try {
-        const response = await fetch('/songs', { credentials: 'include' });
-        if (!response.ok) {
-            throw new Error(`HTTP error! status: ${response.status}`);
-        }
-        const data = await response.json();
-        console.log("Fetched songs data:", data);
-        if (!Array.isArray(data)) {
-            throw new Error('Expected an array of songs, but received: ' + JSON.stringify(data));
-        }
-        allSongs = data.map(song => {
-            console.log("Processing song:", song);
-            if (song.lyrics && Array.isArray(song.lyrics)) {
-                lyricsData[song.id] = song.lyrics;
-                console.log("Updated lyricsData for song", song.id, ":", song.lyrics.slice(0, 5));
+        const songs = [];
+        let cursor = null;
+        do {
+            const params = new URLSearchParams({ limit: SONGS_PAGE_SIZE });
+            if (cursor) params.set('cursor', cursor);
+            const response = await fetch(`/songs?${params}`, { credentials: 'include' });
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
             }
-            return song;
-        });
-        console.log("Updated allSongs:", allSongs);
-        console.log("Updated lyricsData:", lyricsData);
+            const data = await response.json();
+            if (!Array.isArray(data.songs)) {
+                throw new Error('Expected an array of songs, but received: ' + JSON.stringify(data));
+            }
+            songs.push(...data.songs);
+            cursor = data.next_cursor;
+        } while (cursor);
+        allSongs = songs;
+        // Lyrics are fetched lazily per song; drop cached entries so edits are picked up
+        for (const song of allSongs) {
+            if (!song.has_lyrics) delete lyricsData[song.id];
+        }
+        console.log("Updated allSongs:", allSongs.length, "songs");
         if (selectedPlaylist) showPlaylistSongs(selectedPlaylist);
         else displaySongs();
     } catch (error) {
@@ -970,6 +1059,128 @@ async function fetchSongs() {
     }
 }
 
+async function fetchLyrics(songId) {
+    if (lyricsData[songId] !== undefined || pendingLyrics.has(songId)) return;
+    pendingLyrics.add(songId);
+    try {
+        const response = await fetch(`/song/${songId}/lyrics`, { credentials: 'include' });
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        const data = await response.json();
+        lyricsData[songId] = data.lyrics || { times: [], lines: [] };
+        updateLyrics();
+    } catch (error) {
+        console.error("Error fetching lyrics for song", songId, ":", error);
+    } finally {
+        pendingLyrics.delete(songId);
+    }
+}
+
+async function fetchLibraryVersion() {
+    const response = await fetch('/changes', { credentials: 'include' });
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    libraryVersion = (await response.json()).version;
+}
+
+// Full load; the version is taken first so changes made meanwhile are replayed, not lost
+async function reloadLibrary() {
+    try {
+        await fetchLibraryVersion();
+    } catch (error) {
+        console.error("Error fetching library version:", error);
+        libraryVersion = null;
+    }
+    await Promise.all([fetchSongs(), fetchPlaylists()]);
+}
+
+function renderLibrary() {
+    displayPlaylists();
+    if (selectedPlaylist) showPlaylistSongs(selectedPlaylist);
+    else displaySongs();
+}
+
+// Merge a /changes body into allSongs and playlists. Returns false when the
+// server asks for a reset. Applying the same delta twice is harmless.
+function applyChanges(delta) {
+    if (delta.reset) return false;
+    const deletedSongs = new Set(delta.deleted_songs);
+    const changedSongs = new Map(delta.songs.map(song => [song.id, song]));
+    for (const songId of [...deletedSongs, ...changedSongs.keys()]) {
+        delete lyricsData[songId];
+        delete waveforms[songId];
+    }
+    allSongs = allSongs.filter(song => !deletedSongs.has(song.id)).map(song => {
+        const changed = changedSongs.get(song.id);
+        if (!changed) return song;
+        changedSongs.delete(song.id);
+        return changed;
+    });
+    allSongs.push(...changedSongs.values());
+    if (currentSong) currentSong = allSongs.find(song => song.id === currentSong.id) || currentSong;
+
+    const deletedPlaylists = new Set(delta.deleted_playlists);
+    const changedPlaylists = new Map(delta.playlists.map(playlist => [playlist.id, playlist]));
+    playlists = playlists.filter(playlist => !deletedPlaylists.has(playlist.id)).map(playlist => {
+        const changed = changedPlaylists.get(playlist.id);
+        if (!changed) return playlist;
+        changedPlaylists.delete(playlist.id);
+        return changed;
+    });
+    playlists.push(...changedPlaylists.values());
+    libraryVersion = Math.max(libraryVersion, delta.version);
+    return true;
+}
+
+function deltaIsEmpty(delta) {
+    return !delta.songs.length && !delta.deleted_songs.length && !delta.playlists.length && !delta.deleted_playlists.length;
+}
+
+// Catch up with /changes after a mutation instead of reloading the whole library
+async function syncLibrary() {
+    if (libraryVersion === null) {
+        await reloadLibrary();
+        return;
+    }
+    try {
+        let changed = false;
+        let more = true;
+        while (more) {
+            const response = await fetch(`/changes?since=${libraryVersion}`, { credentials: 'include' });
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            const delta = await response.json();
+            if (!applyChanges(delta)) {
+                await reloadLibrary();
+                return;
+            }
+            changed = changed || !deltaIsEmpty(delta);
+            more = delta.more;
+        }
+        if (changed) renderLibrary();
+    } catch (error) {
+        console.error("Error syncing library:", error);
+    }
+}
+
+// Changes made by other sessions (or the indexer) arrive as server-sent events
+function connectChangeStream() {
+    if (changeStream || !window.EventSource || libraryVersion === null) return;
+    changeStream = new EventSource(`/changes/stream?since=${libraryVersion}`);
+    changeStream.addEventListener('changes', event => {
+        const delta = JSON.parse(event.data);
+        if (!applyChanges(delta)) {
+            reloadLibrary();
+        } else if (!deltaIsEmpty(delta)) {
+            renderLibrary();
+        }
+    });
+    changeStream.onerror = () => console.warn("Change stream interrupted, reconnecting");
+}
+
 async function fetchPlaylists() {
     console.log("fetchPlaylists called");
     try {
@@ -996,6 +1207,21 @@ async function fetchPlaylists() {
     }
 }
 
+// Cover as a <picture> choosing WebP/JPEG thumbnails by screen density; tiles
+// are about 104px wide. Falls back to the original when there are no thumbnails.
+function playlistImageHtml(playlist) {
+    const sizes = Object.keys(playlist.thumbnails || {}).sort((a, b) => a - b);
+    if (sizes.length === 0) {
+        return `<img src="${playlist.image}" alt="${playlist.name}" loading="lazy">`;
+    }
+    const srcset = format => sizes.map(size => `${playlist.thumbnails[size][format]} ${size}w`).join(', ');
+    const fallback = playlist.thumbnails[sizes[0]].jpeg;
+    return `<picture>
+                <source type="image/webp" srcset="${srcset('webp')}" sizes="104px">
+                <img src="${fallback}" srcset="${srcset('jpeg')}" sizes="104px" alt="${playlist.name}" loading="lazy">
+            </picture>`;
+}
+
 function displayPlaylists() {
     console.log("displayPlaylists called");
     const container = document.getElementById('playlists-container');
@@ -1005,7 +1231,7 @@ function displayPlaylists() {
         const div = document.createElement('div');
         div.className = 'playlist-item';
         div.innerHTML = `
-            <img src="${playlist.image}" alt="${playlist.name}">
+            ${playlistImageHtml(playlist)}
             <p>${playlist.name}</p>
         `;
         div.addEventListener('click', () => {
@@ -1037,6 +1263,7 @@ function displaySongs() {
             songItem.innerHTML = `
                 <i class="far fa-waveform"></i>
                 <span onclick="playSong(${song.id})" style="cursor: pointer;">${song.title} - ${song.artist}</span>
+                ${songDurationHtml(song)}
                 <button onclick="addToQueue(${song.id})"><i class="fas fa-plus"></i></button>
                 <button onclick="deleteSong(${song.id})" class="delete-btn"><i class="fas fa-trash"></i></button>
                 <button onclick="uploadLyrics(${song.id})" class="upload-lyrics-btn"><i class="fas fa-file-upload"></i> Upload Lyrics</button>
@@ -1139,7 +1366,7 @@ function uploadLyrics(songId) {
                     if ((songQueue.length > 0 && currentSongIndex >= 0 && songQueue[currentSongIndex].id === songId) || (currentSong && currentSong.id === songId)) {
                         updateLyrics();
                     }
-                    fetchSongs();
+                    syncLibrary();
                 } else {
                     alert("Failed to upload lyrics: " + data.message);
                 }
@@ -1198,53 +1425,70 @@ function updateLyrics() {
         return;
     }
     const lyrics = lyricsData[currentSongId];
-    if (!lyrics || !lyrics.length) {
+    if (lyrics === undefined) {
+        const song = currentSong || songQueue[currentSongIndex];
+        if (song && song.has_lyrics) fetchLyrics(currentSongId);
+    }
+    if (!lyrics || !lyrics.times.length) {
         console.log("No lyrics available for song ID:", currentSongId);
         lyricsText.innerHTML = '<p>No lyrics available. Upload a lyrics file to see synced lyrics.</p>';
         return;
     }
 
-    console.log("Lyrics for song:", lyrics);
-    console.log("Lyrics timestamp range:", {
-        first: lyrics[0].time,
-        last: lyrics[lyrics.length - 1].time,
-        totalLines: lyrics.length
-    });
-
+    const times = lyrics.times;
     const currentTime = audioPlayer.currentTime;
-    const songDuration = audioPlayer.duration || 0;
-    console.log("Song duration:", songDuration, "seconds");
-
-    const lrcDuration = lyrics[lyrics.length - 1].time;
     const offset = 0;
     const adjustedTime = currentTime - offset;
-    console.log("Current audio time:", currentTime, "Adjusted time:", adjustedTime);
 
-    let currentLineIndex = -1;
-    for (let i = 0; i < lyrics.length; i++) {
-        if (adjustedTime >= lyrics[i].time) {
-            currentLineIndex = i;
+    // Binary search for the last line starting at or before adjustedTime
+    let low = 0, high = times.length;
+    while (low < high) {
+        const mid = (low + high) >> 1;
+        if (times[mid] <= adjustedTime) {
+            low = mid + 1;
         } else {
-            break;
+            high = mid;
         }
     }
-    console.log("Current line index:", currentLineIndex);
-
-    if (currentLineIndex === -1 && adjustedTime > lrcDuration) {
-        currentLineIndex = lyrics.length - 1;
-        console.log("Past last lyric, setting currentLineIndex to last line:", currentLineIndex);
-    }
+    const currentLineIndex = low - 1;
 
     let html = '';
-    if (currentLineIndex >= 0 && currentLineIndex < lyrics.length) {
-        html = `<p class="current-lyric">${lyrics[currentLineIndex].text}</p>`;
+    if (currentLineIndex >= 0) {
+        html = `<p class="current-lyric">${lyrics.lines[currentLineIndex]}</p>`;
     } else {
         html = '<p>No lyrics at this time.</p>';
     }
-    console.log("Setting lyrics content to:", html);
-    lyricsText.innerHTML = html;
+    if (lyricsText.innerHTML !== html) {
+        lyricsText.innerHTML = html;
+    }
+}
 
-    console.log("Displaying single line at index:", currentLineIndex);
+// Persist one drag-and-drop move; only the moved song's position changes server-side.
+function moveSongItem(item) {
+    const songId = parseInt(item.dataset.id);
+    const previous = item.previousElementSibling;
+    const body = new URLSearchParams({ song_id: songId });
+    if (previous && previous.dataset.id) body.append('after_id', previous.dataset.id);
+    fetch('/move_song', { method: 'POST', body })
+    .then(response => {
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        return response.json();
+    })
+    .then(data => {
+        if (data.compacted) {
+            syncLibrary();
+            return;
+        }
+        const song = allSongs.find(s => s.id === songId);
+        if (song) song.position = data.position;
+    })
+    .catch(error => {
+        console.error("Error moving song:", error);
+        alert("Failed to rearrange playlist: " + error.message);
+        showPlaylistSongs(selectedPlaylist);
+    });
 }
 
 function handleDragStart(event) {
@@ -1271,14 +1515,14 @@ function handleDrop(event) {
     } else {
         container.insertBefore(allItems[draggedIndex], droppedOn);
     }
-    updateSongOrder(container.id);
+    updateSongOrder(container.id, draggedId);
 }
 
 function handleDragEnd() {
     // Cleanup if needed
 }
 
-function updateSongOrder(containerId) {
+function updateSongOrder(containerId, movedId = null) {
     const container = document.getElementById(containerId);
     if (!container) return;
     const items = Array.from(container.children);
@@ -1288,27 +1532,8 @@ function updateSongOrder(containerId) {
     }));
 
     if (containerId === 'songs-container' && selectedPlaylist) {
-        const songIds = newOrder.map(item => parseInt(item.id));
-        fetch('/rearrange_playlist', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
-            body: `playlist_name=${encodeURIComponent(selectedPlaylist)}&song_ids=${songIds.join(',')}`
-        })
-        .then(response => {
-            if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
-            }
-            return response.json();
-        })
-        .then(data => {
-            console.log(data.message);
-            fetchSongs();
-        })
-        .catch(error => {
-            console.error("Error rearranging playlist:", error);
-            alert("Failed to rearrange playlist: " + error.message);
-            showPlaylistSongs(selectedPlaylist);
-        });
+        const moved = movedId && items.find(item => item.dataset.id === movedId);
+        if (moved) moveSongItem(moved);
     } else if (containerId === 'queue-container') {
         songQueue = newOrder.map(item => 
             allSongs.find(s => s.id === parseInt(item.id))
@@ -1365,7 +1590,8 @@ document.addEventListener('DOMContentLoaded', async () => {
 
     const path = window.location.pathname;
     if (path === '/index' || path === '/') {
-        await Promise.all([fetchSongs(), fetchPlaylists()]);
+        await reloadLibrary();
+        connectChangeStream();
         showMainView();
     }
 
@@ -0,0 +1,232 @@
+"""Range-aware, conditionally cached audio streaming.
+
+``stream_file`` answers a request for one file with 200, 206, 304 or 416.
+Bodies are sent with the ASGI ``http.response.zerocopysend`` extension
+(os.sendfile in the server) when the server offers it, and otherwise read
+with os.pread in the thread pool. uvicorn, which ``python main.py`` runs,
+does not offer the extension, so under it every body takes the pread path.
+SongPathCache keeps song id -> file
+lookups in memory so hot tracks need no database round trip.
+"""
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+CACHE_CONTROL = "public, max-age=86400"
+PATH_CACHE_SIZE = 10000
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class SongPathCache:
+    """LRU map of song id -> (path, size, mtime).
+
+    Misses fall through to ``loader(song_id)``, which returns the relative
+    filename or None. The write paths and the indexer drop stale entries.
+    """
+
+    def __init__(self, root: Path, loader: Callable[[int], Optional[str]], maxsize: int = PATH_CACHE_SIZE):
+        self.root = root
+        self.loader = loader
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[int, Tuple[Path, int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cached(self, song_id: int) -> Optional[Tuple[Path, int, float]]:
+        """Return the cached entry without any I/O, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(song_id)
+            if entry is not None:
+                self._entries.move_to_end(song_id)
+                self.hits += 1
+            return entry
+
+    def load(self, song_id: int) -> Optional[Tuple[Path, int, float]]:
+        """Look ``song_id`` up and cache it; blocking, call off the event loop.
+
+        Returns None for an unknown song and raises FileNotFoundError when
+        the song exists but its file does not.
+        """
+        self.misses += 1
+        filename = self.loader(song_id)
+        if filename is None:
+            return None
+        path = self.root / filename
+        st = path.stat()
+        entry = (path, st.st_size, st.st_mtime)
+        with self._lock:
+            self._entries[song_id] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, song_id: Optional[int] = None):
+        """Forget one song, or everything when ``song_id`` is None."""
+        with self._lock:
+            if song_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(song_id, None)
+
+
+def make_etag(size: int, mtime: float) -> str:
+    return f'"{size:x}-{int(mtime * 1000):x}"'
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single ``bytes=`` range into inclusive (start, end).
+
+    Returns None when the header should be ignored (malformed or multiple
+    ranges, which we answer with the full body) and raises ValueError when
+    the range cannot be satisfied.
+    """
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("range not satisfiable")
+    return start, min(end, size - 1)
+
+
+def not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def range_applies(request: Request, etag: str, last_modified: str) -> bool:
+    """Honour If-Range: only serve a partial body if the validator still matches."""
+    if_range = request.headers.get("if-range")
+    return if_range is None or if_range.strip() in (etag, last_modified)
+
+
+class FileRangeResponse(Response):
+    """Send bytes [start, end] of an open file, zero-copy when the server allows.
+
+    ``size`` is the size the headers were built for. If the opened file has
+    another size (it changed since it was indexed), the response is rebuilt
+    with ``resized(actual size)`` instead.
+    """
+
+    def __init__(self, path: Path, start: int, end: int, status_code: int, headers: dict, media_type: str,
+                 size: int, resized: Callable[[int], Response]):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.path = path
+        self.start = start
+        self.end = end
+        self.size = size
+        self.resized = resized
+        self.headers["content-length"] = str(end - start + 1)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            fd = await run_in_threadpool(os.open, self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            await Response(status_code=404)(scope, receive, send)
+            return
+        try:
+            size = (await run_in_threadpool(os.fstat, fd)).st_size
+            if size != self.size:
+                await self.resized(size)(scope, receive, send)
+                return
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if scope["method"] == "HEAD" or self.end < self.start:
+                await send({"type": "http.response.body", "body": b""})
+                return
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": os.fdopen(fd, "rb", closefd=False),
+                    "offset": self.start,
+                    "count": self.end - self.start + 1,
+                })
+                return
+            offset = self.start
+            while offset <= self.end:
+                length = min(CHUNK_SIZE, self.end - offset + 1)
+                chunk = await run_in_threadpool(os.pread, fd, length, offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": offset <= self.end})
+            if offset <= self.end:  # file shrank underneath us; close the body anyway
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            os.close(fd)
+
+
+def stream_file(request: Request, path: Path, size: int, mtime: float, media_type: str = "audio/mpeg",
+                cache_control: str = CACHE_CONTROL, extra_headers: Optional[dict] = None) -> Response:
+    """Build the 200/206/304/416 response for ``path``, assuming it is ``size`` bytes."""
+    def resized(actual: int) -> Response:
+        return stream_file(request, path, actual, mtime, media_type, cache_control, extra_headers)
+
+    etag = make_etag(size, mtime)
+    last_modified = formatdate(mtime, usegmt=True)
+    headers = {
+        "accept-ranges": "bytes",
+        "etag": etag,
+        "last-modified": last_modified,
+        "cache-control": cache_control,
+        **(extra_headers or {}),
+    }
+    if not_modified(request, etag, mtime):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if range_header and range_applies(request, etag, last_modified):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "content-range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            headers["content-range"] = f"bytes {start}-{end}/{size}"
+            return FileRangeResponse(path, start, end, 206, headers, media_type, size, resized)
+    return FileRangeResponse(path, 0, size - 1, 200, headers, media_type, size, resized)
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that also sends a Cache-Control header."""
+
+    def __init__(self, *args, cache_control: str = CACHE_CONTROL, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        response.headers.setdefault("cache-control", self.cache_control)
+        return response
@@ -0,0 +1,80 @@
+"""ID3 tags, duration and bitrate of library files.
+
+``read_tags`` opens one mp3 with mutagen; ``read_many`` spreads a batch over
+a process pool, since parsing frame headers and tag blocks is CPU-bound and
+a first index of a large library touches every file. The indexer stores
+the results in ``songs`` together with the mtime and size they were read
+at, so a file is only read again once it changes.
+
+mutagen is optional: without it nothing is read and titles and artists
+keep coming from the file names.
+"""
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, Optional, Sequence
+
+try:
+    from mutagen import MutagenError
+    from mutagen.mp3 import MP3
+except ImportError:  # pragma: no cover - depends on the install
+    MP3 = None
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = max(1, min(8, (os.cpu_count() or 2) - 1))
+POOL_THRESHOLD = 64  # smaller batches are read inline; starting workers costs more
+CHUNK_SIZE = 32
+
+
+@dataclass
+class Tags:
+    title: Optional[str] = None
+    artist: Optional[str] = None
+    album: Optional[str] = None
+    duration: Optional[float] = None  # seconds
+    bitrate: Optional[int] = None  # bits per second
+
+
+def available() -> bool:
+    return MP3 is not None
+
+
+def _text(id3, key: str) -> Optional[str]:
+    frame = id3.get(key) if id3 is not None else None
+    if frame is None or not frame.text:
+        return None
+    value = str(frame.text[0]).strip()
+    return value or None
+
+
+def read_tags(path: str) -> Optional[Tags]:
+    """Tags of the mp3 at ``path``, or None when it can't be parsed."""
+    try:
+        audio = MP3(path)
+    except (MutagenError, OSError, ValueError) as e:
+        logger.debug("Could not read tags from %s: %s", path, e)
+        return None
+    info = audio.info
+    return Tags(
+        title=_text(audio.tags, "TIT2"),
+        artist=_text(audio.tags, "TPE1"),
+        album=_text(audio.tags, "TALB"),
+        duration=round(info.length, 3) if info.length else None,
+        bitrate=info.bitrate or None,
+    )
+
+
+def read_many(paths: Sequence[str], max_workers: int = MAX_WORKERS) -> Iterator[Optional[Tags]]:
+    """Yield read_tags for every path, in order; large batches use a process pool.
+
+    Results are yielded as they arrive so callers can store them in batches.
+    """
+    if len(paths) < POOL_THRESHOLD or max_workers < 2:
+        yield from map(read_tags, paths)
+        return
+    # Spawned, not forked: this runs from the indexer's thread in a server full of threads and locks
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        yield from executor.map(read_tags, paths, chunksize=CHUNK_SIZE)
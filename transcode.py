@@ -0,0 +1,198 @@
+"""On-demand lower-bitrate variants of songs, kept in a size-bounded disk cache.
+
+Variants are produced by the local ffmpeg the first time they are asked for
+and stored under CACHE_DIR keyed by song id, source size/mtime and profile,
+so a changed source file never serves a stale variant. The cache evicts
+least recently used files once it grows past ``max_bytes``, and concurrent
+requests for the same variant share a single ffmpeg run.
+
+The directory is the cache's only state, so every server worker process
+shares it and the one byte budget: recency is the files' mtimes, and the
+size is summed from the directory when evicting. Nothing touches the disk
+until ``open()``.
+"""
+import asyncio
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Mapping, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from metrics import FILE_IO_SECONDS
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = Path("transcode_cache")
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+MAX_CONCURRENT_TRANSCODES = max(1, (os.cpu_count() or 2) // 2)
+STALE_PART_AGE = 3600  # seconds; younger .part files may still be written by another worker
+
+
+@dataclass(frozen=True)
+class Profile:
+    name: str
+    codec: str
+    bitrate: str
+    extension: str
+    media_type: str
+    format: str
+
+
+PROFILES: Dict[str, Profile] = {
+    "64": Profile("64", "libmp3lame", "64k", "mp3", "audio/mpeg", "mp3"),
+    "96": Profile("96", "libmp3lame", "96k", "mp3", "audio/mpeg", "mp3"),
+    "128": Profile("128", "libmp3lame", "128k", "mp3", "audio/mpeg", "mp3"),
+    "opus": Profile("opus", "libopus", "64k", "ogg", "audio/ogg", "ogg"),
+}
+
+# Client hints (https://wicg.github.io/netinfo/) mapped to a profile when no
+# explicit ?quality= is given.
+ECT_PROFILES = {"slow-2g": "64", "2g": "64", "3g": "96"}
+
+
+def select_profile(quality: Optional[str], headers: Mapping[str, str]) -> Optional[Profile]:
+    """Pick a profile from ``quality`` or the request's client hints.
+
+    Returns None for the original file. Raises KeyError for an unknown
+    explicit quality.
+    """
+    if quality:
+        if quality == "original":
+            return None
+        return PROFILES[quality]
+    if headers.get("save-data", "").lower() == "on":
+        return PROFILES["64"]
+    ect = headers.get("ect", "").lower()
+    if ect in ECT_PROFILES:
+        return PROFILES[ECT_PROFILES[ect]]
+    return None
+
+
+class Transcoder:
+    """Produces and caches variants; see the module docstring."""
+
+    def __init__(self, cache_dir: Path = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES,
+                 concurrency: int = MAX_CONCURRENT_TRANSCODES, ffmpeg: Optional[str] = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ffmpeg = ffmpeg or shutil.which("ffmpeg")
+        self.hits = 0
+        self.misses = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._flights = SingleFlight()
+        self._total = 0  # as of the last scan
+        if not self.ffmpeg:
+            logger.warning("ffmpeg not found, transcoded variants are disabled")
+
+    @property
+    def available(self) -> bool:
+        return self.ffmpeg is not None
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total
+
+    def open(self):
+        """Create the cache directory, drop abandoned temp files and apply the budget; blocking."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        cutoff = time.time() - STALE_PART_AGE
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".part"):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)  # left over from an interrupted run
+            except FileNotFoundError:
+                pass  # another worker finished or removed it
+        self._evict()
+
+    async def variant(self, song_id: int, source: Path, size: int, mtime: float,
+                      profile: Profile) -> Tuple[Path, int, float]:
+        """Return (path, size, mtime) of the cached variant, transcoding if needed.
+
+        The returned mtime is the source's, so validators stay stable while
+        the cache touches files to track recency.
+        """
+        name = f"{song_id}-{size:x}-{int(mtime * 1000):x}-{profile.name}.{profile.extension}"
+        path = self.cache_dir / name
+        try:
+            # Another worker may have made it, so ask the disk rather than memory
+            st = await run_in_threadpool(self._touch, path)
+            self.hits += 1
+            return path, st.st_size, mtime
+        except FileNotFoundError:
+            pass
+
+        return await self._flights.run(name, lambda: self._produce(source, path, mtime, profile))
+
+    async def _produce(self, source: Path, path: Path, mtime: float,
+                       profile: Profile) -> Tuple[Path, int, float]:
+        self.misses += 1
+        async with self._semaphore:
+            await self._transcode(source, path, profile)
+        st = path.stat()
+        await run_in_threadpool(self._evict, path.name)
+        return path, st.st_size, mtime
+
+    async def _transcode(self, source: Path, target: Path, profile: Profile):
+        if not self.ffmpeg:
+            raise RuntimeError("ffmpeg is not available")
+        # Named per process: workers transcoding the same variant must not share a temp file
+        tmp = target.with_name(f"{target.name}.{os.getpid()}.part")
+        process = await asyncio.create_subprocess_exec(
+            self.ffmpeg, "-nostdin", "-v", "error", "-y", "-i", str(source),
+            "-vn", "-map_metadata", "0", "-c:a", profile.codec, "-b:a", profile.bitrate,
+            "-f", profile.format, str(tmp),
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            with FILE_IO_SECONDS.time(op="transcode"):
+                _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        if process.returncode != 0:
+            tmp.unlink(missing_ok=True)
+            raise RuntimeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace').strip()}")
+        os.replace(tmp, target)
+        logger.debug("Transcoded %s to %s", source, target.name)
+
+    def _touch(self, path: Path) -> os.stat_result:
+        os.utime(path)  # keeps LRU order across restarts and workers
+        return path.stat()
+
+    def _evict(self, keep: Optional[str] = None):
+        """Delete least recently used variants until the directory fits ``max_bytes``; blocking.
+
+        ``keep`` (the variant just made) is never evicted.
+        """
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".part") or entry.name == keep:
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue  # evicted by another worker meanwhile
+            files.append((st.st_mtime, entry.name, st.st_size))
+        total = sum(size for _, _, size in files)
+        if keep is not None:
+            try:
+                total += (self.cache_dir / keep).stat().st_size
+            except FileNotFoundError:
+                pass
+        for _, name, size in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(self.cache_dir / name)
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.debug("Evicted transcode %s", name)
+        self._total = total
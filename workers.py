@@ -0,0 +1,226 @@
+"""Running several server processes against one database.
+
+Every uvicorn or gunicorn worker is its own process with its own caches, so
+whatever the workers have to agree on is kept in SQLite:
+
+* Leases. A row in ``leases`` names the worker holding it until
+  ``expires_at``; the holder renews it while it lives, and once it stops
+  any other worker can take it over. The library indexer and peak analyzer
+  only run in the worker holding INDEXER_LEASE, so the library is scanned
+  once however many workers there are. Other workers ask it for a run
+  through ``requested_at`` and read its progress from ``status``.
+* Epochs. Counters in ``epochs`` that triggers bump when a cached copy of
+  something goes stale (a session was revoked, a song's file or lyrics
+  changed). Coordinator polls them and calls the invalidations registered
+  with ``watch``, whichever worker made the change.
+
+Songs and playlists need neither: clients and snapshots follow the change
+log (changes.py), which every worker polls already. ``serve`` runs the app
+with one worker per core.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+import db
+
+logger = logging.getLogger(__name__)
+
+INDEXER_LEASE = "indexer"
+POLL_INTERVAL = 1.0  # seconds between checks of the lease and the epochs
+RENEW_INTERVAL = 5.0
+LEASE_TTL = 15.0  # a holder that hasn't renewed for this long is replaced
+SHUTDOWN_TIMEOUT = 10.0  # seconds the server waits for open connections before cancelling them
+EXIT_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _state(conn: sqlite3.Connection, name: str) -> Tuple[Optional[tuple], Dict[str, int]]:
+    lease = conn.execute("SELECT holder, expires_at, requested_at FROM leases WHERE name = ?", (name,)).fetchone()
+    return lease, dict(conn.execute("SELECT name, value FROM epochs").fetchall())
+
+
+def acquire(conn: sqlite3.Connection, name: str, holder: str, ttl: float = LEASE_TTL,
+            status: Optional[str] = None) -> bool:
+    """Take lease ``name`` if it is free or expired, or renew it; True if ``holder`` has it now."""
+    now = time.time()
+    conn.execute(
+        """INSERT INTO leases (name, holder, expires_at, status) VALUES (?, ?, ?, ?)
+           ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at,
+               status = excluded.status
+           WHERE leases.holder = excluded.holder OR leases.expires_at < ?""",
+        (name, holder, now + ttl, status, now))
+    row = conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+    return row[0] == holder
+
+
+def release(conn: sqlite3.Connection, name: str, holder: str):
+    """Give up lease ``name`` so another worker can take it right away."""
+    # The status described this holder's work; the next one publishes its own
+    conn.execute("UPDATE leases SET expires_at = 0, status = NULL WHERE name = ? AND holder = ?", (name, holder))
+
+
+def request_run(conn: sqlite3.Connection, name: str):
+    """Ask the holder of lease ``name`` to run again; it notices within POLL_INTERVAL."""
+    conn.execute(
+        """INSERT INTO leases (name, holder, expires_at, requested_at) VALUES (?, '', 0, ?)
+           ON CONFLICT (name) DO UPDATE SET requested_at = excluded.requested_at""",
+        (name, time.time()))
+
+
+def read_status(conn: sqlite3.Connection, name: str) -> Optional[dict]:
+    """The status the holder of lease ``name`` last published, if any."""
+    row = conn.execute("SELECT status FROM leases WHERE name = ?", (name,)).fetchone()
+    return json.loads(row[0]) if row and row[0] else None
+
+
+class Coordinator:
+    """Competes for one lease and watches the epochs; see the module docstring.
+
+    ``on_elected`` is called when this worker takes the lease and
+    ``on_requested`` when another worker asks for a run while it holds it.
+    ``status`` is published with every renewal. Callbacks run on the event
+    loop and must not block.
+    """
+
+    def __init__(self, lease: str, on_elected: Callable[[], None], on_requested: Callable[[], None],
+                 status: Callable[[], dict] = dict, poll_interval: float = POLL_INTERVAL):
+        self.lease = lease
+        self.on_elected = on_elected
+        self.on_requested = on_requested
+        self.status = status
+        self.poll_interval = poll_interval
+        self.holder = WORKER_ID
+        self.leader = False
+        self._watchers: Dict[str, List[Callable[[], None]]] = {}
+        self._epochs: Optional[Dict[str, int]] = None
+        self._renewed_at = 0.0
+        self._published: Optional[str] = None
+        self._requested_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def watch(self, epoch: str, callback: Callable[[], None]):
+        """Call ``callback`` whenever epoch ``epoch`` moves."""
+        self._watchers.setdefault(epoch, []).append(callback)
+
+    async def start(self):
+        """Poll once, so a lone worker is leader before it serves, then keep polling in the background."""
+        if self._task is None:
+            await self.poll()
+            self._task = asyncio.create_task(self._run(), name="worker-coordinator")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.leader:
+            self.leader = False
+            await db.run(release, self.lease, self.holder)
+
+    async def poll(self):
+        lease, epochs = await db.read(_state, self.lease)
+        if self._epochs is not None:
+            for name, value in epochs.items():
+                if value != self._epochs.get(name):
+                    for callback in self._watchers.get(name, ()):
+                        callback()
+        self._epochs = epochs
+
+        holder, expires_at, requested_at = lease or (None, 0.0, None)
+        now = time.time()
+        status = json.dumps(self.status())
+        if holder == self.holder and expires_at > now:
+            # Renewing is a write; only do it when due or when there is news to publish
+            if now - self._renewed_at >= RENEW_INTERVAL or status != self._published:
+                await self._acquire(status)
+        elif expires_at <= now:
+            await self._acquire(status)
+        elif self.leader:
+            self.leader = False
+            logger.warning(f"Lost the {self.lease} lease to {holder}")
+
+        if self.leader and requested_at is not None and requested_at != self._requested_at:
+            self._requested_at = requested_at
+            self.on_requested()
+
+    async def _acquire(self, status: str):
+        was_leader = self.leader
+        self.leader = await db.run(acquire, self.lease, self.holder, LEASE_TTL, status)
+        if not self.leader:
+            return
+        self._renewed_at = time.time()
+        self._published = status
+        if not was_leader:
+            logger.info(f"Worker {self.holder} holds the {self.lease} lease")
+            # Whatever was requested before is covered by the run on_elected starts
+            self._requested_at = (await db.read(_state, self.lease))[0][2]
+            self.on_elected()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.error(f"Worker coordination poll failed: {e}")
+
+
+@contextmanager
+def on_exit_signal(callback: Callable[[], None]):
+    """Call ``callback`` on the running loop as soon as SIGINT or SIGTERM arrives.
+
+    Servers only run the lifespan shutdown after open connections have
+    closed, so long-lived responses (/changes/stream) need this to hear
+    about the shutdown in time. The server's own handlers still run. Only
+    the main thread can install handlers; elsewhere this does nothing.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    loop = asyncio.get_running_loop()
+    previous = {sig: signal.getsignal(sig) for sig in EXIT_SIGNALS}
+
+    def handle(sig, frame):
+        loop.call_soon_threadsafe(callback)
+        if callable(previous[sig]):
+            previous[sig](sig, frame)
+        else:
+            # SIG_DFL or SIG_IGN: put it back and let it act on this signal
+            signal.signal(sig, previous[sig])
+            signal.raise_signal(sig)
+
+    for sig in EXIT_SIGNALS:
+        signal.signal(sig, handle)
+    try:
+        yield
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+
+
+def default_workers() -> int:
+    return int(os.environ.get("WEB_CONCURRENCY", 0)) or os.cpu_count() or 1
+
+
+def serve(app: str, host: str, port: int, workers: Optional[int] = None, **options):
+    """Run the app factory ``app`` ("module:function") in ``workers`` processes under uvicorn."""
+    import uvicorn
+
+    workers = workers or default_workers()
+    logger.info(f"Starting {workers} workers on {host}:{port}")
+    options.setdefault("timeout_graceful_shutdown", SHUTDOWN_TIMEOUT)
+    uvicorn.run(app, factory=True, host=host, port=port, workers=workers, **options)
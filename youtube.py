@@ -0,0 +1,196 @@
+"""yt_dlp helpers for downloads and search.
+
+The plain functions block on the network or on ffmpeg, so they must only be
+called from worker threads, never directly from a route handler. Route
+handlers search through SearchService, which does that for them.
+
+yt_dlp itself is imported on first use rather than with this module: it is
+a large package, and most server starts never search or download.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+import db
+from jobs import Job
+from metrics import YTDLP_SECONDS
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+AUDIO_QUALITY = "192"
+SEARCH_RESULTS = 10
+SEARCH_CACHE_SIZE = 256
+SEARCH_CACHE_TTL = 600  # seconds
+SEARCH_CONCURRENCY = 4
+
+
+def _youtube_dl(options: dict):
+    import yt_dlp  # cached in sys.modules after the first call
+    return yt_dlp.YoutubeDL(options)
+
+
+def looks_like_playlist(url: str) -> bool:
+    """Cheap check so single videos don't pay for an extra playlist extraction."""
+    return "list=" in url or "/playlist" in url
+
+
+def playlist_entries(url: str) -> Optional[List[str]]:
+    """Return the video URLs of a playlist URL, or None if it is a single video."""
+    ydl_opts = {
+        'quiet': True,
+        'extract_flat': 'in_playlist',
+    }
+    with YTDLP_SECONDS.time(op="playlist_entries"), _youtube_dl(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if info.get('_type') != 'playlist':
+        return None
+    urls = []
+    for entry in info.get('entries') or []:
+        if not entry:
+            continue
+        entry_url = entry.get('url') or entry.get('webpage_url')
+        if not entry_url and entry.get('id'):
+            entry_url = f"https://www.youtube.com/watch?v={entry['id']}"
+        if entry_url:
+            urls.append(entry_url)
+    logger.debug("Expanded playlist %s into %s entries", url, len(urls))
+    return urls
+
+
+def download_song(job: Job, music_dir: Path, playlist_name: str, youtube_url: str) -> dict:
+    """Download ``youtube_url`` as mp3 into the playlist and add it to the library."""
+    playlist_dir = music_dir / playlist_name
+    playlist_dir.mkdir(exist_ok=True)
+
+    def progress_hook(d):
+        if d['status'] == 'downloading':
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            downloaded = d.get('downloaded_bytes') or 0
+            job.update(stage="downloading", downloaded_bytes=downloaded, total_bytes=total,
+                       percent=round(downloaded * 100 / total, 1) if total else None,
+                       speed=d.get('speed'), eta=d.get('eta'))
+        elif d['status'] == 'finished':
+            job.update(stage="converting", percent=100.0)
+
+    def postprocessor_hook(d):
+        if d['status'] == 'started':
+            job.update(stage="converting", postprocessor=d.get('postprocessor'))
+
+    ydl_opts = {
+        'format': 'bestaudio/best',
+        'outtmpl': str(playlist_dir / '%(title)s.%(ext)s'),
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'mp3',
+            'preferredquality': AUDIO_QUALITY,
+        }],
+        'noplaylist': True,
+        'quiet': True,
+        'progress_hooks': [progress_hook],
+        'postprocessor_hooks': [postprocessor_hook],
+    }
+
+    job.update(stage="resolving")
+    with YTDLP_SECONDS.time(op="download"), _youtube_dl(ydl_opts) as ydl:
+        info = ydl.extract_info(youtube_url, download=True)
+        downloaded_file = Path(ydl.prepare_filename(info)).with_suffix('.mp3')
+        filename = f"{playlist_name}/{downloaded_file.name}"
+        title = info.get('title', 'Unknown Title')
+        artist = info.get('uploader', 'Unknown Artist').replace(" - Topic", "")
+        os.rename(downloaded_file, playlist_dir / downloaded_file.name)  # Ensure file is in correct directory
+
+    with db.transaction() as conn:
+        song_id = db.insert_song(conn, title, artist, filename, playlist_name)
+    job.update(stage="done")
+    logger.debug("Added song %s to playlist %s", title, playlist_name)
+    return {"song_id": song_id, "title": title, "artist": artist, "playlist": playlist_name}
+
+
+def search(query: str, limit: int = SEARCH_RESULTS) -> List[dict]:
+    """Search YouTube without resolving formats for every entry."""
+    ydl_opts = {
+        'quiet': True,
+        'extract_flat': True,
+        'skip_download': True,
+    }
+    with YTDLP_SECONDS.time(op="search"), _youtube_dl(ydl_opts) as ydl:
+        result = ydl.extract_info(f"ytsearch{limit}:{query}", download=False)
+    results = []
+    for v in result.get('entries') or []:
+        if not v:
+            continue
+        url = v.get('webpage_url') or v.get('url') or f"https://www.youtube.com/watch?v={v.get('id')}"
+        results.append({"title": v.get('title'), "url": url,
+                        "artist": v.get('uploader') or v.get('channel') or 'Unknown'})
+    logger.debug("YouTube search returned %s results for query: %s", len(results), query)
+    return results
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+class SearchService:
+    """Async front end to ``search`` with an LRU+TTL cache and single-flight.
+
+    Identical queries (after normalization) that arrive while one is already
+    running wait for that result instead of starting another extraction, and
+    at most ``concurrency`` extractions run in the thread pool at once.
+    ``extractor`` can be swapped for a stub in tests.
+    """
+
+    def __init__(self, extractor: Callable[[str], List[dict]] = search, maxsize: int = SEARCH_CACHE_SIZE,
+                 ttl: float = SEARCH_CACHE_TTL, concurrency: int = SEARCH_CONCURRENCY,
+                 clock: Callable[[], float] = time.monotonic):
+        self.extractor = extractor
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[str, Tuple[float, List[dict]]]" = OrderedDict()
+        self._flights = SingleFlight()
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def search(self, query: str) -> List[dict]:
+        key = normalize_query(query)
+        if not key:
+            return []
+
+        cached = self._cache.get(key)
+        if cached is not None:
+            expires_at, results = cached
+            if expires_at > self.clock():
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return results
+            del self._cache[key]
+
+        return await self._flights.run(key, lambda: self._extract(key))
+
+    @property
+    def coalesced(self) -> int:
+        return self._flights.coalesced
+
+    def clear(self):
+        self._cache.clear()
+
+    async def _extract(self, key: str) -> List[dict]:
+        self.misses += 1
+        async with self._semaphore:
+            results = await run_in_threadpool(self.extractor, key)
+        self._store(key, results)
+        return results
+
+    def _store(self, key: str, results: List[dict]):
+        self._cache[key] = (self.clock() + self.ttl, results)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)